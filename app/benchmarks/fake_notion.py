@@ -0,0 +1,271 @@
+import datetime
+import json
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+from benchmarks.stub_server import StubNotionServer
+from services.metrics import endpoint_label
+
+
+WORKOUT_DATABASE_ID = '3f1c2b7a-5d4e-4a8b-9c6d-0e1f2a3b4c5d'
+RUN_DATABASE_ID = 'e9949596-756e-40af-abcb-efbac49ee837'
+
+TIMESTAMP = '2023-07-01T10:00:00.000Z'
+
+# операторы условий фильтра query, поддерживаемые fake сервером
+FILTER_OPERATORS = {
+    'equals': lambda value, operand: value == operand,
+    'does_not_equal': lambda value, operand: value != operand,
+    'is_empty': lambda value, operand: value in (None, ''),
+    'is_not_empty': lambda value, operand: value not in (None, ''),
+    'contains': lambda value, operand: value is not None and operand in value,
+    'greater_than': lambda value, operand: value is not None and value > operand,
+    'greater_than_or_equal_to': lambda value, operand: value is not None and value >= operand,
+    'less_than': lambda value, operand: value is not None and value < operand,
+    'less_than_or_equal_to': lambda value, operand: value is not None and value <= operand,
+    'after': lambda value, operand: value is not None and value > operand,
+    'on_or_after': lambda value, operand: value is not None and value >= operand,
+    'before': lambda value, operand: value is not None and value < operand,
+    'on_or_before': lambda value, operand: value is not None and value <= operand,
+}
+
+FILTER_PROPERTY_TYPES = ('title', 'rich_text', 'number', 'date')
+
+
+class UnsupportedQueryError(ValueError):
+    pass
+
+
+def _title(text: str) -> list[dict]:
+    return [{'type': 'text', 'text': {'content': text}, 'plain_text': text}]
+
+
+def _timestamp(moment: datetime.datetime) -> str:
+    return moment.astimezone(datetime.timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def _property_value(value: dict | None):
+    """
+    Значение свойства записи для сравнения в фильтре и сортировке: текст, число, начало даты или строка формулы
+    """
+    if not value:
+        return None
+    if 'title' in value or 'rich_text' in value:
+        parts = value.get('title', value.get('rich_text')) or []
+        return ''.join(part.get('plain_text', part.get('text', {}).get('content', '')) for part in parts)
+    if 'number' in value:
+        return value['number']
+    if 'date' in value:
+        return value['date']['start'] if value['date'] else None
+    if 'formula' in value:
+        formula: dict = value['formula']
+        return formula.get(formula.get('type'))
+    raise UnsupportedQueryError(f'Unsupported property {value}')
+
+
+def _matches(page: dict, condition: dict) -> bool:
+    """
+    Проверка записи условием фильтра query: and, or, условия по свойствам и по created_time/last_edited_time
+
+    :raises UnsupportedQueryError: если условие fake сервер не поддерживает
+    """
+    if 'and' in condition:
+        return all(_matches(page, item) for item in condition['and'])
+    if 'or' in condition:
+        return any(_matches(page, item) for item in condition['or'])
+    if 'timestamp' in condition:
+        kind: str = condition['timestamp']
+        value = page.get(kind)
+    elif 'property' in condition:
+        kind = next((key for key in condition if key != 'property'), None)
+        if kind not in FILTER_PROPERTY_TYPES:
+            raise UnsupportedQueryError(f'Unsupported filter {condition}')
+        value = _property_value(page['properties'].get(condition['property']))
+    else:
+        raise UnsupportedQueryError(f'Unsupported filter {condition}')
+    if kind not in condition or len(condition[kind]) != 1:
+        raise UnsupportedQueryError(f'Unsupported filter {condition}')
+    operator, operand = next(iter(condition[kind].items()))
+    if operator not in FILTER_OPERATORS:
+        raise UnsupportedQueryError(f'Unsupported filter operator {operator}')
+    if kind == 'date' and value is not None and isinstance(operand, str):
+        # даты без времени сравниваются по дню
+        value, operand = (value[:10], operand[:10]) if len(value) == 10 or len(operand) == 10 else (value, operand)
+    return FILTER_OPERATORS[operator](value, operand)
+
+
+def _sort_value(page: dict, rule: dict):
+    if 'timestamp' in rule:
+        return page.get(rule['timestamp'])
+    if 'property' in rule:
+        return _property_value(page['properties'].get(rule['property']))
+    raise UnsupportedQueryError(f'Unsupported sort {rule}')
+
+
+def _sort(records: list[dict], sorts: list[dict]) -> list[dict]:
+    """
+    Сортировка записей по свойствам и created_time/last_edited_time, пустые значения в конце
+    """
+    for rule in reversed(sorts):
+        descending: bool = rule.get('direction', 'ascending') == 'descending'
+        present = [page for page in records if _sort_value(page, rule) is not None]
+        empty = [page for page in records if _sort_value(page, rule) is None]
+        records = sorted(present, key=lambda page: _sort_value(page, rule), reverse=descending) + empty
+    return records
+
+
+def _workout_record(day: datetime.date) -> dict:
+    properties = {
+        'Дата': {'type': 'date', 'date': {'start': str(day)}},
+        'Название': {'type': 'title', 'title': _title(f'Турник {day}')},
+    }
+    for exercise in (1, 2):
+        for attempt in (1, 2, 3):
+            properties[f'{exercise}.{attempt}'] = {'type': 'number', 'number': day.day + attempt}
+    return properties
+
+
+def _run_record(day: datetime.date) -> dict:
+    return {
+        'Название': {'type': 'title', 'title': _title(f'Пробежка {day}')},
+        'Дата': {'type': 'date', 'date': {'start': str(day)}},
+        'Дистанция (км)': {'type': 'number', 'number': 8 + day.day % 5},
+        'Общее время': {'type': 'formula', 'formula': {'type': 'string', 'string': '00:55:12'}},
+        'Средний темп': {'type': 'formula', 'formula': {'type': 'string', 'string': "5'31\""}},
+        'Сожжено (ккал)': {'type': 'number', 'number': 640},
+        'Средний пульс (уд/мин)': {'type': 'number', 'number': 151},
+        'Максимальный пульс (уд/мин)': {'type': 'number', 'number': 174},
+        'Время паузы': {'type': 'formula', 'formula': {'type': 'string', 'string': '00:01:05'}},
+        'Время (часы)': {'type': 'number', 'number': 0},
+        'Время (минуты)': {'type': 'number', 'number': 50 + day.day % 10},
+        'Время (секунды)': {'type': 'number', 'number': 12},
+    }
+
+
+class FakeNotionServer(StubNotionServer):
+    """
+    Локальный fake Notion API с эндпоинтами search, databases, query и pages.
+
+    Содержит базу тренировок на турнике и базу пробежек. Query поддерживает фильтры and/or с условиями
+    по свойствам title, rich_text, number, date и по created_time/last_edited_time, а также сортировку
+    по свойствам и времени изменения, поэтому поиск последней записи, инкрементальная синхронизация зеркала
+    и поиск уже созданной записи очередью записи выполняются как в Notion. Без сортировки записи
+    отдаются от новых к старым, неподдерживаемый фильтр отклоняется ответом 400.
+    Задержка и ошибки (например 429) внедряются так же, как в StubNotionServer
+    """
+
+    def __init__(self, records_count: int = 30, **kwargs) -> None:
+        """
+        :param records_count: количество записей в каждой базе данных
+        """
+        super().__init__(**kwargs)
+        today = datetime.date(2023, 7, 1)
+        days = [today - datetime.timedelta(days=i) for i in range(records_count)]
+        self.databases: dict[str, dict] = {
+            WORKOUT_DATABASE_ID: {
+                'object': 'database',
+                'id': WORKOUT_DATABASE_ID,
+                'title': _title('Тренировка. Турник'),
+                'last_edited_time': TIMESTAMP,
+                'description': [{'type': 'text', 'plain_text': '1. Подтягивания\n2. Отжимания'}],
+                'properties': {
+                    **{'Дата': {'type': 'date'}, 'Название': {'type': 'title'}},
+                    **{f'{e}.{a}': {'type': 'number'} for e in (1, 2) for a in (1, 2, 3)},
+                },
+            },
+            RUN_DATABASE_ID: {
+                'object': 'database',
+                'id': RUN_DATABASE_ID,
+                'title': _title('Тренировка. Пробежка'),
+                'last_edited_time': TIMESTAMP,
+                'description': [],
+                'properties': {key: {'type': value['type']} for key, value in _run_record(today).items()},
+            },
+        }
+        self.records: dict[str, list[dict]] = {
+            WORKOUT_DATABASE_ID: [self.__page(WORKOUT_DATABASE_ID, _workout_record(day), self.__edited(day))
+                                  for day in days],
+            RUN_DATABASE_ID: [self.__page(RUN_DATABASE_ID, _run_record(day), self.__edited(day)) for day in days],
+        }
+        self.calls: Counter[str] = Counter()
+
+    @staticmethod
+    def __edited(day: datetime.date) -> str:
+        return _timestamp(datetime.datetime.combine(day, datetime.time(10), datetime.timezone.utc))
+
+    @staticmethod
+    def __page(database_id: str, properties: dict, edited: str | None = None) -> dict:
+        edited = edited if edited else _timestamp(datetime.datetime.now(datetime.timezone.utc))
+        return {
+            'object': 'page',
+            'id': str(uuid.uuid4()),
+            'created_time': edited,
+            'last_edited_time': edited,
+            'parent': {'type': 'database_id', 'database_id': database_id},
+            'properties': properties,
+        }
+
+    async def __call(self, request: web.Request) -> web.Response | None:
+        self.calls[f'{request.method} {endpoint_label(request.path)}'] += 1
+        return await self._delay_or_error()
+
+    async def _search(self, request: web.Request) -> web.Response:
+        error = await self.__call(request)
+        if error is not None:
+            return error
+        results = [{key: database[key] for key in ('object', 'id', 'title', 'last_edited_time')}
+                   for database in self.databases.values()]
+        return web.json_response({'object': 'list', 'results': results, 'has_more': False, 'next_cursor': None})
+
+    async def _database(self, request: web.Request) -> web.Response:
+        error = await self.__call(request)
+        if error is not None:
+            return error
+        database = self.databases.get(request.match_info['database_id'])
+        if database is None:
+            return web.json_response({'object': 'error', 'status': 404}, status=404)
+        return web.json_response(database)
+
+    async def _query(self, request: web.Request) -> web.Response:
+        error = await self.__call(request)
+        if error is not None:
+            return error
+        records = self.records.get(request.match_info['database_id'])
+        if records is None:
+            return web.json_response({'object': 'error', 'status': 404}, status=404)
+        body: dict = json.loads(await request.read() or b'{}') or {}
+        try:
+            if body.get('filter'):
+                records = [page for page in records if _matches(page, body['filter'])]
+            if body.get('sorts'):
+                records = _sort(records, body['sorts'])
+        except UnsupportedQueryError as exc:
+            return web.json_response({'object': 'error', 'status': 400, 'code': 'validation_error',
+                                      'message': str(exc)}, status=400)
+        start = int(body.get('start_cursor') or 0)
+        end = start + int(body.get('page_size') or 100)
+        has_more = end < len(records)
+        return web.json_response({'object': 'list', 'results': records[start:end],
+                                  'has_more': has_more, 'next_cursor': str(end) if has_more else None})
+
+    async def _create_page(self, request: web.Request) -> web.Response:
+        error = await self.__call(request)
+        if error is not None:
+            return error
+        body: dict = await request.json()
+        database_id = str(body['parent']['database_id'])
+        if database_id not in self.records:
+            return web.json_response({'object': 'error', 'status': 404}, status=404)
+        page = self.__page(database_id, body.get('properties', {}))
+        self.records[database_id].insert(0, page)
+        return web.json_response(page)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/search', self._search)
+        app.router.add_get('/v1/databases/{database_id}', self._database)
+        app.router.add_post('/v1/databases/{database_id}/query', self._query)
+        app.router.add_post('/v1/pages', self._create_page)
+        return app
@@ -0,0 +1,115 @@
+import itertools
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+from telebot import asyncio_helper
+
+
+BOT_USER = {'id': 100, 'is_bot': True, 'first_name': 'Bot', 'username': 'bench_bot'}
+
+
+class FakeTelegramServer:
+    """
+    Локальный fake Telegram Bot API: принимает вызовы методов бота, считает их и отвечает успешно.
+    Файлы из files отдаются через getFile и скачивание по file_path.
+
+    install() перенаправляет telebot на этот сервер через asyncio_helper.API_URL и FILE_URL
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.calls: Counter[str] = Counter()
+        self.files: dict[str, bytes] = {}
+        self.__message_ids = itertools.count(1_000_000)
+        self.__runner: web.AppRunner | None = None
+        self.__previous_api_url: str | None = None
+        self.__previous_file_url: str | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def __read_params(self, request: web.Request) -> dict:
+        # telebot передает параметры формой даже в GET запросах
+        params = dict(request.query)
+        if request.content_type == 'application/json':
+            params.update(await request.json())
+        elif request.content_type == 'application/x-www-form-urlencoded':
+            params.update(parse_qsl(await request.text()))
+        elif request.content_type.startswith('multipart/'):
+            params.update({key: value for key, value in (await request.post()).items() if isinstance(value, str)})
+        return params
+
+    def __message(self, params: dict) -> dict:
+        return {
+            'message_id': next(self.__message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method: str = request.match_info['method']
+        self.calls[method] += 1
+        params: dict = await self.__read_params(request)
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getFile':
+            file_id: str = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]),
+                      'file_path': f'documents/{file_id}'}
+        elif method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            result = True
+        elif method == 'sendPhoto':
+            # фото, отправленное по file_id, приходит строкой, загружаемое - файлом multipart формы
+            result = self.__message(params)
+            if 'photo' not in params:
+                self.calls['sendPhoto upload'] += 1
+            file_id: str = params.get('photo') or f'photo-{result["message_id"]}'
+            result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 960, 'height': 480}]
+        else:
+            result = self.__message(params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _download(self, request: web.Request) -> web.Response:
+        self.calls['download'] += 1
+        data: bytes | None = self.files.get(request.match_info['file_id'])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type='application/octet-stream')
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/file/bot{token}/documents/{file_id}', self._download)
+        app.router.add_route('*', '/bot{token}/{method}', self._handle)
+        return app
+
+    def install(self) -> None:
+        """
+        Направление запросов telebot на fake сервер
+        """
+        self.__previous_api_url = asyncio_helper.API_URL
+        self.__previous_file_url = asyncio_helper.FILE_URL
+        asyncio_helper.API_URL = f'{self.url}/bot{{0}}/{{1}}'
+        asyncio_helper.FILE_URL = f'{self.url}/file/bot{{0}}/{{1}}'
+
+    async def start(self) -> None:
+        self.__runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.install()
+
+    async def stop(self) -> None:
+        if self.__previous_api_url is not None:
+            asyncio_helper.API_URL = self.__previous_api_url
+            asyncio_helper.FILE_URL = self.__previous_file_url
+            self.__previous_api_url = None
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
@@ -0,0 +1,230 @@
+"""
+Сквозной нагрузочный тест бота: fake Notion API и fake Telegram Bot API поднимаются локально,
+синтетические обновления Telegram прогоняются через обработчики TelegramBot с заданной частотой.
+
+Отчет: p50/p95/p99 задержки обработки обновления, количество запросов к Notion на обновление
+(всего и по эндпоинтам), вызовы Telegram API (всего, на обновление и по методам) и пропускная способность.
+С --output отчет сохраняется в JSON, с --baseline сравнивается с сохраненным ранее отчетом,
+и при ухудшении больше чем на --tolerance скрипт завершается с кодом 1.
+
+Запуск из каталога app: python -m benchmarks.load_test --updates 500 --rate 50 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from dependency_injector import providers
+from telebot.types import Update
+
+from benchmarks.fake_notion import FakeNotionServer, WORKOUT_DATABASE_ID, RUN_DATABASE_ID
+from benchmarks.fake_telegram import FakeTelegramServer
+from common import RateLimitSettings, WriteQueueSettings
+from schemas.common_data import common_data_notion
+from services.container import ApplicationContainer
+from services.page_write_queue import PageWriteQueue
+from services.request_operator import RequestOperator
+
+
+USER = {'id': 1, 'is_bot': False, 'first_name': 'Test'}
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id, 'type': 'private'}, 'from': USER | {'id': chat_id}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': 'menu',
+               'chat': {'id': chat_id, 'type': 'private'}, 'from': USER | {'id': 100, 'is_bot': True}}
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'from': USER | {'id': chat_id}, 'chat_instance': str(chat_id),
+                               'message': message, 'data': data}}
+
+
+# шаги сценария одного чата: меню тренировок, выбор базы, возврат к списку баз, результаты турника и пробежки
+SCENARIO = (
+    lambda update_id, chat_id: message_update(update_id, chat_id, '🦾 Тренировки'),
+    lambda update_id, chat_id: callback_update(update_id, chat_id, f'database/{WORKOUT_DATABASE_ID}/operations'),
+    lambda update_id, chat_id: callback_update(update_id, chat_id, 'workouts'),
+    lambda update_id, chat_id: callback_update(update_id, chat_id, f'database/{WORKOUT_DATABASE_ID}/last_result'),
+    lambda update_id, chat_id: callback_update(update_id, chat_id, f'database/{RUN_DATABASE_ID}/last_result'),
+)
+
+
+def build_raw_updates(count: int, chats: int) -> list[dict]:
+    return [SCENARIO[(i // chats) % len(SCENARIO)](i + 1, i % chats + 1) for i in range(count)]
+
+
+def build_updates(count: int, chats: int) -> list[Update]:
+    return [Update.de_json(raw) for raw in build_raw_updates(count, chats)]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Подсчет ошибок обработчиков, которые telebot перехватывает и пишет в лог
+    """
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+
+
+async def run(args: argparse.Namespace) -> dict:
+    notion = FakeNotionServer(latency=args.latency, error_every=args.error_every, retry_after=args.retry_after,
+                              records_count=args.records)
+    telegram = FakeTelegramServer()
+    await notion.start()
+    await telegram.start()
+    common_data_notion.url_search = f'{notion.url}/v1/search'
+    common_data_notion.url_search_databases = f'{notion.url}/v1/databases'
+    common_data_notion.url_pages = f'{notion.url}/v1/pages'
+
+    container = ApplicationContainer()
+    container.request_operator.override(providers.Singleton(
+        RequestOperator, rate_limit=RateLimitSettings(requests_per_second=args.rps, burst=args.burst)))
+    journal = tempfile.TemporaryDirectory()
+    container.page_write_queue.override(providers.Singleton(
+        PageWriteQueue, request_operator=container.request_operator, settings=WriteQueueSettings(path=journal.name)))
+    telegram_bot = container.telegram_bot(token='1:load-test')
+    errors = ErrorCounter()
+    logging.getLogger('TeleBot').addHandler(errors)
+
+    updates: list[Update] = build_updates(args.updates, args.chats)
+    latencies: list[float] = []
+
+    async def process(update: Update, send_at: float) -> None:
+        delay = send_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        started_at = time.perf_counter()
+        await telegram_bot.bot.process_new_updates([update])
+        latencies.append(time.perf_counter() - started_at)
+
+    try:
+        start = time.perf_counter()
+        interval = 1 / args.rate if args.rate else 0.0
+        await asyncio.gather(*(process(update, start + i * interval) for i, update in enumerate(updates)))
+        elapsed = time.perf_counter() - start
+    finally:
+        logging.getLogger('TeleBot').removeHandler(errors)
+        await container.page_write_queue().close()
+        await container.request_operator().close()
+        await telegram_bot.bot.close_session()
+        await telegram.stop()
+        await notion.stop()
+        journal.cleanup()
+
+    notion_calls = sum(notion.calls.values())
+    # getMe вызывается один раз при создании бота и к обработке обновлений не относится
+    telegram_calls = sum(count for method, count in telegram.calls.items() if method != 'getMe')
+    return {
+        'updates': len(updates),
+        'duration': elapsed,
+        'throughput': len(updates) / elapsed,
+        'latency': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99), 'max': max(latencies, default=0.0)},
+        'notion_calls': notion_calls,
+        'notion_calls_per_update': notion_calls / len(updates),
+        'notion_calls_by_endpoint': dict(notion.calls),
+        'notion_injected_errors': notion.errors_count,
+        'notion_retries': container.request_operator().retries_count,
+        'telegram_calls': telegram_calls,
+        'telegram_calls_per_update': telegram_calls / len(updates),
+        'telegram_calls_by_method': dict(telegram.calls),
+        'handler_errors': errors.count,
+        'dispatcher': {lane: metrics.as_dict() for lane, metrics in container.update_dispatcher().metrics.items()},
+    }
+
+
+def print_report(report: dict) -> None:
+    latency = report['latency']
+    print(f'updates {report["updates"]} in {report["duration"]:.2f} s, throughput {report["throughput"]:.1f} upd/s')
+    print(f'latency p50 {latency["p50"] * 1000:.1f} ms, p95 {latency["p95"] * 1000:.1f} ms, '
+          f'p99 {latency["p99"] * 1000:.1f} ms, max {latency["max"] * 1000:.1f} ms')
+    print(f'notion calls {report["notion_calls"]} ({report["notion_calls_per_update"]:.2f} per update), '
+          f'injected errors {report["notion_injected_errors"]}, retries {report["notion_retries"]}')
+    for endpoint, count in sorted(report['notion_calls_by_endpoint'].items()):
+        print(f'  {endpoint}: {count}')
+    print(f'telegram calls {report["telegram_calls"]} ({report["telegram_calls_per_update"]:.2f} per update), '
+          f'handler errors {report["handler_errors"]}')
+    for method, count in sorted(report['telegram_calls_by_method'].items()):
+        print(f'  {method}: {count}')
+    for lane, metrics in report['dispatcher'].items():
+        print(f'  {lane}: dispatched {metrics["dispatched"]}, deduplicated {metrics["deduplicated"]}, '
+              f'max queue delay {metrics["max_queue_delay"] * 1000:.1f} ms')
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Сравнение отчета с базовым
+
+    :param report: текущий отчет
+    :param baseline: базовый отчет
+    :param tolerance: допустимое относительное ухудшение
+    :return: список ухудшившихся показателей
+    """
+    # показатель, его значения и направление: True - больше лучше
+    checks = (
+        ('latency p95', report['latency']['p95'], baseline['latency']['p95'], False),
+        ('latency p99', report['latency']['p99'], baseline['latency']['p99'], False),
+        ('notion calls per update', report['notion_calls_per_update'], baseline['notion_calls_per_update'], False),
+        ('telegram calls per update', report['telegram_calls_per_update'],
+         baseline.get('telegram_calls_per_update'), False),
+        ('throughput', report['throughput'], baseline['throughput'], True),
+    )
+    regressions: list[str] = []
+    for name, value, base, higher_is_better in checks:
+        if base is None:
+            # показателя нет в отчете, сохраненном более ранней версией теста
+            continue
+        worse = value < base * (1 - tolerance) if higher_is_better else value > base * (1 + tolerance)
+        if worse:
+            regressions.append(f'{name}: {base:.4f} -> {value:.4f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--rate', type=float, default=100.0, help='обновлений в секунду, 0 - все сразу')
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа fake Notion, с')
+    parser.add_argument('--error-every', type=int, default=0, help='каждый N-й ответ Notion - ошибка 429')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--records', type=int, default=30, help='записей в каждой базе fake Notion')
+    parser.add_argument('--rps', type=float, default=3.0, help='ограничение частоты запросов к Notion')
+    parser.add_argument('--burst', type=int, default=3)
+    parser.add_argument('--output', type=Path, default=None, help='файл для сохранения отчета в JSON')
+    parser.add_argument('--baseline', type=Path, default=None, help='отчет в JSON для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
+    result: dict = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding='utf-8')
+    if args.baseline:
+        found = compare(result, json.loads(args.baseline.read_text(encoding='utf-8')), args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}')
+        sys.exit(1 if found else 0)
@@ -0,0 +1,55 @@
+"""
+Сравнение способов извлечения полей со скриншотов: разбор строк текста (text),
+извлечение по рамкам слов без шаблона (layout cold) и по сохраненному шаблону расположения (layout warm).
+
+Фикстуры в том же формате, что и для ocr_preprocess_benchmark: скриншоты и expected.json.
+
+Запуск из каталога app: python -m benchmarks.ocr_fields_benchmark --fixtures <каталог>
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Callable
+
+from benchmarks.ocr_preprocess_benchmark import field_accuracy
+from services.database_operator import DatabaseRunOperator
+from services.image_operator import ImageOperator
+from services.request_operator import RequestOperator
+
+
+def measure(name: str, extract: Callable[[bytes], dict], images: dict[str, bytes], expected: dict[str, dict]) -> None:
+    elapsed = 0.0
+    matched_total, fields_total = 0, 0
+    for image_name, image_bytes in images.items():
+        start = time.perf_counter()
+        fields = extract(image_bytes)
+        elapsed += time.perf_counter() - start
+        matched, total = field_accuracy(expected[image_name], fields)
+        matched_total += matched
+        fields_total += total
+    print(f'{name:>12}: {elapsed / len(images) * 1000:.0f} ms per image, '
+          f'accuracy {matched_total}/{fields_total} ({matched_total / max(fields_total, 1):.0%})')
+
+
+def main(fixtures: Path) -> None:
+    expected: dict[str, dict] = json.loads((fixtures / 'expected.json').read_text(encoding='utf-8'))
+    images: dict[str, bytes] = {name: (fixtures / name).read_bytes() for name in expected}
+    run_operator = DatabaseRunOperator(request_operator=RequestOperator())
+    image_operator = ImageOperator()
+
+    measure('text', lambda image: run_operator.convert_image_str_to_data(image_operator.parse_image_to_string(image)),
+            images, expected)
+    measure('layout cold', lambda image: image_operator.parse_image_to_fields(image, use_layouts=False),
+            images, expected)
+    # первый проход заполняет кэш шаблонов, второй распознает только области значений
+    for image_bytes in images.values():
+        image_operator.parse_image_to_fields(image_bytes)
+    measure('layout warm', image_operator.parse_image_to_fields, images, expected)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', type=Path, required=True)
+    args = parser.parse_args()
+    main(args.fixtures)
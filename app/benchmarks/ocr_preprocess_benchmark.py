@@ -0,0 +1,54 @@
+"""
+Сравнение режимов предварительной обработки скриншотов: время распознавания и точность извлечения полей.
+
+Каталог с фикстурами содержит скриншоты (*.jpg, *.jpeg, *.png) и файл expected.json вида
+{"<имя файла>": {"<поле>": "<значение>", ...}, ...} с ожидаемым результатом
+DatabaseRunOperator.convert_image_str_to_data.
+
+Запуск из каталога app: python -m benchmarks.ocr_preprocess_benchmark --fixtures <каталог>
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+from common import preprocess_settings
+from services.database_operator import DatabaseRunOperator
+from services.image_operator import ImageOperator
+from services.image_preprocessor import PREPROCESS_MODES
+from services.request_operator import RequestOperator
+
+
+def field_accuracy(expected: dict, actual: dict) -> tuple[int, int]:
+    matched = sum(1 for key, value in expected.items() if actual.get(key) == value)
+    return matched, len(expected)
+
+
+def main(fixtures: Path, modes: list[str], target_width: int) -> None:
+    expected: dict[str, dict] = json.loads((fixtures / 'expected.json').read_text(encoding='utf-8'))
+    images: dict[str, bytes] = {name: (fixtures / name).read_bytes() for name in expected}
+    run_operator = DatabaseRunOperator(request_operator=RequestOperator())
+
+    for mode in modes:
+        image_operator = ImageOperator(preprocess=preprocess_settings.model_copy(
+            update={'mode': mode, 'target_width': target_width}))
+        elapsed = 0.0
+        matched_total, fields_total = 0, 0
+        for name, image_bytes in images.items():
+            start = time.perf_counter()
+            text = image_operator.parse_image_to_string(image_bytes)
+            elapsed += time.perf_counter() - start
+            matched, fields = field_accuracy(expected[name], run_operator.convert_image_str_to_data(text))
+            matched_total += matched
+            fields_total += fields
+        print(f'{mode:>7}: {elapsed / len(images) * 1000:.0f} ms per image, '
+              f'accuracy {matched_total}/{fields_total} ({matched_total / max(fields_total, 1):.0%})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', type=Path, required=True)
+    parser.add_argument('--modes', nargs='+', default=list(PREPROCESS_MODES), choices=PREPROCESS_MODES)
+    parser.add_argument('--target-width', type=int, default=preprocess_settings.target_width)
+    args = parser.parse_args()
+    main(args.fixtures, args.modes, args.target_width)
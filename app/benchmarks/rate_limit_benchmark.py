@@ -0,0 +1,44 @@
+"""
+Проверка планировщика запросов RequestOperator против stub-сервера, отвечающего 429.
+
+Запуск из каталога app: python -m benchmarks.rate_limit_benchmark
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.stub_server import StubNotionServer
+from common import RateLimitSettings
+from services.request_operator import RequestOperator
+
+
+async def main(requests: int, rate: float, error_every: int, retry_after: float) -> None:
+    server = StubNotionServer(error_every=error_every, retry_after=retry_after)
+    await server.start()
+    request_operator = RequestOperator(rate_limit=RateLimitSettings(requests_per_second=rate, burst=int(rate)))
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(request_operator.post_request_response_data(url=f'{server.url}/v1/pages', headers={}, data={})
+              for _ in range(requests)),
+            return_exceptions=True
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        await request_operator.close()
+        await server.stop()
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    print(f'requests: {requests}, failed: {len(failed)}, server 429: {server.errors_count}, '
+          f'server calls: {server.requests_count}, elapsed: {elapsed:.2f} s')
+    print(f'scheduler metrics: {request_operator.metrics}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--rate', type=float, default=3.0)
+    parser.add_argument('--error-every', type=int, default=5)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.rate, args.error_every, args.retry_after))
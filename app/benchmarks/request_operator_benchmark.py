@@ -0,0 +1,68 @@
+"""
+Сравнение задержки и пропускной способности RequestOperator:
+новая сессия aiohttp на каждый запрос против общей сессии с пулом соединений.
+
+Запуск из каталога app: python -m benchmarks.request_operator_benchmark
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import aiohttp
+
+from benchmarks.stub_server import StubNotionServer
+from common import RateLimitSettings
+from services.request_operator import RequestOperator
+
+
+async def post_with_new_session(url: str, headers: dict, data: dict | None = None) -> dict:
+    # поведение RequestOperator до перехода на общую сессию
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url=url, data=json.dumps(data), headers=headers) as resp:
+            return await resp.json()
+
+
+async def measure(name: str, call, url: str, requests: int, concurrency: int) -> None:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await call(url=url, headers={'Content-Type': 'application/json'}, data={})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'{name:>14}: mean {statistics.mean(latencies) * 1000:.2f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.2f} ms, '
+          f'throughput {requests / elapsed:.1f} req/s')
+
+
+async def main(requests: int, concurrency: int, latency: float) -> None:
+    server = StubNotionServer(latency=latency)
+    await server.start()
+    url = f'{server.url}/v1/search'
+    try:
+        await measure('new session', post_with_new_session, url, requests, concurrency)
+        # ограничитель частоты отключен, чтобы измерять только транспорт
+        request_operator = RequestOperator(rate_limit=RateLimitSettings(requests_per_second=1e9, burst=requests))
+        try:
+            await measure('pooled session', request_operator.post_request_response_data, url, requests, concurrency)
+        finally:
+            await request_operator.close()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа stub-сервера, с')
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.latency))
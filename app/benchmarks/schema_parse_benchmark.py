@@ -0,0 +1,93 @@
+"""
+Сравнение разбора ответов Notion: json.loads + полные модели против сокращенных моделей из байтов JSON.
+
+Без --search/--query используются синтетические ответы в формате Notion разного размера.
+
+Запуск из каталога app: python -m benchmarks.schema_parse_benchmark
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+from typing import Callable
+
+from schemas.database import Database, DatabaseSearchResponse
+from schemas.entry_database import EntryDB, EntryQueryResponse
+
+
+def make_user() -> dict:
+    return {'object': 'user', 'id': str(uuid.uuid4())}
+
+
+def make_search_payload(databases: int, properties: int) -> bytes:
+    return json.dumps({'object': 'list', 'has_more': False, 'next_cursor': None, 'results': [{
+        'object': 'database',
+        'id': str(uuid.uuid4()),
+        'created_by': make_user(),
+        'last_edited_by': make_user(),
+        'created_time': '2023-07-01T10:00:00.000Z',
+        'last_edited_time': '2023-07-02T10:00:00.000Z',
+        'title': [{'type': 'text', 'plain_text': f'Тренировка. Турник {i}', 'text': {'content': 'x'}}],
+        'description': [{'type': 'text', 'plain_text': '1. Подтягивания\n2. Отжимания'}],
+        'properties': {f'{p // 9 + 1}.{p % 9 + 1}': {'id': str(p), 'name': str(p), 'type': 'number',
+                                                     'number': {'format': 'number'}} for p in range(properties)},
+        'parent': {'type': 'page_id', 'page_id': str(uuid.uuid4())},
+        'url': 'https://www.notion.so/x',
+        'archived': False,
+    } for i in range(databases)]}).encode()
+
+
+def make_query_payload(pages: int, properties: int) -> bytes:
+    return json.dumps({'object': 'list', 'has_more': False, 'next_cursor': None, 'results': [{
+        'object': 'page',
+        'id': str(uuid.uuid4()),
+        'created_by': make_user(),
+        'last_edited_by': make_user(),
+        'created_time': '2023-07-01T10:00:00.000Z',
+        'last_edited_time': '2023-07-02T10:00:00.000Z',
+        'parent': {'type': 'database_id', 'database_id': str(uuid.uuid4())},
+        'properties': {f'{p // 9 + 1}.{p % 9 + 1}': {'id': str(p), 'type': 'number', 'number': p}
+                       for p in range(properties)},
+        'url': 'https://www.notion.so/x',
+        'archived': False,
+    } for _ in range(pages)]}).encode()
+
+
+def measure(name: str, parse: Callable[[bytes], object], payload: bytes, repeat: int) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(payload)
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    result = parse(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print(f'    {name:>28}: {elapsed * 1000:8.3f} ms, peak memory {peak / 1024:8.1f} KiB')
+
+
+def run(payloads: dict[str, tuple[bytes, bytes]], repeat: int) -> None:
+    for title, (search, query) in payloads.items():
+        print(f'{title} (search {len(search) / 1024:.0f} KiB, query {len(query) / 1024:.0f} KiB)')
+        measure('search: dict + Database', lambda data: [Database.model_validate(db)
+                                                         for db in json.loads(data)['results']], search, repeat)
+        measure('search: DatabaseSearchResponse', DatabaseSearchResponse.model_validate_json, search, repeat)
+        measure('query: dict + EntryDB', lambda data: [EntryDB.model_validate(page)
+                                                       for page in json.loads(data)['results']], query, repeat)
+        measure('query: EntryQueryResponse', EntryQueryResponse.model_validate_json, query, repeat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--search', type=Path, default=None, help='записанный ответ /v1/search')
+    parser.add_argument('--query', type=Path, default=None, help='записанный ответ /v1/databases/{id}/query')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    if args.search and args.query:
+        payloads = {'captured': (args.search.read_bytes(), args.query.read_bytes())}
+    else:
+        payloads = {f'{size} objects': (make_search_payload(size, 30), make_query_payload(size, 30))
+                    for size in (1, 10, 100)}
+    run(payloads, args.repeat)
@@ -0,0 +1,114 @@
+"""
+Пропускная способность бота при обработке обновлений в нескольких процессах.
+
+Fake Notion API и fake Telegram Bot API поднимаются локально, синтетические обновления сценария
+нагрузочного теста передаются ShardSupervisor с 1, 2, ... N процессами-обработчиками.
+Ограничение частоты запросов к Notion общее для процессов через SQLite во временном каталоге.
+
+Отчет: время, пропускная способность и ускорение относительно первого количества процессов,
+запросы к Notion на обновление.
+
+Запуск из каталога app: python -m benchmarks.shard_benchmark --workers 1 2 4 --updates 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.fake_notion import FakeNotionServer
+from benchmarks.fake_telegram import FakeTelegramServer
+from benchmarks.load_test import build_raw_updates
+from common import coordination_settings, ShardSettings
+from services.shard_supervisor import ShardSupervisor
+
+
+def _install_fakes(notion_url: str, telegram_url: str, journal_path: str, rps: float, burst: int,
+                   log_level: str) -> None:
+    """
+    Настройка процесса-обработчика на fake серверы, вызывается в каждом процессе до создания сервисов
+    """
+    logging.getLogger().setLevel(log_level)
+    from telebot import asyncio_helper
+
+    from common import ocr_settings, rate_limit_settings, write_queue_settings
+    from schemas.common_data import common_data_notion
+
+    common_data_notion.url_search = f'{notion_url}/v1/search'
+    common_data_notion.url_search_databases = f'{notion_url}/v1/databases'
+    common_data_notion.url_pages = f'{notion_url}/v1/pages'
+    asyncio_helper.API_URL = f'{telegram_url}/bot{{0}}/{{1}}'
+    asyncio_helper.FILE_URL = f'{telegram_url}/file/bot{{0}}/{{1}}'
+    write_queue_settings.path = journal_path
+    rate_limit_settings.requests_per_second = rps
+    rate_limit_settings.burst = burst
+    # сценарий не распознает скриншоты, пул распознавания не запускается
+    ocr_settings.warm_up = False
+
+
+async def run_workers(workers: int, raw_updates: list[dict], notion: FakeNotionServer, telegram: FakeTelegramServer,
+                      args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        coordination_settings.backend = f'sqlite:///{directory}/coordination.sqlite3'
+        supervisor = ShardSupervisor(
+            token='1:shard-benchmark',
+            settings=ShardSettings(workers=workers, queue_size=args.queue_size, concurrency=args.concurrency),
+            worker_init=_install_fakes,
+            worker_init_args=(notion.url, telegram.url, f'{directory}/write_queue', args.rps, args.burst,
+                              args.log_level)
+        )
+        notion_calls_before = sum(notion.calls.values())
+        try:
+            await supervisor.start()
+            start = time.perf_counter()
+            for raw in raw_updates:
+                await supervisor.submit(raw)
+            while supervisor.processed < len(raw_updates):
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - start
+        finally:
+            await supervisor.drain()
+    notion_calls = sum(notion.calls.values()) - notion_calls_before
+    return {'workers': workers, 'duration': elapsed, 'throughput': len(raw_updates) / elapsed,
+            'notion_calls_per_update': notion_calls / len(raw_updates)}
+
+
+async def main(args: argparse.Namespace) -> None:
+    notion = FakeNotionServer(latency=args.latency, records_count=args.records)
+    telegram = FakeTelegramServer()
+    await notion.start()
+    await telegram.start()
+    raw_updates: list[dict] = build_raw_updates(args.updates, args.chats)
+    reports: list[dict] = []
+    try:
+        for workers in args.workers:
+            reports.append(await run_workers(workers, raw_updates, notion, telegram, args))
+    finally:
+        await telegram.stop()
+        await notion.stop()
+
+    base: float = reports[0]['throughput']
+    print(f'cpu count {os.cpu_count()}')
+    for report in reports:
+        print(f'workers {report["workers"]}: {args.updates} updates in {report["duration"]:.2f} s, '
+              f'throughput {report["throughput"]:.1f} upd/s, speedup {report["throughput"] / base:.2f}x, '
+              f'notion calls per update {report["notion_calls_per_update"]:.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.005, help='задержка ответа fake Notion, с')
+    parser.add_argument('--records', type=int, default=30, help='записей в каждой базе fake Notion')
+    parser.add_argument('--rps', type=float, default=1000.0, help='общее ограничение частоты запросов к Notion')
+    parser.add_argument('--burst', type=int, default=100)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
+    asyncio.run(main(args))
@@ -0,0 +1,59 @@
+"""
+Время запуска и память процесса бота: импорт сервисов и создание TelegramBot через контейнер.
+
+Каждый замер выполняется в новом интерпретаторе. С --eager библиотеки распознавания (cv2, numpy, pytesseract)
+импортируются заранее, как до перехода на ленивый импорт, для сравнения.
+
+Запуск из каталога app: python -m benchmarks.startup_benchmark
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+HEAVY_MODULES = ('cv2', 'numpy', 'pytesseract', 'PIL')
+
+PROBE = """
+import json, resource, sys, time
+started_at = time.perf_counter()
+if {eager}:
+    import cv2, numpy, pytesseract
+import services.container
+imported_at = time.perf_counter()
+services.container.ApplicationContainer().telegram_bot(token='1:startup-benchmark')
+created_at = time.perf_counter()
+print(json.dumps({{
+    'import': imported_at - started_at,
+    'create': created_at - imported_at,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'loaded': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def probe(eager: bool) -> dict:
+    code = PROBE.format(eager=eager, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).resolve().parents[1],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(name: str, eager: bool, runs: int) -> None:
+    results = [probe(eager) for _ in range(runs)]
+    print(f'{name:>6}: import {statistics.median(r["import"] for r in results) * 1000:.0f} ms, '
+          f'container {statistics.median(r["create"] for r in results) * 1000:.0f} ms, '
+          f'max RSS {statistics.median(r["max_rss_kb"] for r in results) / 1024:.1f} MiB, '
+          f'loaded {results[-1]["loaded"]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--eager', action='store_true', help='сравнить с заранее импортированными библиотеками')
+    args = parser.parse_args()
+    measure('lazy', False, args.runs)
+    if args.eager:
+        measure('eager', True, args.runs)
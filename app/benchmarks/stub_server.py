@@ -0,0 +1,109 @@
+"""
+Stub-сервер Notion API с задержкой ответа и ошибками для бенчмарков.
+
+Проверка доли ошибок при параллельных запросах из каталога app: python -m benchmarks.stub_server
+"""
+import argparse
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+
+class StubNotionServer:
+    """
+    Локальный stub-сервер Notion API для бенчмарков
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 error_every: int = 0, error_status: int = 429, retry_after: float | None = 1.0) -> None:
+        """
+        :param latency: задержка ответа, с
+        :param error_every: каждый error_every-й запрос завершается ошибкой, 0 - без ошибок
+        :param error_status: статус ошибочного ответа
+        :param retry_after: значение заголовка Retry-After для ответов 429
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_every = error_every
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.requests_count = 0
+        self.errors_count = 0
+        self.__runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def _delay_or_error(self) -> web.Response | None:
+        """
+        Задержка ответа и внедрение ошибок
+
+        :return: ответ с ошибкой или None, если запрос нужно обработать
+        """
+        # номер запроса фиксируется до ожидания: за время задержки счетчик увеличат параллельные запросы
+        self.requests_count += 1
+        index = self.requests_count
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_every and index % self.error_every == 0:
+            self.errors_count += 1
+            headers = {'Retry-After': str(self.retry_after)} \
+                if self.error_status == 429 and self.retry_after is not None else None
+            return web.json_response({'object': 'error', 'status': self.error_status},
+                                     status=self.error_status, headers=headers)
+        return None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        error = await self._delay_or_error()
+        if error is not None:
+            return error
+        return web.json_response({'object': 'list', 'results': [], 'has_more': False, 'next_cursor': None})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self._handle)
+        return app
+
+    async def start(self) -> None:
+        self.__runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+
+async def check_error_rate(calls: int, error_every: int, latency: float) -> None:
+    """
+    Проверка доли ошибок при параллельных запросах: ошибкой завершается ровно каждый error_every-й запрос
+    """
+    server = StubNotionServer(latency=latency, error_every=error_every)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def call() -> int:
+                async with session.post(f'{server.url}/v1/search') as response:
+                    return response.status
+            statuses: list[int] = await asyncio.gather(*(call() for _ in range(calls)))
+    finally:
+        await server.stop()
+    errors = sum(status == 429 for status in statuses)
+    assert errors == server.errors_count == calls // error_every, (errors, server.errors_count, calls)
+    print(f'{calls} concurrent calls, latency {latency} s: {errors} errors, expected {calls // error_every}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=85)
+    parser.add_argument('--error-every', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    asyncio.run(check_error_rate(args.calls, args.error_every, args.latency))
@@ -0,0 +1,80 @@
+"""
+Отправка записанных обновлений Telegram (JSON) в webhook сервер.
+
+Без --url поднимается локальный WebhookServer с ботом, который только считает обработанные обновления.
+Файл обновлений содержит одно обновление или список обновлений в формате Telegram Bot API.
+
+Запуск из каталога app: python -m benchmarks.webhook_replay --updates <файл.json>
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import aiohttp
+from telebot.async_telebot import AsyncTeleBot
+
+from common import BotSettings
+from services.webhook_server import WebhookServer, SECRET_TOKEN_HEADER
+
+
+SAMPLE_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 1690000000,
+        'chat': {'id': 1, 'type': 'private', 'first_name': 'Test'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+        'text': '👋 Поздороваться'
+    }
+}
+
+
+async def post_updates(url: str, updates: list[dict], secret: str | None) -> list[int]:
+    headers = {SECRET_TOKEN_HEADER: secret} if secret else {}
+    async with aiohttp.ClientSession() as session:
+        async def post(update: dict) -> int:
+            async with session.post(url, json=update, headers=headers) as resp:
+                return resp.status
+        return await asyncio.gather(*(post(update) for update in updates))
+
+
+async def main(url: str | None, updates: list[dict], repeat: int, secret: str | None) -> None:
+    updates = [update | {'update_id': i} for i in range(repeat) for update in updates]
+    if url:
+        statuses = await post_updates(url, updates, secret)
+        print(f'posted {len(statuses)} updates, statuses: { {s: statuses.count(s) for s in set(statuses)} }')
+        return
+
+    bot = AsyncTeleBot(token='0:test')
+    processed: list[int] = []
+
+    @bot.message_handler(func=lambda message: True)
+    async def count(message):
+        processed.append(message.message_id)
+
+    settings = BotSettings(webhook_host='127.0.0.1', webhook_port=8089, webhook_secret_token=secret)
+    server = WebhookServer(bot=bot, settings=settings)
+    await server.start()
+    try:
+        start = time.perf_counter()
+        statuses = await post_updates(f'http://127.0.0.1:8089{settings.webhook_path}', updates, secret)
+        acked = time.perf_counter() - start
+        await server.queue.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        await server.stop()
+    print(f'posted {len(statuses)} updates, statuses: { {s: statuses.count(s) for s in set(statuses)} }, '
+          f'acked in {acked:.3f} s, processed {len(processed)} in {elapsed:.3f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=None, help='адрес запущенного webhook сервера')
+    parser.add_argument('--updates', type=Path, default=None, help='файл с записанными обновлениями')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--secret', default=None)
+    args = parser.parse_args()
+    loaded = json.loads(args.updates.read_text(encoding='utf-8')) if args.updates else SAMPLE_UPDATE
+    asyncio.run(main(args.url, loaded if isinstance(loaded, list) else [loaded], args.repeat, args.secret))
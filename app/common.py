@@ -16,10 +16,153 @@ logger.addHandler(console_handler)
 class CredsNotionAPI(BaseSettings):
     search_path: str = Field('https://api.notion.com/v1/search', env='SEARCH_PATH_NOTION')
     search_databases_path: str = Field('https://api.notion.com/v1/databases', env='SEARCH_DATABASES_PATH_NOTION')
+    pages_path: str = Field('https://api.notion.com/v1/pages', env='PAGES_PATH_NOTION')
     authorization_header: str = Field('Bearer secret_TRXbcIjGWyXkKJdXjEj2jF06e03ZidnpWhkHSMdo3zE',
                                       env='AUTHORIZATION_HEADER_NOTION')
     version: str = Field('2021-08-16', env='VERSION_NOTION')
     bot_token: str = Field('6308344660:AAGf_frIZ4AKW3gPDN8dVMNdpZ_cJUknq5w', env='BOT_TOKEN')
 
 
+class HttpClientSettings(BaseSettings):
+    connections_limit: int = Field(100, env='HTTP_CONNECTIONS_LIMIT')
+    connections_limit_per_host: int = Field(10, env='HTTP_CONNECTIONS_LIMIT_PER_HOST')
+    dns_cache_ttl: int = Field(300, env='HTTP_DNS_CACHE_TTL')
+    keepalive_timeout: float = Field(30.0, env='HTTP_KEEPALIVE_TIMEOUT')
+    total_timeout: float = Field(30.0, env='HTTP_TOTAL_TIMEOUT')
+    connect_timeout: float = Field(10.0, env='HTTP_CONNECT_TIMEOUT')
+    read_timeout: float = Field(20.0, env='HTTP_READ_TIMEOUT')
+
+
+class RateLimitSettings(BaseSettings):
+    requests_per_second: float = Field(3.0, env='NOTION_REQUESTS_PER_SECOND')
+    burst: int = Field(3, env='NOTION_REQUESTS_BURST')
+    max_retries: int = Field(5, env='NOTION_MAX_RETRIES')
+    backoff_base: float = Field(0.5, env='NOTION_BACKOFF_BASE')
+    backoff_max: float = Field(30.0, env='NOTION_BACKOFF_MAX')
+
+
+class OcrSettings(BaseSettings):
+    workers: int = Field(2, env='OCR_WORKERS')
+    max_pending: int = Field(8, env='OCR_MAX_PENDING')
+    timeout: float = Field(60.0, env='OCR_TIMEOUT')
+    lang: str = Field('rus', env='OCR_LANG')
+    warm_up: bool = Field(True, env='OCR_WARM_UP')
+    engine: str = Field('text', env='OCR_ENGINE')
+    max_layouts: int = Field(32, env='OCR_MAX_LAYOUTS')
+    # зависших задач, после которых пул процессов перезапускается, None - по количеству процессов
+    max_hung_jobs: int | None = Field(None, env='OCR_MAX_HUNG_JOBS')
+
+
+class PreprocessSettings(BaseSettings):
+    mode: str = Field('thresh', env='OCR_PREPROCESS_MODE')
+    target_width: int = Field(1080, env='OCR_PREPROCESS_TARGET_WIDTH')
+    roi_top: float = Field(0.0, env='OCR_PREPROCESS_ROI_TOP')
+    roi_bottom: float = Field(1.0, env='OCR_PREPROCESS_ROI_BOTTOM')
+    roi_left: float = Field(0.0, env='OCR_PREPROCESS_ROI_LEFT')
+    roi_right: float = Field(1.0, env='OCR_PREPROCESS_ROI_RIGHT')
+    max_pixels: int = Field(50_000_000, env='OCR_PREPROCESS_MAX_PIXELS')
+
+
+class UploadSettings(BaseSettings):
+    max_file_size: int = Field(10 * 1024 * 1024, env='UPLOAD_MAX_FILE_SIZE')
+    spool_max_memory: int = Field(1024 * 1024, env='UPLOAD_SPOOL_MAX_MEMORY')
+    chunk_size: int = Field(64 * 1024, env='UPLOAD_CHUNK_SIZE')
+    max_concurrent_files: int = Field(4, env='UPLOAD_MAX_CONCURRENT_FILES')
+
+
+class CacheSettings(BaseSettings):
+    databases_ttl: float = Field(300.0, env='CACHE_DATABASES_TTL')
+    databases_stale_ttl: float = Field(3600.0, env='CACHE_DATABASES_STALE_TTL')
+    # минимальный возраст списка баз данных, после которого неизвестный id запрашивает список заново
+    databases_refetch_interval: float = Field(30.0, env='CACHE_DATABASES_REFETCH_INTERVAL')
+    ocr_max_entries: int = Field(256, env='CACHE_OCR_MAX_ENTRIES')
+    ocr_disk_path: str | None = Field(None, env='CACHE_OCR_DISK_PATH')
+    stats_ttl: float = Field(60.0, env='CACHE_STATS_TTL')
+
+
+class ChartSettings(BaseSettings):
+    workers: int = Field(1, env='CHART_WORKERS')
+    width: int = Field(960, env='CHART_WIDTH')
+    height: int = Field(480, env='CHART_HEIGHT')
+    timeout: float = Field(30.0, env='CHART_TIMEOUT')
+    max_cached: int = Field(256, env='CHART_MAX_CACHED')
+
+
+class BotSettings(BaseSettings):
+    mode: str = Field('polling', env='BOT_MODE')
+    webhook_url: str | None = Field(None, env='BOT_WEBHOOK_URL')
+    webhook_host: str = Field('0.0.0.0', env='BOT_WEBHOOK_HOST')
+    webhook_port: int = Field(8080, env='BOT_WEBHOOK_PORT')
+    webhook_path: str = Field('/telegram/webhook', env='BOT_WEBHOOK_PATH')
+    webhook_secret_token: str | None = Field(None, env='BOT_WEBHOOK_SECRET_TOKEN')
+    webhook_queue_size: int = Field(1000, env='BOT_WEBHOOK_QUEUE_SIZE')
+    webhook_workers: int = Field(8, env='BOT_WEBHOOK_WORKERS')
+    media_group_debounce: float = Field(1.0, env='BOT_MEDIA_GROUP_DEBOUNCE')
+    media_group_max_size: int = Field(10, env='BOT_MEDIA_GROUP_MAX_SIZE')
+    keyboards_max_cached: int = Field(256, env='BOT_KEYBOARDS_MAX_CACHED')
+
+
+class MirrorSettings(BaseSettings):
+    enabled: bool = Field(False, env='MIRROR_ENABLED')
+    path: str = Field('notion_mirror.sqlite3', env='MIRROR_PATH')
+    sync_interval: float = Field(300.0, env='MIRROR_SYNC_INTERVAL')
+
+
+class WriteQueueSettings(BaseSettings):
+    path: str = Field('write_queue', env='WRITE_QUEUE_PATH')
+    idempotency_property: str | None = Field(None, env='WRITE_QUEUE_IDEMPOTENCY_PROPERTY')
+    retry_delay: float = Field(5.0, env='WRITE_QUEUE_RETRY_DELAY')
+    retry_delay_max: float = Field(300.0, env='WRITE_QUEUE_RETRY_DELAY_MAX')
+
+
+class DispatcherSettings(BaseSettings):
+    interactive_concurrency: int = Field(32, env='DISPATCHER_INTERACTIVE_CONCURRENCY')
+    heavy_concurrency: int = Field(4, env='DISPATCHER_HEAVY_CONCURRENCY')
+
+
+class TenantSettings(BaseSettings):
+    enabled: bool = Field(False, env='TENANTS_ENABLED')
+    store_path: str = Field('tenants.sqlite3', env='TENANTS_STORE_PATH')
+    encryption_key: str | None = Field(None, env='TENANTS_ENCRYPTION_KEY')
+    max_active: int = Field(100, env='TENANTS_MAX_ACTIVE')
+    idle_ttl: float = Field(1800.0, env='TENANTS_IDLE_TTL')
+    connections_limit: int = Field(4, env='TENANTS_CONNECTIONS_LIMIT')
+
+
+class CoordinationSettings(BaseSettings):
+    backend: str | None = Field(None, env='COORDINATION_BACKEND')
+    cache_ttl: float = Field(86400.0, env='COORDINATION_CACHE_TTL')
+
+
+class ShardSettings(BaseSettings):
+    workers: int = Field(1, env='SHARD_WORKERS')
+    queue_size: int = Field(1000, env='SHARD_QUEUE_SIZE')
+    concurrency: int = Field(64, env='SHARD_CONCURRENCY')
+    ocr_workers: int | None = Field(None, env='SHARD_OCR_WORKERS')
+    start_timeout: float = Field(60.0, env='SHARD_START_TIMEOUT')
+    drain_timeout: float = Field(30.0, env='SHARD_DRAIN_TIMEOUT')
+
+
+class MetricsSettings(BaseSettings):
+    enabled: bool = Field(False, env='METRICS_ENABLED')
+    host: str = Field('127.0.0.1', env='METRICS_HOST')
+    # при работе в нескольких процессах процесс-обработчик N отдает метрики на порту port + 1 + N
+    port: int = Field(9100, env='METRICS_PORT')
+
+
 creds_notion_api: CredsNotionAPI = CredsNotionAPI()
+bot_settings: BotSettings = BotSettings()
+http_client_settings: HttpClientSettings = HttpClientSettings()
+rate_limit_settings: RateLimitSettings = RateLimitSettings()
+ocr_settings: OcrSettings = OcrSettings()
+preprocess_settings: PreprocessSettings = PreprocessSettings()
+upload_settings: UploadSettings = UploadSettings()
+cache_settings: CacheSettings = CacheSettings()
+chart_settings: ChartSettings = ChartSettings()
+mirror_settings: MirrorSettings = MirrorSettings()
+write_queue_settings: WriteQueueSettings = WriteQueueSettings()
+dispatcher_settings: DispatcherSettings = DispatcherSettings()
+tenant_settings: TenantSettings = TenantSettings()
+coordination_settings: CoordinationSettings = CoordinationSettings()
+shard_settings: ShardSettings = ShardSettings()
+metrics_settings: MetricsSettings = MetricsSettings()
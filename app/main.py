@@ -1,12 +1,52 @@
 import asyncio
-from common import creds_notion_api
-from services.container import ApplicationContainer
+import contextlib
+import signal
+from common import creds_notion_api, bot_settings, shard_settings, write_queue_settings
+from services.container import ApplicationContainer, close_services
+from services.metrics import MetricsServer
+from services.shard_supervisor import rebalance_journals, ShardSupervisor
 
 
-async def main():
+async def run_single():
     container = ApplicationContainer()
     telegram_bot = container.telegram_bot(token=creds_notion_api.bot_token)
-    await telegram_bot.run()
+    # записи, оставшиеся в журналах процессов после работы с шардированием
+    rebalance_journals(write_queue_settings.path, 1)
+    try:
+        if bot_settings.mode == 'webhook':
+            await telegram_bot.run_webhook(bot_settings)
+        else:
+            await telegram_bot.run()
+    finally:
+        await close_services(container, telegram_bot)
+
+
+async def run_sharded():
+    supervisor = ShardSupervisor(token=creds_notion_api.bot_token)
+    try:
+        await supervisor.start()
+        if bot_settings.mode == 'webhook':
+            await supervisor.run_webhook(bot_settings)
+        else:
+            await supervisor.run_polling()
+    finally:
+        await supervisor.drain()
+
+
+async def main():
+    # SIGTERM останавливает бот так же, как Ctrl+C: с обработкой уже принятых обновлений
+    task = asyncio.current_task()
+    with contextlib.suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    metrics_server = MetricsServer()
+    await metrics_server.start()
+    try:
+        if shard_settings.workers > 1:
+            await run_sharded()
+        else:
+            await run_single()
+    finally:
+        await metrics_server.stop()
 
 
 if __name__ == '__main__':
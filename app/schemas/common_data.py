@@ -15,9 +15,21 @@ class CommonData:
     def __init__(self):
         self.url_search = creds_notion_api.search_path
         self.url_search_databases = creds_notion_api.search_databases_path
+        self.url_pages = creds_notion_api.pages_path
         self.mandatory_headers = {'Authorization': creds_notion_api.authorization_header,
                                   'Notion-Version': creds_notion_api.version}
         self.content_json_header = {'Content-Type': 'application/json'}
 
+    def authorized_headers(self, token: str | None = None) -> dict[str, str]:
+        """
+        Обязательные заголовки запроса к Notion
+
+        :param token: токен интеграции пользователя, None - токен из настроек
+        :return: заголовки
+        """
+        if token is None:
+            return self.mandatory_headers
+        return self.mandatory_headers | {'Authorization': f'Bearer {token}'}
+
 
 common_data_notion: CommonData = CommonData()
@@ -34,3 +34,28 @@ class Database(BaseModel):
     description: list[Description]
     properties: dict[str, dict]
     parent: Parent
+
+
+class DatabaseSummary(BaseModel):
+    """
+    Сокращенная модель базы данных для списка баз: только поля, которые использует бот
+    """
+    id: UUID
+    title: list[Title]
+    last_edited_time: datetime
+
+
+class DatabaseSearchResponse(BaseModel):
+    results: list[DatabaseSummary]
+    has_more: bool = False
+    next_cursor: str | None = None
+
+
+class DatabaseSchema(BaseModel):
+    """
+    Сокращенная модель базы данных для построения отчетов
+    """
+    id: UUID
+    last_edited_time: datetime
+    description: list[Description]
+    properties: dict[str, dict]
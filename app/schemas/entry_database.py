@@ -22,3 +22,12 @@ class EntryDB(BaseModel):
     last_edited_time: datetime
     parent: Parent
     properties: dict
+
+
+class EntryQueryResponse(BaseModel):
+    """
+    Страница записей базы данных, записи остаются в необработанном виде
+    """
+    results: list[dict]
+    has_more: bool = False
+    next_cursor: str | None = None
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from services.metrics import cache_requests
+
+
+class AsyncTTLCache:
+    """
+    Асинхронный кэш значений с временем жизни.
+
+    Одновременные запросы одного ключа разделяют одну загрузку (single-flight),
+    устаревшее значение отдается сразу, пока в фоне идет его обновление (stale-while-revalidate)
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0.0, name: str = 'ttl_cache') -> None:
+        """
+        :param ttl: время, в течение которого значение считается свежим, с
+        :param stale_ttl: время после истечения ttl, в течение которого отдается устаревшее значение, с
+        :param name: имя кэша в метриках
+        """
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.__values: dict[Hashable, tuple[float, Any]] = {}
+        self.__loading: dict[Hashable, asyncio.Future] = {}
+        self.__generation = 0
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Получение значения по ключу
+
+        :param key: ключ кэша
+        :param loader: корутина-фабрика, загружающая значение при промахе
+        :return: значение из кэша или загруженное значение
+        """
+        entry = self.__values.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                cache_requests.inc(cache=self.name, result='hit')
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                cache_requests.inc(cache=self.name, result='stale')
+                if key not in self.__loading:
+                    self.__start_loading(key, loader).add_done_callback(self.__log_background_error)
+                return entry[1]
+        cache_requests.inc(cache=self.name, result='miss')
+        future = self.__loading.get(key)
+        if future is None:
+            future = self.__start_loading(key, loader)
+        return await asyncio.shield(future)
+
+    def __start_loading(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = asyncio.ensure_future(self.__load(key, loader))
+        self.__loading[key] = future
+        return future
+
+    async def __load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        generation = self.__generation
+        try:
+            value = await loader()
+            # значение, загруженное до инвалидации, в кэш не попадает
+            if generation == self.__generation:
+                self.__values[key] = (time.monotonic(), value)
+            return value
+        finally:
+            if self.__loading.get(key) is asyncio.current_task():
+                del self.__loading[key]
+
+    @staticmethod
+    def __log_background_error(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f'Background cache refresh failed: {future.exception()!r}')
+
+    def invalidate(self, key: Hashable | None = None) -> None:
+        """
+        Сброс значения по ключу, без ключа сбрасывается весь кэш
+
+        :param key: ключ кэша
+        """
+        self.__generation += 1
+        if key is None:
+            self.__values.clear()
+            self.__loading.clear()
+        else:
+            self.__values.pop(key, None)
+            self.__loading.pop(key, None)
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from uuid import UUID
+
+from common import chart_settings, ChartSettings
+from services.metrics import cache_requests, chart_render_duration, tracer
+
+
+# reps - повторения по упражнениям, distance и pace - дистанция и темп пробежек
+CHART_TYPES = ('reps', 'distance', 'pace')
+
+COLORS = ((31, 119, 180), (255, 127, 14), (44, 160, 44), (214, 39, 40), (148, 103, 189), (140, 86, 75))
+
+
+class ChartData:
+    """
+    Данные одного графика: даты тренировок и значения линий.
+
+    Передается в рабочий процесс, поэтому содержит только списки и строки без numpy
+    """
+
+    def __init__(self,
+                 chart_type: str,
+                 version: str,
+                 caption: str,
+                 days: list[int],
+                 series: dict[str, list[float]],
+                 unit: str) -> None:
+        """
+        :param chart_type: тип графика из CHART_TYPES
+        :param version: last_edited_time самой новой записи истории, по которой построен график
+        :param caption: подпись к графику в Telegram
+        :param days: даты тренировок в днях от 1970-01-01
+        :param series: значения линий по названию, NaN - значения нет
+        :param unit: единица измерения по оси значений
+        """
+        self.chart_type = chart_type
+        self.version = version
+        self.caption = caption
+        self.days = days
+        self.series = series
+        self.unit = unit
+
+
+def _format_tick(unit: str, value: float) -> str:
+    if unit == 'min/km':
+        minutes, seconds = divmod(round(value * 60), 60)
+        return f'{minutes}:{seconds:02d}'
+    return f'{value:.1f}' if unit == 'km' else f'{value:.0f}'
+
+
+# numpy и PIL импортируются только в рабочем процессе, как и при распознавании изображений
+def _render_chart(chart: ChartData, width: int, height: int) -> bytes:
+    """
+    Отрисовка линейного графика в PNG
+
+    :param chart: данные графика
+    :param width: ширина изображения
+    :param height: высота изображения
+    :return: PNG
+    """
+    import datetime
+    import io
+
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFont
+
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    left, top, right, bottom = 60, 30, width - 20, height - 40
+
+    days = np.asarray(chart.days, dtype=np.float64)
+    series = {name: np.asarray(values, dtype=np.float64) for name, values in chart.series.items()}
+    present = np.concatenate([values[~np.isnan(values)] for values in series.values()])
+    low, high = float(present.min()), float(present.max())
+    if high - low < 1e-9:
+        low, high = low - 1.0, high + 1.0
+    first, last = float(days.min()), float(days.max())
+    if last == first:
+        first, last = first - 1.0, last + 1.0
+
+    # сетка и подписи оси значений
+    for value in np.linspace(low, high, 5):
+        y = float(np.interp(value, (low, high), (bottom, top)))
+        draw.line((left, y, right, y), fill=(225, 225, 225))
+        draw.text((5, y - 6), _format_tick(chart.unit, float(value)), fill='black', font=font)
+    draw.line((left, top, left, bottom), fill='black')
+    draw.line((left, bottom, right, bottom), fill='black')
+    draw.text((5, 5), chart.unit, fill='black', font=font)
+
+    # подписи дат: первая, средняя и последняя
+    epoch = datetime.date(1970, 1, 1)
+    for day in (first, (first + last) / 2, last):
+        x = float(np.interp(day, (first, last), (left, right)))
+        label = str(epoch + datetime.timedelta(days=round(day)))
+        draw.text((min(max(x - 30, left), right - 60), bottom + 8), label, fill='black', font=font)
+
+    xs = np.interp(days, (first, last), (left, right))
+    for i, (name, values) in enumerate(series.items()):
+        color = COLORS[i % len(COLORS)]
+        mask = ~np.isnan(values)
+        points = list(zip(xs[mask].tolist(), np.interp(values[mask], (low, high), (bottom, top)).tolist()))
+        if len(points) > 1:
+            draw.line(points, fill=color, width=2, joint='curve')
+        for x, y in points if len(points) <= width // 8 else points[-1:]:
+            draw.ellipse((x - 3, y - 3, x + 3, y + 3), fill=color)
+        # легенда в правом верхнем углу
+        legend_y = top + 14 * i
+        draw.line((right - 90, legend_y + 6, right - 70, legend_y + 6), fill=color, width=2)
+        draw.text((right - 65, legend_y), name, fill='black', font=font)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _render_timed(chart: ChartData, width: int, height: int) -> tuple[bytes, float]:
+    started_at = time.perf_counter()
+    png = _render_chart(chart, width, height)
+    return png, time.perf_counter() - started_at
+
+
+class ChartRenderer:
+    """
+    Класс для построения графиков прогресса.
+
+    Графики рисуются в пуле процессов, чтобы не блокировать цикл событий бота. После отправки
+    запоминается file_id фото в Telegram по (id базы данных, last_edited_time, тип графика),
+    и пока записи базы не менялись, график отправляется повторно по file_id без отрисовки и загрузки
+    """
+
+    def __init__(self, settings: ChartSettings | None = None) -> None:
+        self.__settings = settings if settings else chart_settings
+        self.__executor: ProcessPoolExecutor | None = None
+        self.__file_ids: OrderedDict[tuple[UUID, str, str], str] = OrderedDict()
+
+    def close(self) -> None:
+        """
+        Остановка пула процессов, незапущенные задачи отменяются
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+    async def render(self, chart: ChartData) -> bytes:
+        """
+        Асинхронная отрисовка графика в пуле процессов
+
+        :param chart: данные графика
+        :return: PNG
+        """
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(max_workers=self.__settings.workers)
+        with tracer.start_as_current_span('chart render'):
+            future = self.__executor.submit(_render_timed, chart, self.__settings.width, self.__settings.height)
+            png, duration = await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.__settings.timeout)
+        chart_render_duration.observe(duration)
+        return png
+
+    def get_file_id(self, database_id: UUID, chart: ChartData) -> str | None:
+        """
+        Получение file_id уже отправленного графика
+
+        :param database_id: id базы данных
+        :param chart: данные графика
+        :return: file_id или None, если такой график еще не отправлялся
+        """
+        key = (database_id, chart.version, chart.chart_type)
+        file_id: str | None = self.__file_ids.get(key)
+        if file_id is not None:
+            self.__file_ids.move_to_end(key)
+        cache_requests.inc(cache='charts', result='hit' if file_id is not None else 'miss')
+        return file_id
+
+    def put_file_id(self, database_id: UUID, chart: ChartData, file_id: str) -> None:
+        key = (database_id, chart.version, chart.chart_type)
+        self.__file_ids[key] = file_id
+        self.__file_ids.move_to_end(key)
+        while len(self.__file_ids) > self.__settings.max_cached:
+            self.__file_ids.popitem(last=False)
+
+    def forget_file_id(self, database_id: UUID, chart: ChartData) -> None:
+        # file_id перестает быть действительным, например после смены токена бота
+        self.__file_ids.pop((database_id, chart.version, chart.chart_type), None)
@@ -1,24 +1,100 @@
 from dependency_injector import containers, providers
 
 from services.telegram_bot import TelegramBot
+from services.chart_renderer import ChartRenderer
+from services.coordination import create_backend
 from services.database_lister import DatabaseLister
+from services.image_operator import ImageOperator
+from services.notion_mirror import NotionMirror
+from services.ocr_cache import OcrResultCache
+from services.page_write_queue import PageWriteQueue
 from services.request_operator import RequestOperator
+from services.tenants import Tenant, TenantRegistry, TenantStore
+from services.update_dispatcher import UpdateDispatcher
+from services.workout_analytics import WorkoutAnalytics
 from services.database_operator import DatabaseWorkoutOperator, DatabaseRunOperator
 
 
 class ApplicationContainer(containers.DeclarativeContainer):
-    request_operator = providers.Singleton(RequestOperator)
+    # общее состояние процессов бота при шардировании, None - состояние только в памяти процесса
+    coordination_backend = providers.Singleton(create_backend)
+
+    request_operator = providers.Singleton(RequestOperator,
+                                           backend=coordination_backend)
+
+    database_lister = providers.Singleton(DatabaseLister,
+                                          request_operator=request_operator)
+
+    notion_mirror = providers.Singleton(NotionMirror,
+                                        request_operator=request_operator,
+                                        database_lister=database_lister)
 
     database_workout_operator = providers.Singleton(DatabaseWorkoutOperator,
-                                                    request_operator=request_operator)
+                                                    request_operator=request_operator,
+                                                    mirror=notion_mirror)
 
     database_run_operator = providers.Singleton(DatabaseRunOperator,
-                                                request_operator=request_operator)
+                                                request_operator=request_operator,
+                                                mirror=notion_mirror)
 
-    database_lister = providers.Singleton(DatabaseLister,
-                                          request_operator=request_operator)
+    workout_analytics = providers.Singleton(WorkoutAnalytics,
+                                            database_workout_operator=database_workout_operator,
+                                            database_run_operator=database_run_operator)
+
+    chart_renderer = providers.Singleton(ChartRenderer)
+
+    # рабочее пространство из настроек, используется, пока режим нескольких пользователей выключен
+    default_tenant = providers.Singleton(Tenant,
+                                         request_operator=request_operator,
+                                         database_lister=database_lister,
+                                         database_workout_operator=database_workout_operator,
+                                         database_run_operator=database_run_operator,
+                                         workout_analytics=workout_analytics)
+
+    tenant_store = providers.Singleton(TenantStore)
+
+    tenant_registry = providers.Singleton(TenantRegistry,
+                                          store=tenant_store,
+                                          backend=coordination_backend)
+
+    page_write_queue = providers.Singleton(PageWriteQueue,
+                                           request_operator=request_operator,
+                                           tenants=tenant_registry,
+                                           mirror=notion_mirror)
+
+    image_operator = providers.Singleton(ImageOperator)
+
+    ocr_cache = providers.Singleton(OcrResultCache,
+                                    backend=coordination_backend)
+
+    update_dispatcher = providers.Singleton(UpdateDispatcher)
 
     telegram_bot = providers.Factory(TelegramBot,
-                                     database_lister=database_lister,
-                                     database_workout_operator=database_workout_operator,
-                                     database_run_operator=database_run_operator)
+                                     default_tenant=default_tenant,
+                                     tenants=tenant_registry,
+                                     chart_renderer=chart_renderer,
+                                     image_operator=image_operator,
+                                     ocr_cache=ocr_cache,
+                                     notion_mirror=notion_mirror,
+                                     page_write_queue=page_write_queue,
+                                     dispatcher=update_dispatcher,
+                                     backend=coordination_backend)
+
+
+async def close_services(container: ApplicationContainer, telegram_bot: TelegramBot) -> None:
+    """
+    Остановка бота и освобождение ресурсов сервисов контейнера
+
+    :param container: контейнер сервисов
+    :param telegram_bot: бот, созданный контейнером
+    """
+    await telegram_bot.close()
+    await container.page_write_queue().close()
+    await container.notion_mirror().close()
+    await container.tenant_registry().close()
+    await container.request_operator().close()
+    container.image_operator().close()
+    container.chart_renderer().close()
+    backend = container.coordination_backend()
+    if backend is not None:
+        await backend.close()
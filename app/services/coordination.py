@@ -0,0 +1,216 @@
+import asyncio
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+
+from common import coordination_settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+"""
+
+
+def _reserve(tokens: float, updated_at: float, now: float, rate: float, capacity: int) -> tuple[float, float, float]:
+    """
+    Резервирование токена: количество токенов может уйти в минус, тогда токен становится доступен позже
+
+    :param tokens: токены на момент updated_at
+    :param updated_at: время последнего пополнения, в будущем - пока действует пауза
+    :param now: текущее время
+    :param rate: скорость пополнения, токенов в секунду
+    :param capacity: максимальное количество токенов
+    :return: новые токены, время пополнения и ожидание до зарезервированного токена, с
+    """
+    if now > updated_at:
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        updated_at = now
+    tokens -= 1
+    ready_at = updated_at + max(0.0, -tokens) / rate
+    return tokens, updated_at, max(0.0, ready_at - now)
+
+
+class CoordinationBackend(ABC):
+    """
+    Общее состояние нескольких процессов бота: ограничители частоты запросов и кэш.
+
+    Время берется из time.time(), чтобы быть общим для процессов
+    """
+
+    @abstractmethod
+    async def reserve_token(self, key: str, rate: float, capacity: int) -> float:
+        """
+        Резервирование токена ограничителя частоты
+
+        :param key: ключ ограничителя
+        :param rate: скорость пополнения, токенов в секунду
+        :param capacity: максимальное количество токенов
+        :return: сколько ждать до зарезервированного токена, с
+        """
+
+    @abstractmethod
+    async def pause(self, key: str, until: float) -> None:
+        """
+        Приостановка выдачи токенов ограничителя, например по заголовку Retry-After
+
+        :param key: ключ ограничителя
+        :param until: время окончания паузы по time.time()
+        """
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        """
+        Получение значения кэша
+
+        :param key: ключ
+        :return: значение или None, если его нет или срок хранения истек
+        """
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        """
+        Сохранение значения кэша
+
+        :param key: ключ
+        :param value: значение
+        :param ttl: срок хранения, с, None - без ограничения
+        """
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(CoordinationBackend):
+    """
+    Общее состояние в памяти одного процесса, для тестов и работы без шардирования
+    """
+
+    def __init__(self) -> None:
+        self.__buckets: dict[str, tuple[float, float]] = {}
+        self.__cache: dict[str, tuple[bytes, float | None]] = {}
+
+    async def reserve_token(self, key: str, rate: float, capacity: int) -> float:
+        now = time.time()
+        tokens, updated_at = self.__buckets.get(key, (capacity, now))
+        tokens, updated_at, delay = _reserve(tokens, updated_at, now, rate, capacity)
+        self.__buckets[key] = (tokens, updated_at)
+        return delay
+
+    async def pause(self, key: str, until: float) -> None:
+        tokens, updated_at = self.__buckets.get(key, (0.0, until))
+        self.__buckets[key] = (min(tokens, 0.0), max(updated_at, until))
+
+    async def get(self, key: str) -> bytes | None:
+        value, expires_at = self.__cache.get(key, (None, None))
+        if expires_at is not None and expires_at < time.time():
+            del self.__cache[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        self.__cache[key] = (value, time.time() + ttl if ttl is not None else None)
+
+
+class SqliteBackend(CoordinationBackend):
+    """
+    Общее состояние процессов одной машины в файле SQLite: локальная замена Redis.
+
+    Резервирование токена выполняется в транзакции BEGIN IMMEDIATE, поэтому процессы
+    не выдают один и тот же токен дважды
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__connection: sqlite3.Connection | None = None
+        self.__lock = asyncio.Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None,
+                                                check_same_thread=False)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.executescript(SCHEMA)
+        return self.__connection
+
+    async def __execute(self, func, *args):
+        # sqlite вызывается в отдельном потоке, запросы к соединению процесса выполняются по очереди
+        async with self.__lock:
+            return await asyncio.to_thread(func, self.__connect(), *args)
+
+    @staticmethod
+    def __reserve_token(connection: sqlite3.Connection, key: str, rate: float, capacity: int) -> float:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated_at, delay = _reserve(*(row or (capacity, now)), now, rate, capacity)
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                               (key, tokens, updated_at))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return delay
+
+    @staticmethod
+    def __pause(connection: sqlite3.Connection, key: str, until: float) -> None:
+        connection.execute('INSERT INTO buckets (key, tokens, updated_at) VALUES (?, 0, ?) '
+                           'ON CONFLICT (key) DO UPDATE SET tokens = MIN(tokens, 0), '
+                           'updated_at = MAX(updated_at, excluded.updated_at)', (key, until))
+
+    @staticmethod
+    def __get(connection: sqlite3.Connection, key: str) -> bytes | None:
+        row = connection.execute('SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)',
+                                 (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def __set(connection: sqlite3.Connection, key: str, value: bytes, ttl: float | None) -> None:
+        now = time.time()
+        connection.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+        connection.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                           (key, value, now + ttl if ttl is not None else None))
+
+    async def reserve_token(self, key: str, rate: float, capacity: int) -> float:
+        return await self.__execute(self.__reserve_token, key, rate, capacity)
+
+    async def pause(self, key: str, until: float) -> None:
+        await self.__execute(self.__pause, key, until)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.__execute(self.__get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        await self.__execute(self.__set, key, value, ttl)
+
+    async def close(self) -> None:
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+
+def create_backend(url: str | None = None) -> CoordinationBackend | None:
+    """
+    Создание общего хранилища по адресу из настроек
+
+    :param url: memory:// или sqlite:///путь/к/файлу, None - адрес из настроек
+    :return: хранилище или None, если адрес не задан и каждый процесс работает со своим состоянием
+    """
+    url = url if url else coordination_settings.backend
+    if not url:
+        return None
+    if url == 'memory://':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SqliteBackend(url.removeprefix('sqlite:///'))
+    raise ValueError(f'Unknown coordination backend "{url}", expected memory:// or sqlite:///<path>')
@@ -1,9 +1,12 @@
 import re
+import time
 from uuid import UUID
 
+from common import cache_settings
+from services.async_ttl_cache import AsyncTTLCache
 from services.request_operator import get_request_operator, RequestOperator
 from schemas.common_data import common_data_notion
-from schemas.database import Database
+from schemas.database import DatabaseSummary, DatabaseSearchResponse
 
 
 # def get_database_lister():
@@ -16,9 +19,20 @@ class DatabaseLister:
     """
 
     def __init__(self,
-                 request_operator: RequestOperator) -> None:
+                 request_operator: RequestOperator,
+                 cache: AsyncTTLCache | None = None,
+                 token: str | None = None) -> None:
+        """
+        :param request_operator: оператор запросов
+        :param cache: кэш списка баз данных
+        :param token: токен интеграции Notion пользователя, None - токен из настроек
+        """
         self.common_data = common_data_notion
+        self.__token = token
         self.__request_operator = request_operator
+        self.__cache = cache if cache else AsyncTTLCache(ttl=cache_settings.databases_ttl,
+                                                         stale_ttl=cache_settings.databases_stale_ttl,
+                                                         name='databases')
         self.__request_body_database_lister = {
             "filter": {
                 "value": "database",
@@ -26,32 +40,69 @@ class DatabaseLister:
             }
         }
         self.__template_name_workout_database = re.compile(r'^Тренировка.')
+        # время последнего запроса списка у Notion
+        self.__fetched_at: float | None = None
+
+    @property
+    def __workspace_key(self) -> str:
+        return self.common_data.authorized_headers(self.__token)['Authorization']
 
-    async def __get_model_databases(self) -> list[Database]:
+    async def __get_model_databases(self) -> list[DatabaseSummary]:
         """
-        Метод получения всех баз данных
+        Метод получения всех баз данных из кэша, при промахе список запрашивается у Notion
 
         :return:
         """
-        resp: dict = await self.__request_operator.post_request_response_data(
+        return await self.__cache.get(self.__workspace_key, self.__fetch_model_databases)
+
+    async def __fetch_model_databases(self) -> list[DatabaseSummary]:
+        self.__fetched_at = time.monotonic()
+        resp: DatabaseSearchResponse = await self.__request_operator.post_request_response_model(
             url=self.common_data.url_search,
-            headers=self.common_data.mandatory_headers | self.common_data.content_json_header,
-            data=self.__request_body_database_lister
+            headers=self.common_data.authorized_headers(self.__token) | self.common_data.content_json_header,
+            model=DatabaseSearchResponse,
+            data=self.__request_body_database_lister,
+            idempotent=True
         )
-        databases: list[dict] = resp.get('results')
-        return [Database.model_validate(db) for db in databases]
+        return resp.results
+
+    def invalidate_cache(self) -> None:
+        """
+        Сброс кэша списка баз данных текущего рабочего пространства
+        """
+        self.__cache.invalidate(self.__workspace_key)
 
     async def get_all_databases(self) -> dict[UUID, str]:
-        databases: list[Database] = await self.__get_model_databases()
+        databases: list[DatabaseSummary] = await self.__get_model_databases()
         return {db.id: db.title[0].plain_text for db in databases}
 
+    async def get_database_title(self, database_id: UUID) -> str | None:
+        """
+        Метод получения названия базы данных по id.
+        Если базы нет в кэше, кэш сбрасывается и список запрашивается повторно, но не чаще
+        databases_refetch_interval: id приходит из кнопки, и устаревшие или подделанные кнопки
+        не должны запрашивать полный список при каждом нажатии
+
+        :param database_id: id базы данных
+        :return: название базы данных или None, если база не найдена
+        """
+        databases: dict[UUID, str] = await self.get_all_databases()
+        if database_id not in databases and self.__listing_outdated():
+            self.invalidate_cache()
+            databases = await self.get_all_databases()
+        return databases.get(database_id)
+
+    def __listing_outdated(self) -> bool:
+        return self.__fetched_at is None or \
+            time.monotonic() - self.__fetched_at >= cache_settings.databases_refetch_interval
+
     async def get_workout_databases(self) -> dict[UUID, str]:
         """
         Метод получения баз данных для тренировок
 
         :return:
         """
-        databases: list[Database] = await self.__get_model_databases()
+        databases: list[DatabaseSummary] = await self.__get_model_databases()
         return {
             db.id: db.title[0].plain_text for db in databases
             if re.match(self.__template_name_workout_database, db.title[0].plain_text)
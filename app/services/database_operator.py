@@ -1,76 +1,387 @@
+import asyncio
 import logging
 import re
 import datetime
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Awaitable, Iterable, TYPE_CHECKING
 from uuid import UUID
 
+from common import cache_settings
+from services.async_ttl_cache import AsyncTTLCache
 from services.request_operator import RequestOperator
-from schemas.entry_database import EntryDB
+from schemas.entry_database import EntryQueryResponse
 from schemas.common_data import common_data_notion
-from schemas.database import Database
+from schemas.database import DatabaseSchema
+
+if TYPE_CHECKING:
+    from services.notion_mirror import NotionMirror
+
+
+MAX_PAGE_SIZE = 100
+
+# база пробежек, в которую сохраняются распознанные скриншоты, если база не указана явно
+RUN_DATABASE_ID = 'e9949596-756e-40af-abcb-efbac49ee837'
+
+
+async def gather_or_cancel(*aws: Awaitable):
+    """
+    Конкурентное выполнение корутин: при первой ошибке остальные задачи отменяются, а ошибка пробрасывается
+
+    :param aws: корутины
+    :return: список результатов в порядке корутин
+    """
+    tasks: list[asyncio.Task] = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+FIELD_EXTRACTORS = {
+    'number': lambda field: field.get('number'),
+    'string': lambda field: field.get('string'),
+    'date': lambda field: field.get('date').get('start'),
+    'title': lambda field: field.get('title')[0].get('plain_text'),
+    # значение формулы хранится в том же виде, что и обычное поле
+    'formula': lambda field: extract_field(field.get('formula')),
+}
+
+
+def extract_field(field: dict):
+    """
+    Получение значения поля записи по его типу
+
+    :param field: поле записи в необработанном виде
+    :return: значение поля или None для неподдерживаемых типов
+    """
+    extractor = FIELD_EXTRACTORS.get(field.get('type'))
+    return extractor(field) if extractor else None
+
+
+class WorkoutReportPlan:
+    """
+    Скомпилированный план отчета по базе данных тренировок.
+
+    Строится один раз по схеме базы данных и действует, пока не изменится last_edited_time базы
+    """
+
+    def __init__(self, last_edited_time: datetime.datetime, exercises: list[tuple[str, tuple[str, ...]]]) -> None:
+        """
+        :param last_edited_time: время изменения базы данных, по которой построен план
+        :param exercises: заголовки упражнений и ключи их подходов в порядке вывода
+        """
+        self.last_edited_time = last_edited_time
+        self.exercises = exercises
+
+    @classmethod
+    def compile(cls,
+                database: DatabaseSchema,
+                template_exercise: re.Pattern,
+                template_exercise_number: re.Pattern) -> 'WorkoutReportPlan':
+        list_exercises: list[str] = database.description[0].plain_text.split('\n')
+        exercises: dict[str, str] = {elem.split('. ')[0]: elem.split('. ')[1]
+                                     for elem in list_exercises if re.match(template_exercise, elem)}
+        number_keys: list[str] = sorted(key for key, value in database.properties.items()
+                                        if value.get('type') == 'number' and re.match(template_exercise_number, key))
+        return cls(
+            last_edited_time=database.last_edited_time,
+            exercises=[(f'{num}. {exercise}', tuple(key for key in number_keys if key.startswith(f'{num}.')))
+                       for num, exercise in exercises.items()]
+        )
+
+    def project(self, properties: dict) -> dict[str, dict[str, int]]:
+        """
+        Построение отчета по свойствам записи
+
+        :param properties: свойства записи в необработанном виде
+        :return: результаты подходов по упражнениям
+        """
+        return {
+            header: {key: properties[key].get('number') for key in keys if key in properties}
+            for header, keys in self.exercises
+        }
 
 
 class DatabaseOperator:
 
     def __init__(self,
-                 request_operator: RequestOperator) -> None:
+                 request_operator: RequestOperator,
+                 mirror: 'NotionMirror | None' = None,
+                 token: str | None = None) -> None:
+        """
+        :param request_operator: оператор запросов
+        :param mirror: локальная копия баз данных
+        :param token: токен интеграции Notion пользователя, None - токен из настроек
+        """
         self._common_data = common_data_notion
+        self._token = token
         self._request_operator = request_operator
+        self._mirror = mirror
+        self._database_cache = AsyncTTLCache(ttl=cache_settings.databases_ttl, name='database_schema')
 
     def get_field(self, data: dict, name: str):
-        field = data.get(name)
-        match field.get('type'):
-            case 'number':
-                return field.get('number')
-            case 'string':
-                return field.get('string')
-            case 'date':
-                return field.get('date').get('start')
-            case 'title':
-                return field.get('title')[0].get('plain_text')
-            case 'formula':
-                return self.get_field({'formula': field.get('formula')}, 'formula')
-
-    async def get_database_by_id(self, database_id: UUID) -> Database | None:
+        return extract_field(data.get(name))
+
+    async def get_database_by_id(self, database_id: UUID) -> DatabaseSchema | None:
         """
         Метод получения базы данных по id
 
         :param database_id: id базы данных
-        :return: pydantic модель базы данных
+        :return: pydantic модель схемы базы данных
         """
-        response: dict = await self._request_operator.get_request_response_data(
+        database: DatabaseSchema = await self._request_operator.get_request_response_model(
             url=f'{self._common_data.url_search_databases}/{database_id}',
-            headers=self._common_data.mandatory_headers
+            headers=self._common_data.authorized_headers(self._token),
+            model=DatabaseSchema
         )
         logging.info(f'Get database with id {database_id}')
-        return Database.model_validate(response)
+        return database
+
+    async def get_cached_database_by_id(self, database_id: UUID) -> DatabaseSchema:
+        """
+        Метод получения базы данных по id с кэшированием на время cache_settings.databases_ttl
+
+        :param database_id: id базы данных
+        :return: pydantic модель схемы базы данных
+        """
+        return await self._database_cache.get(database_id, lambda: self.get_database_by_id(database_id))
+
+    async def __query_page(self, database_id: UUID, query: dict) -> EntryQueryResponse:
+        response: EntryQueryResponse = await self._request_operator.post_request_response_model(
+            url=f'{self._common_data.url_search_databases}/{database_id}/query',
+            headers=self._common_data.authorized_headers(self._token) | self._common_data.content_json_header,
+            model=EntryQueryResponse,
+            data=query,
+            idempotent=True
+        )
+        logging.info(f'Get page of records of database with id {database_id}')
+        return response
+
+    async def iter_pages_record_database(self,
+                                         database_id: UUID,
+                                         query: dict | None = None,
+                                         page_size: int = MAX_PAGE_SIZE,
+                                         prefetch: bool = True) -> AsyncIterator[list[dict]]:
+        """
+        Потоковое получение записей таблицы постранично по курсору
+
+        :param database_id: id базы данных
+        :param query: тело запроса (фильтры и сортировки)
+        :param page_size: размер страницы, не больше 100
+        :param prefetch: запрашивать следующую страницу, пока обрабатывается текущая
+
+        :return: асинхронный генератор страниц записей в необработанном виде
+        """
+        base_query: dict = (query if query else {}) | {'page_size': min(page_size, MAX_PAGE_SIZE)}
+        next_page: asyncio.Task = asyncio.ensure_future(self.__query_page(database_id, base_query))
+        try:
+            while next_page is not None:
+                response: EntryQueryResponse = await next_page
+                next_page = None
+                if response.has_more and response.next_cursor:
+                    next_query: dict = base_query | {'start_cursor': response.next_cursor}
+                    if prefetch:
+                        next_page = asyncio.ensure_future(self.__query_page(database_id, next_query))
+                    else:
+                        next_page = self.__query_page(database_id, next_query)
+                yield response.results
+        finally:
+            if isinstance(next_page, asyncio.Future):
+                next_page.cancel()
+            elif next_page is not None:
+                next_page.close()
+
+    async def iter_record_database(self,
+                                   database_id: UUID,
+                                   query: dict | None = None,
+                                   page_size: int = MAX_PAGE_SIZE) -> AsyncIterator[dict]:
+        """
+        Потоковое получение записей таблицы по одной
+
+        :param database_id: id базы данных
+        :param query: тело запроса (фильтры и сортировки)
+        :param page_size: размер страницы, не больше 100
+
+        :return: асинхронный генератор записей в необработанном виде
+        """
+        pages = self.iter_pages_record_database(database_id, query, page_size)
+        try:
+            async for records in pages:
+                for record in records:
+                    yield record
+        finally:
+            await pages.aclose()
 
     async def get_list_record_database(self, database_id: UUID, query: dict | None = None) -> list[dict]:
         """
-        Поучение последней записи таблицы в необработанном виде
+        Получение всех записей таблицы в необработанном виде
 
         :param database_id: id базы данных
-        :param query: !!!
+        :param query: тело запроса (фильтры и сортировки)
 
-        :return: В случае успеха возвращает последнюю запись таблицы в необработанном виде
-        :rtype: :obj:`schemas.entry_database`
+        :return: В случае успеха возвращает все записи таблицы в необработанном виде
+        :rtype: :obj:`list[dict]`
         """
-        data = query if query else {}
-        response: dict = await self._request_operator.post_request_response_data(
-            url=f'{self._common_data.url_search_databases}/{database_id}/query',
-            headers=self._common_data.mandatory_headers | self._common_data.content_json_header,
+        records: list[dict] = []
+        async for page in self.iter_pages_record_database(database_id, query):
+            records.extend(page)
+        logging.info(f'Get list records of database with id {database_id}')
+        return records
+
+    async def get_first_record_database(self, database_id: UUID, query: dict | None = None) -> dict | None:
+        """
+        Получение первой записи таблицы, запрашивается страница из одной записи
+
+        :param database_id: id базы данных
+        :param query: тело запроса (фильтры и сортировки)
+
+        :return: первая запись таблицы в необработанном виде или None, если таблица пуста
+        """
+        pages = self.iter_pages_record_database(database_id, query, page_size=1, prefetch=False)
+        try:
+            async for records in pages:
+                return records[0] if records else None
+        finally:
+            await pages.aclose()
+        return None
+
+    async def create_page(self, data: dict) -> dict:
+        """
+        Создание записи в базе данных
+
+        :param data: тело запроса /v1/pages
+        :return: созданная запись в необработанном виде
+        """
+        return await self._request_operator.post_request_response_data(
+            url=self._common_data.url_pages,
+            headers=self._common_data.authorized_headers(self._token) | self._common_data.content_json_header,
             data=data
         )
-        logging.info(f'Get list records of database with id {database_id}')
-        return response.get('results')
 
+    async def get_last_record_by_date(self, database_id: UUID, force_refresh: bool = False) -> dict | None:
+        """
+        Получение последней по дате записи таблицы: из локальной копии, если она есть, иначе из Notion
+
+        :param database_id: id базы данных
+        :param force_refresh: запросить запись из Notion в обход локальной копии
+
+        :return: последняя запись таблицы в необработанном виде или None, если таблица пуста
+        """
+        if self._mirror is not None and not force_refresh:
+            record: dict | None = await self._mirror.get_last_record(database_id)
+            if record is not None:
+                return record
+        return await self.get_first_record_database(
+            database_id=database_id,
+            query={"sorts": [{"property": "Дата",
+                              "direction": "descending"}]}
+        )
+
+    async def get_records_edited_since(self,
+                                       database_id: UUID,
+                                       since: str | None = None) -> tuple[list[dict], str | None]:
+        """
+        Получение записей, измененных начиная с момента прошлой синхронизации.
+        Записи запрашиваются в порядке убывания last_edited_time, пока не встретится более старая запись
+
+        :param database_id: id базы данных
+        :param since: last_edited_time самой новой записи прошлой синхронизации, None - все записи
+
+        :return: записи в необработанном виде и last_edited_time самой новой из них
+        """
+        records: list[dict] = []
+        newest: str | None = None
+        pages = self.iter_pages_record_database(
+            database_id=database_id,
+            query={"sorts": [{"timestamp": "last_edited_time", "direction": "descending"}]}
+        )
+        try:
+            async for page in pages:
+                for record in page:
+                    last_edited_time: str = record.get('last_edited_time')
+                    newest = newest or last_edited_time
+                    # last_edited_time в Notion округляется до минуты, поэтому граничные записи запрашиваются повторно
+                    if since and last_edited_time < since:
+                        return records, newest
+                    records.append(record)
+        finally:
+            await pages.aclose()
+        return records, newest
+
+
+class WorkoutReportOperator(DatabaseOperator, ABC):
+    """
+    Оператор базы данных тренировок одного вида, строящий отчеты о последней тренировке
+    """
+
+    @abstractmethod
+    def history_row(self, properties: dict) -> dict[str, float]:
+        """
+        Показатели записи для истории тренировок
+
+        :param properties: свойства записи в необработанном виде
+        :return: значения показателей по названию
+        """
+
+    @abstractmethod
+    async def get_report_last_workout(self, database_id: UUID) -> dict:
+        """
+        Получение отчета о последней тренировке
+
+        :param database_id: id базы данных
+        :return: отчет, пустой, если в базе данных еще нет записей
+        """
+
+    async def get_reports_last_workouts(self,
+                                        database_ids: Iterable[UUID],
+                                        concurrency: int = 4) -> dict[UUID, dict]:
+        """
+        Получение отчетов о последней тренировке сразу по нескольким базам данных
+
+        :param database_ids: id баз данных
+        :param concurrency: максимальное количество одновременно строящихся отчетов
+
+        :return: отчеты по id базы данных
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_report(database_id: UUID) -> dict:
+            async with semaphore:
+                return await self.get_report_last_workout(database_id)
 
-class DatabaseWorkoutOperator(DatabaseOperator):
+        database_ids = list(database_ids)
+        reports = await gather_or_cancel(*(get_report(database_id) for database_id in database_ids))
+        return dict(zip(database_ids, reports))
+
+
+class DatabaseWorkoutOperator(WorkoutReportOperator):
 
     def __init__(self,
-                 request_operator: RequestOperator) -> None:
-        super().__init__(request_operator=request_operator)
+                 request_operator: RequestOperator,
+                 mirror: 'NotionMirror | None' = None,
+                 token: str | None = None) -> None:
+        super().__init__(request_operator=request_operator, mirror=mirror, token=token)
         self.template_exercise = re.compile(r'^[1-9].')
         self.template_exercise_number = re.compile(r"^[1-9].[1-9]$")
+        self.__report_plans: dict[UUID, WorkoutReportPlan] = {}
+
+    async def get_report_plan(self, database_id: UUID) -> WorkoutReportPlan:
+        """
+        Получение плана отчета, план перестраивается только при изменении схемы базы данных
+
+        :param database_id: id базы данных
+        :return: план отчета
+        """
+        database: DatabaseSchema = await self.get_cached_database_by_id(database_id)
+        plan: WorkoutReportPlan | None = self.__report_plans.get(database_id)
+        if plan is None or plan.last_edited_time != database.last_edited_time:
+            plan = WorkoutReportPlan.compile(database, self.template_exercise, self.template_exercise_number)
+            self.__report_plans[database_id] = plan
+            logging.info(f'Compile report plan for database with id {database_id}')
+        return plan
 
     async def get_last_processed_record_by_date(self, database_id: UUID) -> dict[str, int]:
         """
@@ -79,32 +390,39 @@ class DatabaseWorkoutOperator(DatabaseOperator):
         :return: В случае успеха возвращает последнюю запись таблицы в обработанном виде
         :rtype: :obj:`schemas.entry_database`
         """
-        records: list[dict] = await self.get_list_record_database(
-            database_id=database_id,
-            query={"sorts": [{"property": "Дата",
-                              "direction": "descending"}]}
-        )
-        record: EntryDB = EntryDB.model_validate(records[0])
+        last_record: dict | None = await self.get_last_record_by_date(database_id)
         num_exercise_res: dict = {}
-        for key, value in record.properties.items():
+        if last_record is None:
+            return num_exercise_res
+        for key, value in last_record.get('properties').items():
             if value.get('type') == 'number' and re.match(self.template_exercise_number, key):
                 num_exercise_res[key] = value.get(value.get("type"))
         num_exercise_res = dict(sorted(num_exercise_res.items(), key=lambda para: para[0]))
         return num_exercise_res
 
-    async def get_report_last_workout(self, database_id: UUID) -> dict[str, dict[str, int]]:
-        database: Database = await self.get_database_by_id(database_id)
-        list_exercises: list[str] = database.description[0].plain_text.split('\n')
-        exercises: dict[str, str] = {elem.split('. ')[0]: elem.split('. ')[1]
-                                     for elem in list_exercises if re.match(self.template_exercise, elem)}
-        result_exercises: dict[str, int] = await self.get_last_processed_record_by_date(database_id)
+    def history_row(self, properties: dict) -> dict[str, float]:
+        """
+        Количество повторений по упражнениям: подходы упражнения "N.M" суммируются в показатель "N"
 
-        report: dict[str, dict[str, int]] = {}
-        for num, exercise in exercises.items():
-            report[f'{num}. {exercise}'] = {
-                key: value for key, value in result_exercises.items() if key.startswith(f'{num}.')
-            }
-        return report
+        :param properties: свойства записи в необработанном виде
+        :return: повторения по номерам упражнений
+        """
+        row: dict[str, float] = {}
+        for key, value in properties.items():
+            if value.get('type') == 'number' and value.get('number') is not None \
+                    and re.match(self.template_exercise_number, key):
+                exercise: str = key.split('.')[0]
+                row[exercise] = row.get(exercise, 0.0) + value.get('number')
+        return row
+
+    async def get_report_last_workout(self, database_id: UUID) -> dict[str, dict[str, int]]:
+        plan, last_record = await gather_or_cancel(
+            self.get_report_plan(database_id),
+            self.get_last_record_by_date(database_id)
+        )
+        if last_record is None:
+            return {}
+        return plan.project(last_record.get('properties'))
 
     @staticmethod
     def convert_report_to_str_mess(report: dict) -> str:
@@ -125,22 +443,22 @@ class DatabaseWorkoutOperator(DatabaseOperator):
         return mess
 
 
-class DatabaseRunOperator(DatabaseOperator):
+class DatabaseRunOperator(WorkoutReportOperator):
 
     def __init__(self,
-                 request_operator: RequestOperator) -> None:
-        super().__init__(request_operator=request_operator)
+                 request_operator: RequestOperator,
+                 mirror: 'NotionMirror | None' = None,
+                 token: str | None = None) -> None:
+        super().__init__(request_operator=request_operator, mirror=mirror, token=token)
         self.params = ('Название', 'Дата', 'Дистанция (км)', 'Общее время', 'Средний темп', 'Сожжено (ккал)',
                        'Средний пульс (уд/мин)', 'Максимальный пульс (уд/мин)', 'Время паузы')
 
     async def get_report_last_workout(self, database_id: UUID) -> dict:
-        records: list[dict] = await self.get_list_record_database(
-            database_id=database_id,
-            query={"sorts": [{"property": "Дата",
-                              "direction": "descending"}]}
-        )
-        record: EntryDB = EntryDB.model_validate(records[0])
-        report = {param: self.get_field(record.properties, param) for param in self.params}
+        last_record: dict | None = await self.get_last_record_by_date(database_id)
+        if last_record is None:
+            return {}
+        properties: dict = last_record.get('properties')
+        report = {param: self.get_field(properties, param) for param in self.params}
         return report
 
     @staticmethod
@@ -168,8 +486,64 @@ class DatabaseRunOperator(DatabaseOperator):
                 data[param] = value
         return data
 
-    async def send_new_report(self, report: dict, database_id: str | None = "e9949596-756e-40af-abcb-efbac49ee837"):
-        data = {
+    def history_row(self, properties: dict) -> dict[str, float]:
+        """
+        Показатели пробежки: дистанция, длительность, темп, пульс и калории
+
+        :param properties: свойства записи в необработанном виде
+        :return: значения показателей по названию
+        """
+        def number(name: str) -> float | None:
+            field: dict | None = properties.get(name)
+            value = extract_field(field) if field else None
+            return float(value) if isinstance(value, (int, float)) else None
+
+        row: dict[str, float | None] = {
+            'distance': number('Дистанция (км)'),
+            'calories': number('Сожжено (ккал)'),
+            'heart_rate': number('Средний пульс (уд/мин)'),
+            'max_heart_rate': number('Максимальный пульс (уд/мин)'),
+        }
+        time_parts = [number(f'Время ({unit})') for unit in ('часы', 'минуты', 'секунды')]
+        if any(part is not None for part in time_parts):
+            hours, minutes, seconds = (part or 0.0 for part in time_parts)
+            row['duration'] = hours * 60 + minutes + seconds / 60
+            if row['distance']:
+                row['pace'] = row['duration'] / row['distance']
+        return {name: value for name, value in row.items() if value is not None}
+
+    @staticmethod
+    def merge_reports(reports: list[dict]) -> list[dict]:
+        """
+        Объединение данных, распознанных с нескольких скриншотов.
+        Данные без противоречий объединяются в одну тренировку (например, две части одного экрана),
+        одинаковые данные отбрасываются, противоречащие друг другу данные считаются разными тренировками
+
+        :param reports: данные, распознанные со скриншотов, в порядке скриншотов
+        :return: данные тренировок
+        """
+        merged: list[dict] = []
+        for report in reports:
+            if not report:
+                continue
+            target: dict | None = next((item for item in merged
+                                        if all(item.get(key, value) == value for key, value in report.items())), None)
+            if target is None:
+                merged.append(dict(report))
+            else:
+                target.update(report)
+        return merged
+
+    def build_new_report_page(self, report: dict, database_id: str | None = RUN_DATABASE_ID) -> dict:
+        """
+        Построение тела запроса на создание записи о пробежке
+
+        :param report: данные, распознанные со скриншота
+        :param database_id: id базы данных пробежек
+
+        :return: тело запроса /v1/pages
+        """
+        return {
             "parent": {"database_id": database_id},
             "properties": {
                 "Название": {
@@ -192,9 +566,8 @@ class DatabaseRunOperator(DatabaseOperator):
                 "Время паузы (секунды)": {"number": int(report.get('Время пауз').split(':')[2])}
             }
         }
-        print(data)
-        await self._request_operator.post_request_response_data(
-            url='https://api.notion.com/v1/pages',
-            headers=self._common_data.mandatory_headers | self._common_data.content_json_header,
-            data=data
-        )
+
+    async def send_new_report(self, report: dict, database_id: str | None = "e9949596-756e-40af-abcb-efbac49ee837"):
+        data = self.build_new_report_page(report, database_id)
+        logging.debug(f"New run report page {data}")
+        await self.create_page(data)
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterator
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from common import upload_settings, UploadSettings
+
+
+class FileTooLargeError(Exception):
+    """
+    Файл превышает допустимый размер
+    """
+
+    def __init__(self, size: int, max_size: int) -> None:
+        super().__init__(f'File size {size} exceeds limit {max_size}')
+        self.size = size
+        self.max_size = max_size
+
+
+class DownloadedFile:
+    """
+    Скачанный файл: содержимое в буфере (в памяти, большие файлы - на диске), размер и sha256
+    """
+
+    def __init__(self, buffer: SpooledTemporaryFile, size: int, sha256: str) -> None:
+        self.__buffer = buffer
+        self.size = size
+        self.sha256 = sha256
+
+    def read(self) -> bytes:
+        self.__buffer.seek(0)
+        return self.__buffer.read()
+
+
+class FileDownloader:
+    """
+    Потоковое скачивание файлов из Telegram.
+
+    Размер проверяется до скачивания и по мере получения данных, файл пишется в буфер, который
+    при превышении spool_max_memory переносится на диск. Одновременно обрабатывается не больше
+    max_concurrent_files файлов, остальные ждут, поэтому память под файлы ограничена при любой нагрузке
+    """
+
+    def __init__(self, bot: AsyncTeleBot, settings: UploadSettings | None = None) -> None:
+        self.bot = bot
+        self.settings = settings if settings else upload_settings
+        self.__semaphore = asyncio.Semaphore(self.settings.max_concurrent_files)
+
+    def __check_size(self, size: int | None) -> None:
+        if size is not None and size > self.settings.max_file_size:
+            raise FileTooLargeError(size, self.settings.max_file_size)
+
+    def __file_url(self, file_path: str) -> str:
+        url = asyncio_helper.FILE_URL if asyncio_helper.FILE_URL else 'https://api.telegram.org/file/bot{0}/{1}'
+        return url.format(self.bot.token, file_path)
+
+    @asynccontextmanager
+    async def download(self, file_id: str, file_size: int | None = None) -> AsyncIterator[DownloadedFile]:
+        """
+        Скачивание файла, место в лимите одновременных файлов занято, пока открыт контекст
+
+        :param file_id: id файла в Telegram
+        :param file_size: размер файла из сообщения, если известен
+
+        :return: контекст со скачанным файлом
+        :raises FileTooLargeError: если файл больше max_file_size
+        """
+        self.__check_size(file_size)
+        async with self.__semaphore:
+            file_info = await self.bot.get_file(file_id)
+            self.__check_size(file_info.file_size)
+            with SpooledTemporaryFile(max_size=self.settings.spool_max_memory) as buffer:
+                digest = hashlib.sha256()
+                size = 0
+                session = await asyncio_helper.session_manager.get_session()
+                async with session.get(self.__file_url(file_info.file_path), proxy=asyncio_helper.proxy) as resp:
+                    if resp.status != 200:
+                        raise asyncio_helper.ApiHTTPException('Download file', resp)
+                    self.__check_size(resp.content_length)
+                    async for chunk in resp.content.iter_chunked(self.settings.chunk_size):
+                        size += len(chunk)
+                        self.__check_size(size)
+                        digest.update(chunk)
+                        buffer.write(chunk)
+                yield DownloadedFile(buffer, size, digest.hexdigest())
@@ -1,39 +1,328 @@
-import pytesseract
-import cv2
-import os
-import io
-import numpy as np
-from PIL import Image
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+
+from common import ocr_settings, OcrSettings, preprocess_settings, PreprocessSettings
+from services.metrics import metrics_registry, ocr_duration, ocr_queue_wait, tracer
+from services.ocr_layout import (field_value, group_phrases, pair_fields, same_label, LayoutTemplate,
+                                 RUN_REPORT_FIELDS, VALUE_PATTERN)
+
+
+# text - распознавание всего текста и разбор строк, layout - извлечение полей по рамкам слов
+OCR_ENGINES = ('text', 'layout')
+
+
+class OcrQueueFullError(Exception):
+    """
+    Очередь распознавания изображений переполнена
+    """
+
+
+class OcrEngineError(Exception):
+    """
+    Ошибка запуска tesseract в рабочем процессе
+    """
+
+
+class ImageTooLargeError(ValueError):
+    """
+    Размер изображения превышает допустимое количество пикселей
+    """
+
+
+class ImageDecodeError(ValueError):
+    """
+    Файл не является изображением или поврежден
+    """
+
+
+# cv2, numpy и pytesseract (вместе с PIL) импортируются только в рабочих процессах распознавания,
+# чтобы не увеличивать время запуска и память основного процесса бота
+def _warm_up_worker() -> None:
+    # загрузка библиотек и tesseract в процесс заранее, чтобы первое распознавание не платило за старт
+    import pytesseract
+    import services.image_preprocessor  # noqa: F401
+    try:
+        pytesseract.get_tesseract_version()
+    except pytesseract.TesseractNotFoundError as exc:
+        raise OcrEngineError(str(exc)) from None
+
+
+def _parse_image_bytes(image_bytes: bytes, lang: str, preprocess: PreprocessSettings) -> str:
+    import pytesseract
+    from services.image_preprocessor import ImagePreprocessor
+
+    image = ImagePreprocessor(preprocess).process(image_bytes)
+    try:
+        return pytesseract.image_to_string(image, lang=lang)
+    except pytesseract.TesseractNotFoundError as exc:
+        # TesseractNotFoundError не восстанавливается из pickle и ломает весь пул процессов
+        raise OcrEngineError(str(exc)) from None
+
+
+def _read_template(image, template: LayoutTemplate, lang: str) -> dict[str, str] | None:
+    """
+    Распознавание полей только в областях шаблона
+
+    :return: поля или None, если скриншот не совпал с шаблоном
+    """
+    import pytesseract
+
+    # подписи проверяются до чтения значений: скриншот другого приложения того же размера
+    # иначе был бы разобран по чужим областям
+    for label, (left, top, right, bottom) in template.label_boxes().items():
+        text: str = pytesseract.image_to_string(image[top:bottom, left:right], lang=lang, config='--psm 7')
+        if not same_label(text, label):
+            return None
+    fields: dict[str, str] = {}
+    for label, (left, top, right, bottom) in template.boxes().items():
+        # одна строка текста в области значения
+        text = pytesseract.image_to_string(image[top:bottom, left:right], lang=lang, config='--psm 7')
+        if not VALUE_PATTERN.search(text):
+            return None
+        fields[label] = field_value(text)
+    return fields
+
+
+def _parse_image_fields(image_bytes: bytes,
+                        lang: str,
+                        preprocess: PreprocessSettings,
+                        templates: list[LayoutTemplate],
+                        required: tuple[str, ...]
+                        ) -> tuple[dict[str, str], LayoutTemplate | None]:
+    """
+    Извлечение полей по расположению слов. Шаблоны того же размера проверяются по областям подписей,
+    и при совпадении распознаются только области значений, иначе весь скриншот с рамками слов.
+    Новый шаблон строится, только если на скриншоте найдены все обязательные поля
+
+    :return: поля и использованный или новый шаблон, None - шаблона нет
+    """
+    import pytesseract
+    from services.image_preprocessor import ImagePreprocessor
+
+    image = ImagePreprocessor(preprocess).process(image_bytes)
+    size: tuple[int, int] = (image.shape[1], image.shape[0])
+    try:
+        for template in templates:
+            if template.size != size:
+                continue
+            fields: dict[str, str] | None = _read_template(image, template, lang)
+            if fields is not None:
+                return fields, template
+        data: dict = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    except pytesseract.TesseractNotFoundError as exc:
+        raise OcrEngineError(str(exc)) from None
+    pairs = pair_fields(group_phrases(data))
+    fields = {label.text: field_value(value.text) for label, value in pairs}
+    complete: bool = all(field in fields for field in required)
+    return fields, LayoutTemplate.from_pairs(size, pairs) if pairs and complete else None
+
+
+def _run_timed(func: Callable, *args):
+    # время начала передается в основной процесс, чтобы посчитать ожидание свободного процесса
+    started_at = time.time()
+    result = func(*args)
+    return result, started_at, time.time() - started_at
 
 
 class ImageOperator:
+    """
+    Класс для распознавания текста на изображениях.
+    Распознавание выполняется в пуле процессов, чтобы не блокировать цикл событий бота.
+    Пул, потерявший процесс (нехватка памяти, падение tesseract), пересоздается при следующем распознавании,
+    пул с max_hung_jobs задачами, не завершившимися за timeout, перезапускается с остановкой процессов
+    """
+
+    def __init__(self,
+                 settings: OcrSettings | None = None,
+                 preprocess: PreprocessSettings | None = None) -> None:
+        self.__settings = settings if settings else ocr_settings
+        self.__preprocess = preprocess if preprocess else preprocess_settings
+        if self.__settings.engine not in OCR_ENGINES:
+            raise ValueError(f'Unknown OCR engine "{self.__settings.engine}", expected one of {OCR_ENGINES}')
+        self.__executor: ProcessPoolExecutor | None = None
+        self.__pending: int = 0
+        # задачи, ожидание которых прервано по таймауту, но все еще занимающие процесс
+        self.__hung: set[Future] = set()
+        self.__layouts: OrderedDict[tuple, LayoutTemplate] = OrderedDict()
+        metrics_registry.gauge('ocr_pending_jobs', 'OCR jobs submitted and not finished', lambda: self.__pending)
+
+    def start(self) -> None:
+        """
+        Запуск пула процессов и прогрев всех рабочих процессов
+        """
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(max_workers=self.__settings.workers)
+            for _ in range(self.__settings.workers):
+                self.__executor.submit(_warm_up_worker)
+
+    def warm_up(self) -> None:
+        """
+        Запуск пула процессов при старте бота, если прогрев включен в настройках,
+        иначе пул запускается при первом распознавании
+        """
+        if self.__settings.warm_up:
+            self.start()
+
+    def close(self) -> None:
+        """
+        Остановка пула процессов, незапущенные задачи отменяются
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+    def __recycle(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Остановка пула с принудительным завершением процессов: shutdown не прерывает выполняющиеся задачи.
+        Задачи пула завершаются ошибкой и освобождают места в очереди, новый пул создается при следующем вызове
+        """
+        if executor is not self.__executor:
+            return
+        self.__executor = None
+        self.__hung.clear()
+        # у ProcessPoolExecutor нет публичного способа остановить выполняющиеся задачи
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.kill()
+
+    def __mark_hung(self, loop: asyncio.AbstractEventLoop, executor: ProcessPoolExecutor, future: Future) -> None:
+        # задача, не начавшая выполняться, отменяется вместе с ожиданием
+        if not future.running():
+            return
+        self.__hung.add(future)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.__hung.discard, future))
+        if len(self.__hung) >= (self.__settings.max_hung_jobs or self.__settings.workers):
+            logging.warning(f'{len(self.__hung)} OCR jobs exceeded timeout, restarting OCR workers')
+            self.__recycle(executor)
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    @property
+    def workers(self) -> int:
+        return self.__settings.workers
+
+    @property
+    def engine(self) -> str:
+        return self.__settings.engine
+
+    def __release(self) -> None:
+        self.__pending -= 1
+
+    async def __run(self, span_name: str, func: Callable, *args):
+        if self.__pending >= self.__settings.max_pending:
+            raise OcrQueueFullError(f'OCR queue is full ({self.__pending} pending jobs)')
+        self.start()
+        executor: ProcessPoolExecutor = self.__executor
+        loop = asyncio.get_running_loop()
+        with tracer.start_as_current_span(span_name):
+            submitted_at = time.time()
+            try:
+                future = executor.submit(_run_timed, func, *args)
+            except BrokenProcessPool:
+                logging.error('OCR worker process died, restarting OCR workers')
+                self.__recycle(executor)
+                raise
+            # место в очереди освобождается только по завершении задачи в процессе, а не по таймауту ожидания
+            self.__pending += 1
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.__release))
+            try:
+                result, started_at, duration = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                                      timeout=self.__settings.timeout)
+            except BrokenProcessPool:
+                logging.error('OCR worker process died, restarting OCR workers')
+                self.__recycle(executor)
+                raise
+            except asyncio.TimeoutError:
+                self.__mark_hung(loop, executor, future)
+                raise
+        ocr_queue_wait.observe(max(started_at - submitted_at, 0.0))
+        ocr_duration.observe(duration)
+        return result
+
+    async def parse_image_bytes(self, image_bytes: bytes) -> str:
+        """
+        Асинхронное распознавание текста на изображении в пуле процессов
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :return: распознанный текст
+
+        :raises OcrQueueFullError: если в очереди уже max_pending задач
+        :raises ImageTooLargeError: если изображение больше max_pixels
+        :raises ImageDecodeError: если файл не является изображением
+        :raises asyncio.TimeoutError: если распознавание не уложилось в timeout
+        :raises BrokenProcessPool: если процесс распознавания завершился аварийно
+        """
+        return await self.__run('ocr', _parse_image_bytes, image_bytes, self.__settings.lang, self.__preprocess)
+
+    def __templates(self) -> list[LayoutTemplate]:
+        # недавно использованные шаблоны проверяются первыми
+        return list(reversed(self.__layouts.values()))
+
+    def __remember_layout(self, template: LayoutTemplate | None) -> None:
+        if template is None:
+            return
+        self.__layouts[template.signature] = template
+        self.__layouts.move_to_end(template.signature)
+        while len(self.__layouts) > self.__settings.max_layouts:
+            self.__layouts.popitem(last=False)
+
+    async def parse_image_fields(self,
+                                 image_bytes: bytes,
+                                 required: tuple[str, ...] = RUN_REPORT_FIELDS) -> dict[str, str]:
+        """
+        Асинхронное извлечение полей скриншота по расположению подписей и значений в пуле процессов.
+        Шаблоны расположения запоминаются по размеру изображения и набору подписей, и следующие скриншоты,
+        подписи которых совпали с шаблоном, распознаются только в областях подписей и значений
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :param required: подписи полей, без которых шаблон не сохраняется
+        :return: значения по подписям полей
+
+        :raises OcrQueueFullError: если в очереди уже max_pending задач
+        :raises ImageTooLargeError: если изображение больше max_pixels
+        :raises ImageDecodeError: если файл не является изображением
+        :raises asyncio.TimeoutError: если распознавание не уложилось в timeout
+        :raises BrokenProcessPool: если процесс распознавания завершился аварийно
+        """
+        fields, template = await self.__run('ocr fields', _parse_image_fields, image_bytes, self.__settings.lang,
+                                            self.__preprocess, self.__templates(), required)
+        self.__remember_layout(template)
+        return fields
+
+    def parse_image_to_string(self, image_bytes: bytes, preprocess: str | None = None) -> str:
+        """
+        Синхронное распознавание текста на изображении в текущем процессе
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :param preprocess: режим предварительной обработки ('none', 'gray', 'thresh', 'blur'),
+            по умолчанию из настроек
+        :return: распознанный текст
+        """
+        settings = self.__preprocess.model_copy(update={'mode': preprocess}) if preprocess else self.__preprocess
+        return _parse_image_bytes(image_bytes, self.__settings.lang, settings)
+
+    def parse_image_to_fields(self,
+                              image_bytes: bytes,
+                              use_layouts: bool = True,
+                              required: tuple[str, ...] = RUN_REPORT_FIELDS) -> dict[str, str]:
+        """
+        Синхронное извлечение полей скриншота в текущем процессе
 
-    def parse_image_to_string(self, image, preprocess: str = 'thresh') -> str:
-        # загрузить образ и преобразовать его в оттенки серого
-        # image = cv2.imread(image)
-        # gray: np.ndarray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        #
-        # # проверьте, следует ли применять пороговое значение для предварительной обработки изображения
-        # if preprocess == "thresh":
-        #     gray = cv2.threshold(gray, 0, 255,
-        #                          cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-        # # если нужно медианное размытие, чтобы удалить шум
-        # elif preprocess == "blur":
-        #     gray = cv2.medianBlur(gray, 3)
-        #
-        # success, encoded_image = cv2.imencode('.jpg', gray)
-        # buffer = io.BytesIO(encoded_image.tobytes())
-        #
-        # # загрузка изображения в виде объекта image Pillow, применение OCR, а затем удаление временного файла
-        # text = pytesseract.image_to_string(Image.open(buffer), lang='rus')
-
-        text = pytesseract.image_to_string(image, lang='rus')
-        return text
-
-# image_operator = ImageOperator()
-#
-# path = '/Users/zhbankov.da/telegram_bot_notionAPI/app/test.jpeg'
-#
-# text = image_operator.parse_image_to_string(path)
-#
-# print(image_operator.convert_string_to_data(text))
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :param use_layouts: использовать и пополнять кэш шаблонов расположения
+        :param required: подписи полей, без которых шаблон не сохраняется
+        :return: значения по подписям полей
+        """
+        fields, template = _parse_image_fields(image_bytes, self.__settings.lang, self.__preprocess,
+                                               self.__templates() if use_layouts else [], required)
+        if use_layouts:
+            self.__remember_layout(template)
+        return fields
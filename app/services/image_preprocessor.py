@@ -0,0 +1,125 @@
+import io
+
+import cv2
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+from common import preprocess_settings, PreprocessSettings
+from services.image_operator import ImageDecodeError, ImageTooLargeError
+
+
+PREPROCESS_MODES = ('none', 'gray', 'thresh', 'blur')
+
+# флаги декодирования с уменьшением в 2, 4 или 8 раз: для jpeg уменьшение выполняется прямо при декодировании
+REDUCED_FLAGS = {
+    (False, 1): cv2.IMREAD_GRAYSCALE, (False, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (False, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4, (False, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    (True, 1): cv2.IMREAD_COLOR, (True, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (True, 4): cv2.IMREAD_REDUCED_COLOR_4, (True, 8): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class ImagePreprocessor:
+    """
+    Класс предварительной обработки скриншотов перед распознаванием.
+    Вся обработка выполняется над буферами в памяти, без повторного кодирования изображения
+    """
+
+    def __init__(self, settings: PreprocessSettings | None = None) -> None:
+        self.settings = settings if settings else preprocess_settings
+        if self.settings.mode not in PREPROCESS_MODES:
+            raise ValueError(f'Unknown preprocess mode "{self.settings.mode}", expected one of {PREPROCESS_MODES}')
+
+    @staticmethod
+    def size(image_bytes: bytes) -> tuple[int, int]:
+        """
+        Размер изображения по заголовку, без декодирования
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :return: ширина и высота
+
+        :raises ImageTooLargeError: если размер в заголовке превышает защиту PIL от decompression bomb
+        :raises ImageDecodeError: если файл не является изображением
+        """
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                return image.size
+        except Image.DecompressionBombError as exc:
+            raise ImageTooLargeError(str(exc)) from None
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            raise ImageDecodeError('Cannot decode image') from None
+
+    def reduction(self, width: int) -> int:
+        """
+        Во сколько раз можно уменьшить изображение при декодировании, чтобы область распознавания
+        осталась не уже целевой ширины
+
+        :param width: ширина исходного изображения
+        :return: 1, 2, 4 или 8
+        """
+        if not self.settings.target_width:
+            return 1
+        roi_width = width * (self.settings.roi_right - self.settings.roi_left)
+        return next((factor for factor in (8, 4, 2) if roi_width / factor >= self.settings.target_width), 1)
+
+    def decode(self, image_bytes: bytes) -> np.ndarray:
+        """
+        Декодирование изображения из байтов, для всех режимов кроме 'none' сразу в оттенки серого.
+        Размер проверяется по заголовку до декодирования, большие изображения уменьшаются при декодировании
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :return: изображение в виде массива numpy
+
+        :raises ImageTooLargeError: если в изображении больше max_pixels пикселей
+        :raises ImageDecodeError: если файл не является изображением
+        """
+        width, height = self.size(image_bytes)
+        if width * height > self.settings.max_pixels:
+            raise ImageTooLargeError(f'Image {width}x{height} exceeds {self.settings.max_pixels} pixels')
+        flags = REDUCED_FLAGS[(self.settings.mode == 'none', self.reduction(width))]
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+        if image is None:
+            raise ImageDecodeError('Cannot decode image')
+        return image
+
+    def crop(self, image: np.ndarray) -> np.ndarray:
+        """
+        Обрезка изображения до области с результатами тренировки
+
+        :param image: изображение
+        :return: срез исходного массива без копирования
+        """
+        height, width = image.shape[:2]
+        return image[int(height * self.settings.roi_top):int(height * self.settings.roi_bottom),
+                     int(width * self.settings.roi_left):int(width * self.settings.roi_right)]
+
+    def resize(self, image: np.ndarray) -> np.ndarray:
+        """
+        Уменьшение изображения до целевой ширины, изображения меньше целевой ширины не меняются
+
+        :param image: изображение
+        :return: уменьшенное изображение
+        """
+        height, width = image.shape[:2]
+        if not self.settings.target_width or width <= self.settings.target_width:
+            return image
+        scale = self.settings.target_width / width
+        return cv2.resize(image, (self.settings.target_width, int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    def process(self, image_bytes: bytes) -> np.ndarray:
+        """
+        Полный цикл обработки: декодирование, обрезка, уменьшение, пороговая обработка или размытие
+
+        :param image_bytes: изображение в закодированном виде (jpeg, png)
+        :return: изображение, готовое к распознаванию
+        """
+        image = self.resize(self.crop(self.decode(image_bytes)))
+        match self.settings.mode:
+            case 'thresh':
+                image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+            case 'blur':
+                # медианное размытие, чтобы удалить шум
+                image = cv2.medianBlur(image, 3)
+            case 'none':
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from telebot.types import Message
+
+from common import bot_settings, BotSettings
+
+
+class MediaGroupCollector:
+    """
+    Сбор сообщений альбома (media group) Telegram.
+
+    Сообщения альбома приходят отдельными обновлениями, поэтому они копятся по media_group_id,
+    и обработчик вызывается один раз для всего альбома, когда новые сообщения перестают приходить
+    дольше media_group_debounce или альбом достиг media_group_max_size
+    """
+
+    def __init__(self,
+                 handler: Callable[[list[Message]], Awaitable],
+                 settings: BotSettings | None = None) -> None:
+        self.__handler = handler
+        self.settings = settings if settings else bot_settings
+        self.__groups: dict[str, list[Message]] = {}
+        self.__timers: dict[str, asyncio.TimerHandle] = {}
+        self.__tasks: set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self.__groups)
+
+    def add(self, message: Message) -> None:
+        """
+        Добавление сообщения в альбом
+
+        :param message: сообщение с media_group_id
+        """
+        group_id: str = message.media_group_id
+        messages: list[Message] = self.__groups.setdefault(group_id, [])
+        messages.append(message)
+        timer: asyncio.TimerHandle | None = self.__timers.pop(group_id, None)
+        if timer is not None:
+            timer.cancel()
+        if len(messages) >= self.settings.media_group_max_size:
+            self.__flush(group_id)
+        else:
+            self.__timers[group_id] = asyncio.get_running_loop().call_later(
+                self.settings.media_group_debounce, self.__flush, group_id)
+
+    def __flush(self, group_id: str) -> None:
+        self.__timers.pop(group_id, None)
+        messages: list[Message] = sorted(self.__groups.pop(group_id), key=lambda message: message.message_id)
+        task: asyncio.Task = asyncio.create_task(self.__handler(messages))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__done)
+
+    def __done(self, task: asyncio.Task) -> None:
+        self.__tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error('Media group processing failed', exc_info=task.exception())
+
+    async def close(self) -> None:
+        """
+        Обработка уже собранных альбомов без ожидания и завершение начатой обработки
+        """
+        for group_id in list(self.__timers):
+            self.__timers[group_id].cancel()
+            self.__flush(group_id)
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
@@ -0,0 +1,235 @@
+import logging
+import math
+import re
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from aiohttp import web
+from opentelemetry import trace
+
+from common import metrics_settings, MetricsSettings
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+tracer = trace.get_tracer('telegram_bot_notionAPI')
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    body = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    return f'{{{body}}}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    type_name: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    @abstractmethod
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        """
+        Значения метрики для экспорта
+
+        :return: имя, метки и значение каждого ряда
+        """
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Монотонно растущий счетчик
+    """
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.__values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self.__values[key] = self.__values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self.__values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for key, value in self.__values.items():
+            yield f'{self.name}_total', self._labels(key), value
+
+
+class Gauge(Metric):
+    """
+    Текущее значение, вычисляемое при каждом чтении метрик
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        yield self.name, {}, self.callback()
+
+
+class Histogram(Metric):
+    """
+    Гистограмма значений, например длительностей в секундах
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.__counts: dict[tuple[str, ...], list[int]] = {}
+        self.__sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self.__counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.__sums[key] = self.__sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[dict[str, str]]:
+        """
+        Измерение длительности блока, метки можно дополнить внутри блока через возвращаемый словарь
+        """
+        labels = dict(labels)
+        started_at = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def count(self, **labels) -> int:
+        counts = self.__counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for key, counts in self.__counts.items():
+            labels = self._labels(key)
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', labels | {'le': _format_value(bound)}, count
+            yield f'{self.name}_sum', labels, self.__sums[key]
+            yield f'{self.name}_count', labels, counts[-1]
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик приложения в формате Prometheus
+    """
+
+    def __init__(self) -> None:
+        self.__metrics: dict[str, Metric] = {}
+
+    def __register(self, metric: Metric) -> Metric:
+        existing = self.__metrics.get(metric.name)
+        if existing is not None and not isinstance(metric, Gauge):
+            return existing
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.__register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> Gauge:
+        """
+        Регистрация показателя, при повторной регистрации с тем же именем используется последний callback
+        """
+        return self.__register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.__metrics.values()) + '\n'
+
+
+metrics_registry: MetricsRegistry = MetricsRegistry()
+
+notion_request_duration = metrics_registry.histogram(
+    'notion_request_duration_seconds', 'Notion API request latency', ('method', 'endpoint', 'status'))
+handler_duration = metrics_registry.histogram(
+    'bot_handler_duration_seconds', 'Telegram handler latency', ('handler',))
+dispatch_queue_delay = metrics_registry.histogram(
+    'bot_dispatch_queue_delay_seconds', 'Delay between update arrival and handler start', ('lane',))
+ocr_duration = metrics_registry.histogram(
+    'ocr_duration_seconds', 'OCR duration inside a worker process')
+ocr_queue_wait = metrics_registry.histogram(
+    'ocr_queue_wait_seconds', 'Time an OCR job waits for a worker process')
+chart_render_duration = metrics_registry.histogram(
+    'chart_render_duration_seconds', 'Chart rendering duration inside a worker process')
+cache_requests = metrics_registry.counter(
+    'cache_requests', 'Cache lookups by result', ('cache', 'result'))
+
+_UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}')
+
+
+def endpoint_label(path: str) -> str:
+    """
+    Шаблон пути запроса для метки метрики: id заменяются на {id}, чтобы не плодить метки
+
+    :param path: путь запроса
+    :return: шаблон пути
+    """
+    return _UUID_PATTERN.sub('{id}', path)
+
+
+class MetricsServer:
+    """
+    HTTP сервер, отдающий метрики на /metrics
+    """
+
+    def __init__(self, registry: MetricsRegistry | None = None, settings: MetricsSettings | None = None) -> None:
+        self.registry = registry if registry else metrics_registry
+        self.settings = settings if settings else metrics_settings
+        self.__runner: web.AppRunner | None = None
+
+    async def __handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self) -> None:
+        if not self.settings.enabled or self.__runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.__handle_metrics)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.settings.host, self.settings.port).start()
+        logging.info(f'Metrics server listening on {self.settings.host}:{self.settings.port}/metrics')
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from uuid import UUID
+
+from common import mirror_settings, MirrorSettings
+from services.database_lister import DatabaseLister
+from services.database_operator import DatabaseOperator
+from services.request_operator import RequestOperator
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS databases (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    synced_until TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    database_id TEXT NOT NULL,
+    date TEXT,
+    last_edited_time TEXT NOT NULL,
+    properties TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_database_date ON records (database_id, date DESC);
+"""
+
+
+class NotionMirror:
+    """
+    Локальная копия баз данных тренировок в SQLite.
+
+    Базы данных синхронизируются инкрементально: записи запрашиваются в порядке убывания last_edited_time,
+    пока не встретится запись, уже сохраненная при прошлой синхронизации.
+    Удаленные в Notion записи убираются только при принудительном обновлении
+    """
+
+    def __init__(self,
+                 request_operator: RequestOperator,
+                 database_lister: DatabaseLister,
+                 settings: MirrorSettings | None = None) -> None:
+        self.settings = settings if settings else mirror_settings
+        self.__database_operator = DatabaseOperator(request_operator=request_operator)
+        self.__database_lister = database_lister
+        self.__connection: sqlite3.Connection | None = None
+        self.__lock = asyncio.Lock()
+        self.__sync_task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.enabled
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.settings.path, check_same_thread=False)
+            self.__connection.executescript(SCHEMA)
+        return self.__connection
+
+    async def __execute(self, func, *args):
+        # sqlite вызывается в отдельном потоке, запросы к соединению выполняются по очереди
+        async with self.__lock:
+            return await asyncio.to_thread(func, self.__connect(), *args)
+
+    @staticmethod
+    def __record_row(database_id: UUID, record: dict) -> tuple:
+        date_field: dict | None = record.get('properties', {}).get('Дата', {}).get('date')
+        return (record.get('id'), str(database_id), date_field.get('start') if date_field else None,
+                record.get('last_edited_time'), json.dumps(record.get('properties'), ensure_ascii=False))
+
+    @staticmethod
+    def __get_synced_until(connection: sqlite3.Connection, database_id: str) -> str | None:
+        row = connection.execute('SELECT synced_until FROM databases WHERE id = ?', (database_id,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def __save(connection: sqlite3.Connection, database_id: str, title: str, rows: list[tuple],
+               synced_until: str | None, full: bool) -> None:
+        with connection:
+            if full:
+                connection.execute('DELETE FROM records WHERE database_id = ?', (database_id,))
+            connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', rows)
+            connection.execute('INSERT INTO databases (id, title, synced_until) VALUES (?, ?, ?) '
+                               'ON CONFLICT (id) DO UPDATE SET title = excluded.title, '
+                               'synced_until = COALESCE(excluded.synced_until, databases.synced_until)',
+                               (database_id, title, synced_until))
+
+    @staticmethod
+    def __upsert(connection: sqlite3.Connection, row: tuple) -> None:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', row)
+
+    @staticmethod
+    def __select_last_record(connection: sqlite3.Connection, database_id: str) -> tuple | None:
+        if connection.execute('SELECT 1 FROM databases WHERE id = ? AND synced_until IS NOT NULL',
+                              (database_id,)).fetchone() is None:
+            return None
+        return connection.execute('SELECT id, last_edited_time, properties FROM records WHERE database_id = ? '
+                                  'ORDER BY date DESC LIMIT 1', (database_id,)).fetchone()
+
+    async def sync_database(self, database_id: UUID, title: str, full: bool = False) -> int:
+        """
+        Синхронизация одной базы данных
+
+        :param database_id: id базы данных
+        :param title: название базы данных
+        :param full: полная перезагрузка записей базы данных
+
+        :return: количество полученных записей
+        """
+        synced_until: str | None = None if full else await self.__execute(self.__get_synced_until, str(database_id))
+        records, newest = await self.__database_operator.get_records_edited_since(database_id, synced_until)
+        rows: list[tuple] = [self.__record_row(database_id, record) for record in records]
+        await self.__execute(self.__save, str(database_id), title, rows, newest or synced_until or '', full)
+        logging.info(f'Mirror synced {len(rows)} records of database with id {database_id}')
+        return len(rows)
+
+    async def sync_all(self, full: bool = False) -> None:
+        """
+        Синхронизация всех баз данных тренировок
+
+        :param full: полная перезагрузка записей
+        """
+        workout_databases: dict[UUID, str] = await self.__database_lister.get_workout_databases()
+        for database_id, title in workout_databases.items():
+            try:
+                await self.sync_database(database_id, title, full=full)
+            except Exception as exc:
+                logging.warning(f'Mirror sync of database with id {database_id} failed: {exc!r}')
+
+    async def force_refresh(self) -> None:
+        """
+        Принудительное полное обновление копии, включая список баз данных
+        """
+        self.__database_lister.invalidate_cache()
+        await self.sync_all(full=True)
+
+    async def upsert_record(self, database_id: UUID, record: dict) -> None:
+        """
+        Сохранение записи, созданной или измененной ботом, не дожидаясь следующей синхронизации
+
+        :param database_id: id базы данных
+        :param record: запись в необработанном виде из ответа Notion
+        """
+        if not self.enabled:
+            return
+        await self.__execute(self.__upsert, self.__record_row(database_id, record))
+
+    async def get_last_record(self, database_id: UUID) -> dict | None:
+        """
+        Получение последней по дате записи базы данных из локальной копии
+
+        :param database_id: id базы данных
+        :return: запись в необработанном виде (id, last_edited_time, properties)
+            или None, если база данных еще не синхронизирована или пуста
+        """
+        if not self.enabled:
+            return None
+        row: tuple | None = await self.__execute(self.__select_last_record, str(database_id))
+        if row is None:
+            return None
+        return {'id': row[0], 'last_edited_time': row[1], 'properties': json.loads(row[2])}
+
+    async def __sync_forever(self) -> None:
+        while True:
+            # ошибка получения списка баз не должна останавливать синхронизацию до перезапуска бота
+            try:
+                await self.sync_all()
+            except Exception as exc:
+                logging.warning(f'Mirror sync failed: {exc!r}')
+            await asyncio.sleep(self.settings.sync_interval)
+
+    def start(self) -> None:
+        """
+        Запуск фоновой синхронизации
+        """
+        if self.enabled and self.__sync_task is None:
+            self.__sync_task = asyncio.create_task(self.__sync_forever())
+
+    async def close(self) -> None:
+        """
+        Остановка фоновой синхронизации и закрытие базы данных
+        """
+        if self.__sync_task is not None:
+            self.__sync_task.cancel()
+            await asyncio.gather(self.__sync_task, return_exceptions=True)
+            self.__sync_task = None
+        if self.__connection is not None:
+            async with self.__lock:
+                self.__connection.close()
+                self.__connection = None
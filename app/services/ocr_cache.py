@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from common import cache_settings, coordination_settings
+from services.coordination import CoordinationBackend
+from services.metrics import cache_requests
+
+
+class OcrResultCache:
+    """
+    Кэш результатов распознавания скриншотов.
+
+    Ключ - хэш содержимого изображения, дополнительно результат доступен по file_unique_id Telegram,
+    чтобы повторно присланный файл не приходилось даже скачивать.
+    В памяти хранятся последние max_entries результатов, при заданном disk_path результаты сохраняются на диск.
+    При заданном общем хранилище результаты доступны всем процессам бота
+    """
+
+    def __init__(self,
+                 max_entries: int | None = None,
+                 disk_path: str | None = None,
+                 backend: CoordinationBackend | None = None) -> None:
+        self.backend = backend
+        self.max_entries = max_entries if max_entries else cache_settings.ocr_max_entries
+        disk_path = disk_path if disk_path else cache_settings.ocr_disk_path
+        self.__disk_path: Path | None = Path(disk_path) if disk_path else None
+        if self.__disk_path is not None:
+            self.__disk_path.mkdir(parents=True, exist_ok=True)
+        self.__entries: OrderedDict[str, dict] = OrderedDict()
+
+    @staticmethod
+    def content_key(image_bytes: bytes) -> str:
+        """
+        Ключ кэша по содержимому изображения
+
+        :param image_bytes: изображение в закодированном виде
+        :return: sha256 содержимого
+        """
+        return OcrResultCache.digest_key(hashlib.sha256(image_bytes).hexdigest())
+
+    @staticmethod
+    def digest_key(sha256: str) -> str:
+        """
+        Ключ кэша по уже посчитанному хэшу содержимого, например при потоковом скачивании
+
+        :param sha256: sha256 содержимого в шестнадцатеричном виде
+        :return: ключ кэша
+        """
+        return f'sha256_{sha256}'
+
+    @staticmethod
+    def file_key(file_unique_id: str) -> str:
+        """
+        Ключ кэша по file_unique_id Telegram
+
+        :param file_unique_id: постоянный id файла в Telegram
+        :return: ключ кэша
+        """
+        return f'file_{file_unique_id}'
+
+    def __remember(self, key: str, data: dict) -> None:
+        self.__entries[key] = data
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def __read_disk(self, key: str) -> dict | None:
+        try:
+            return json.loads((self.__disk_path / f'{key}.json').read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logging.warning(f'Cannot read OCR cache entry {key}: {exc!r}')
+            return None
+
+    def __write_disk(self, keys: list[str], data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False)
+        for key in keys:
+            tmp_path = self.__disk_path / f'{key}.json.tmp'
+            tmp_path.write_text(body, encoding='utf-8')
+            tmp_path.replace(self.__disk_path / f'{key}.json')
+
+    async def get(self, key: str) -> dict | None:
+        """
+        Получение результата распознавания по ключу
+
+        :param key: ключ из content_key или file_key
+        :return: результат распознавания или None
+        """
+        data = self.__entries.get(key)
+        if data is not None:
+            self.__entries.move_to_end(key)
+            cache_requests.inc(cache='ocr', result='hit')
+            return data
+        if self.backend is not None:
+            value: bytes | None = await self.backend.get(f'ocr:{key}')
+            if value is not None:
+                data = json.loads(value)
+                self.__remember(key, data)
+                cache_requests.inc(cache='ocr', result='shared_hit')
+                return data
+        if self.__disk_path is not None:
+            data = await asyncio.to_thread(self.__read_disk, key)
+        if data is not None:
+            self.__remember(key, data)
+            cache_requests.inc(cache='ocr', result='disk_hit')
+        else:
+            cache_requests.inc(cache='ocr', result='miss')
+        return data
+
+    async def put(self, data: dict, content_key: str, file_unique_id: str | None = None) -> None:
+        """
+        Сохранение результата распознавания
+
+        :param data: результат распознавания
+        :param content_key: ключ содержимого изображения из content_key
+        :param file_unique_id: постоянный id файла в Telegram
+        """
+        keys: list[str] = [content_key]
+        if file_unique_id:
+            keys.append(self.file_key(file_unique_id))
+        for key in keys:
+            self.__remember(key, data)
+        if self.backend is not None:
+            value = json.dumps(data, ensure_ascii=False).encode()
+            for key in keys:
+                await self.backend.set(f'ocr:{key}', value, ttl=coordination_settings.cache_ttl)
+        if self.__disk_path is not None:
+            try:
+                await asyncio.to_thread(self.__write_disk, keys, data)
+            except OSError as exc:
+                logging.warning(f'Cannot write OCR cache entry {keys[0]}: {exc!r}')
@@ -0,0 +1,171 @@
+import re
+import statistics
+
+
+# подпись поля начинается с заглавной кириллической буквы, значение содержит цифру
+LABEL_PATTERN = re.compile(r'^[А-ЯЁ]')
+VALUE_PATTERN = re.compile(r'\d')
+
+# подписи полей скриншота пробежки, без которых запись о тренировке не построить
+RUN_REPORT_FIELDS = ('Сожжено', 'Средний пульс', 'Макс. пульс', 'Время тренировки', 'Время пауз')
+
+
+class Phrase:
+    """
+    Группа соседних слов одной строки распознанного текста с общей рамкой
+    """
+
+    def __init__(self, words: list[tuple[str, int, int, int, int]]) -> None:
+        """
+        :param words: слова строки в виде (текст, left, top, width, height)
+        """
+        self.text: str = ' '.join(word[0] for word in words)
+        self.left: int = min(word[1] for word in words)
+        self.top: int = min(word[2] for word in words)
+        self.right: int = max(word[1] + word[3] for word in words)
+        self.bottom: int = max(word[2] + word[4] for word in words)
+
+    @property
+    def height(self) -> int:
+        return self.bottom - self.top
+
+    @property
+    def center_x(self) -> float:
+        return (self.left + self.right) / 2
+
+    def is_label(self) -> bool:
+        return bool(LABEL_PATTERN.match(self.text)) and not VALUE_PATTERN.search(self.text)
+
+    def is_value(self) -> bool:
+        return bool(VALUE_PATTERN.search(self.text))
+
+
+def group_phrases(data: dict[str, list]) -> list[Phrase]:
+    """
+    Группировка слов из pytesseract.image_to_data во фразы: слова одной строки объединяются,
+    если промежуток между ними меньше высоты строки, иначе это соседние колонки
+
+    :param data: результат image_to_data с output_type=Output.DICT
+    :return: фразы
+    """
+    lines: dict[tuple[int, int, int], list[tuple[str, int, int, int, int]]] = {}
+    for i, text in enumerate(data['text']):
+        text = text.strip()
+        if not text or float(data['conf'][i]) < 0:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append((text, data['left'][i], data['top'][i], data['width'][i], data['height'][i]))
+
+    phrases: list[Phrase] = []
+    for words in lines.values():
+        words.sort(key=lambda word: word[1])
+        line_height = statistics.median(word[4] for word in words)
+        current: list[tuple[str, int, int, int, int]] = [words[0]]
+        for previous, word in zip(words, words[1:]):
+            if word[1] - (previous[1] + previous[3]) > line_height:
+                phrases.append(Phrase(current))
+                current = []
+            current.append(word)
+        phrases.append(Phrase(current))
+    return phrases
+
+
+def pair_fields(phrases: list[Phrase]) -> list[tuple[Phrase, Phrase]]:
+    """
+    Сопоставление подписей и значений по расположению: значение находится над подписью,
+    ближе всего к ней по вертикали и пересекается с ней по горизонтали
+
+    :param phrases: фразы скриншота
+    :return: пары (подпись, значение)
+    """
+    values: list[Phrase] = [phrase for phrase in phrases if phrase.is_value()]
+    pairs: list[tuple[Phrase, Phrase]] = []
+    used: set[int] = set()
+    for label in sorted((phrase for phrase in phrases if phrase.is_label()), key=lambda phrase: phrase.top):
+        candidates = [
+            (label.top - value.bottom, abs(value.center_x - label.center_x), i)
+            for i, value in enumerate(values)
+            if i not in used and value.bottom <= label.top + label.height / 2
+            and value.left < label.right and label.left < value.right
+        ]
+        if candidates:
+            *_, index = min(candidates)
+            used.add(index)
+            pairs.append((label, values[index]))
+    return pairs
+
+
+def field_value(text: str) -> str:
+    # как и в текстовом разборе, значением поля считается первое слово
+    return text.split()[0] if text.split() else ''
+
+
+def same_label(text: str, label: str) -> bool:
+    # пробелы, знаки препинания и регистр при сравнении подписей не учитываются
+    return re.sub(r'\W+', '', text).lower() == re.sub(r'\W+', '', label).lower()
+
+
+class LayoutTemplate:
+    """
+    Шаблон расположения полей на скриншотах одного приложения и размера экрана.
+
+    Хранит области подписей и значений в долях размера изображения: по шаблону распознаются только
+    эти области, а не весь скриншот. Шаблон различается по сигнатуре - размеру и набору подписей,
+    поэтому скриншоты разных приложений одного размера получают разные шаблоны
+    """
+
+    def __init__(self,
+                 size: tuple[int, int],
+                 labels: dict[str, tuple[float, float, float, float]],
+                 regions: dict[str, tuple[float, float, float, float]]) -> None:
+        """
+        :param size: ширина и высота обработанного изображения
+        :param labels: области подписей полей в виде (left, top, right, bottom) в долях
+        :param regions: области значений по подписям полей в виде (left, top, right, bottom) в долях
+        """
+        self.size = size
+        self.labels = labels
+        self.regions = regions
+
+    @property
+    def signature(self) -> tuple[tuple[int, int], tuple[str, ...]]:
+        return self.size, tuple(sorted(self.regions))
+
+    @classmethod
+    def from_pairs(cls, size: tuple[int, int], pairs: list[tuple[Phrase, Phrase]]) -> 'LayoutTemplate':
+        width, height = size
+        # по ширине область значения захватывает и подпись: значения на других скриншотах бывают длиннее
+        return cls(size,
+                   {label.text: (label.left / width, label.top / height, label.right / width, label.bottom / height)
+                    for label, _ in pairs},
+                   {label.text: (min(value.left, label.left) / width, value.top / height,
+                                 max(value.right, label.right) / width, value.bottom / height)
+                    for label, value in pairs})
+
+    def __to_pixels(self, regions: dict[str, tuple[float, float, float, float]],
+                    padding: float) -> dict[str, tuple[int, int, int, int]]:
+        width, height = self.size
+        boxes: dict[str, tuple[int, int, int, int]] = {}
+        for label, (left, top, right, bottom) in regions.items():
+            pad = (bottom - top) * height * padding
+            boxes[label] = (max(int(left * width - pad), 0), max(int(top * height - pad), 0),
+                            min(int(right * width + pad), width), min(int(bottom * height + pad), height))
+        return boxes
+
+    def label_boxes(self, padding: float = 0.3) -> dict[str, tuple[int, int, int, int]]:
+        """
+        Области подписей в пикселях с запасом по краям, по ним проверяется, что скриншот совпадает с шаблоном
+
+        :param padding: запас в долях высоты области
+        :return: области (left, top, right, bottom) по подписям полей
+        """
+        return self.__to_pixels(self.labels, padding)
+
+    def boxes(self, padding: float = 0.3) -> dict[str, tuple[int, int, int, int]]:
+        """
+        Области значений в пикселях с запасом по краям
+
+        :param padding: запас в долях высоты области
+        :return: области (left, top, right, bottom) по подписям полей
+        """
+        return self.__to_pixels(self.regions, padding)
@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, TYPE_CHECKING
+from uuid import UUID
+
+from common import write_queue_settings, WriteQueueSettings
+from services.database_operator import DatabaseOperator
+from services.metrics import metrics_registry
+from services.request_operator import NotionRequestError, RequestOperator
+
+if TYPE_CHECKING:
+    from services.notion_mirror import NotionMirror
+    from services.tenants import TenantRegistry
+
+
+class PageWriteQueue:
+    """
+    Очередь отложенного создания записей в Notion с журналом на диске.
+
+    Запись принимается мгновенно и сохраняется в журнал, отправка в Notion выполняется в фоне
+    с повторами, по одной задаче на базу данных, поэтому порядок записей в каждой базе сохраняется.
+    Запись, отправка которой была прервана перезапуском, перед повтором ищется в Notion: по ключу,
+    если задан idempotency_property и ключ сохраняется в это текстовое свойство, иначе по значениям всех свойств.
+    Записи пользователей со своим рабочим пространством отправляются через сервисы этого пространства.
+    Созданные записи рабочего пространства из настроек сразу сохраняются в локальную копию баз данных
+    """
+
+    def __init__(self,
+                 request_operator: RequestOperator,
+                 settings: WriteQueueSettings | None = None,
+                 tenants: 'TenantRegistry | None' = None,
+                 mirror: 'NotionMirror | None' = None) -> None:
+        self.settings = settings if settings else write_queue_settings
+        self.__database_operator = DatabaseOperator(request_operator=request_operator)
+        self.__tenants = tenants
+        self.__mirror = mirror
+        self.__path = Path(self.settings.path)
+        self.__path.mkdir(parents=True, exist_ok=True)
+        self.__sequence = itertools.count(time.time_ns())
+        self.__queues: dict[str, asyncio.Queue[Path]] = {}
+        self.__workers: dict[str, asyncio.Task] = {}
+        self.__queued_paths: set[Path] = set()
+        self.__started = False
+        metrics_registry.gauge('write_queue_pending_pages', 'Pages waiting to be created in Notion',
+                               lambda: self.pending)
+
+    @property
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self.__queues.values())
+
+    @staticmethod
+    def __write_entry(path: Path, entry: dict) -> None:
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(entry, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        tmp_path.replace(path)
+
+    @staticmethod
+    def __read_entry(path: Path) -> dict:
+        return json.loads(path.read_text(encoding='utf-8'))
+
+    def __submit(self, database_id: str, path: Path) -> None:
+        self.__queued_paths.add(path)
+        if database_id not in self.__queues:
+            self.__queues[database_id] = asyncio.Queue()
+        self.__queues[database_id].put_nowait(path)
+        if self.__started and database_id not in self.__workers:
+            self.__workers[database_id] = asyncio.create_task(self.__worker(database_id))
+
+    def __new_entry(self, data: dict, tenant_id: int | None) -> tuple[Path, dict]:
+        key: str = uuid.uuid4().hex
+        database_id: str = str(data['parent']['database_id'])
+        if self.settings.idempotency_property:
+            data['properties'][self.settings.idempotency_property] = {'rich_text': [{'text': {'content': key}}]}
+        entry = {'key': key, 'database_id': database_id, 'tenant_id': tenant_id, 'state': 'pending', 'data': data}
+        return self.__path / f'{next(self.__sequence):020d}_{key}.json', entry
+
+    def __write_entries(self, entries: list[tuple[Path, dict]]) -> None:
+        for path, entry in entries:
+            self.__write_entry(path, entry)
+
+    async def enqueue(self, data: dict, tenant_id: int | None = None) -> str:
+        """
+        Постановка записи в очередь на создание
+
+        :param data: тело запроса /v1/pages
+        :param tenant_id: id пользователя со своим рабочим пространством, None - рабочее пространство из настроек
+        :return: ключ идемпотентности записи
+        """
+        return (await self.enqueue_many([data], tenant_id))[0]
+
+    async def enqueue_many(self, pages: list[dict], tenant_id: int | None = None) -> list[str]:
+        """
+        Постановка нескольких записей в очередь одним пакетом: журнал пишется за один переход в поток,
+        записи отправляются в порядке списка с общим ограничением частоты запросов
+
+        :param pages: тела запросов /v1/pages
+        :param tenant_id: id пользователя со своим рабочим пространством, None - рабочее пространство из настроек
+        :return: ключи идемпотентности записей в порядке pages
+        """
+        entries: list[tuple[Path, dict]] = [self.__new_entry(data, tenant_id) for data in pages]
+        await asyncio.to_thread(self.__write_entries, entries)
+        for path, entry in entries:
+            self.__submit(entry['database_id'], path)
+            logging.info(f'Page {entry["key"]} queued for database with id {entry["database_id"]}')
+        return [entry['key'] for _, entry in entries]
+
+    @asynccontextmanager
+    async def __operator(self, entry: dict) -> AsyncIterator[DatabaseOperator]:
+        # сервисы пользователя арендуются на время отправки, чтобы реестр не закрыл их соединения
+        tenant_id: int | None = entry.get('tenant_id')
+        if tenant_id is None:
+            yield self.__database_operator
+            return
+        if self.__tenants is None:
+            raise NotionRequestError('POST', 401, f'Notion workspace of user {tenant_id} is not connected')
+        async with self.__tenants.lease(tenant_id) as tenant:
+            if tenant is None:
+                # пользователь отключил рабочее пространство, повтор не поможет
+                raise NotionRequestError('POST', 401, f'Notion workspace of user {tenant_id} is not connected')
+            yield tenant.database_operator
+
+    @staticmethod
+    def __content_filter(properties: dict) -> dict | None:
+        """
+        Фильтр Notion, находящий запись с теми же значениями свойств, что и в теле запроса
+
+        :param properties: свойства тела запроса /v1/pages
+        :return: фильтр или None, если сравнивать нечего
+        """
+        conditions: list[dict] = []
+        for name, value in properties.items():
+            if 'title' in value or 'rich_text' in value:
+                kind = 'title' if 'title' in value else 'rich_text'
+                text = ''.join(part.get('text', {}).get('content', '') for part in value[kind])
+                conditions.append({'property': name, kind: {'equals': text} if text else {'is_empty': True}})
+            elif 'date' in value and value['date']:
+                conditions.append({'property': name, 'date': {'equals': value['date']['start']}})
+            elif 'number' in value:
+                number = value['number']
+                conditions.append({'property': name,
+                                   'number': {'equals': number} if number is not None else {'is_empty': True}})
+        return {'and': conditions} if conditions else None
+
+    async def __page_exists(self, operator: DatabaseOperator, entry: dict) -> bool:
+        if self.settings.idempotency_property:
+            query_filter: dict | None = {'property': self.settings.idempotency_property,
+                                         'rich_text': {'equals': entry['key']}}
+        else:
+            # без свойства с ключом запись ищется по всем значениям: совпадение всех свойств
+            # у другой записи означает ту же самую тренировку
+            query_filter = self.__content_filter(entry['data'].get('properties', {}))
+            if query_filter is None:
+                return False
+        record: dict | None = await operator.get_first_record_database(
+            database_id=entry['database_id'],
+            query={'filter': query_filter}
+        )
+        return record is not None
+
+    async def __send(self, path: Path) -> None:
+        entry: dict = await asyncio.to_thread(self.__read_entry, path)
+        async with self.__operator(entry) as operator:
+            if entry['state'] == 'sending' and await self.__page_exists(operator, entry):
+                logging.info(f'Page {entry["key"]} already exists in Notion')
+                return
+            entry['state'] = 'sending'
+            await asyncio.to_thread(self.__write_entry, path, entry)
+            page: dict = await operator.create_page(entry['data'])
+        logging.info(f'Page {entry["key"]} created in database with id {entry["database_id"]}')
+        if self.__mirror is not None and entry.get('tenant_id') is None:
+            # без этого последняя тренировка из локальной копии устарела бы до следующей синхронизации
+            try:
+                await self.__mirror.upsert_record(UUID(entry['database_id']), page)
+            except Exception as exc:
+                logging.warning(f'Cannot save page {entry["key"]} to mirror: {exc!r}')
+
+    async def __worker(self, database_id: str) -> None:
+        queue = self.__queues[database_id]
+        while True:
+            path: Path = await queue.get()
+            attempt = 0
+            while True:
+                try:
+                    await self.__send(path)
+                    break
+                except NotionRequestError as exc:
+                    if 400 <= exc.status < 500 and exc.status not in (408, 409, 429):
+                        # запрос некорректен, повтор не поможет, запись остается в журнале с пометкой
+                        logging.error(f'Page from {path.name} rejected by Notion: {exc}')
+                        await asyncio.to_thread(path.replace, path.with_suffix('.failed'))
+                        break
+                    error = exc
+                except Exception as exc:
+                    error = exc
+                delay = random.uniform(0, min(self.settings.retry_delay_max, self.settings.retry_delay * 2 ** attempt))
+                attempt += 1
+                logging.warning(f'Page from {path.name} not sent, retry in {delay:.1f} s: {error!r}')
+                await asyncio.sleep(delay)
+            path.unlink(missing_ok=True)
+            self.__queued_paths.discard(path)
+            queue.task_done()
+
+    async def start(self) -> None:
+        """
+        Загрузка неотправленных записей из журнала и запуск фоновой отправки
+        """
+        if self.__started:
+            return
+        paths: list[Path] = sorted(path for path in self.__path.glob('*.json') if path not in self.__queued_paths)
+        for path in paths:
+            entry: dict = await asyncio.to_thread(self.__read_entry, path)
+            self.__submit(entry['database_id'], path)
+        if paths:
+            logging.info(f'Restored {len(paths)} queued pages from journal')
+        self.__started = True
+        for database_id in self.__queues:
+            self.__workers[database_id] = asyncio.create_task(self.__worker(database_id))
+
+    async def join(self) -> None:
+        """
+        Ожидание отправки всех записей очереди
+        """
+        for queue in list(self.__queues.values()):
+            await queue.join()
+
+    async def close(self) -> None:
+        """
+        Остановка фоновой отправки, неотправленные записи остаются в журнале
+        """
+        for worker in self.__workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.__workers.values(), return_exceptions=True)
+        self.__workers = {}
+        self.__queues = {}
+        self.__queued_paths = set()
+        self.__started = False
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from services.coordination import CoordinationBackend
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket.
+
+    Ожидающие запросы обслуживаются в порядке очереди, поэтому всплеск запросов
+    превращается в короткие ожидания, а не в ответы 429 от Notion
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        """
+        :param rate: скорость пополнения, токенов в секунду
+        :param capacity: максимальное количество токенов (размер всплеска)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens: float = capacity
+        self.__updated_at: float = time.monotonic()
+        self.__paused_until: float = 0.0
+        self.__lock = asyncio.Lock()
+
+        self.queue_depth: int = 0
+        self.acquired_count: int = 0
+        self.total_wait_time: float = 0.0
+        self.max_wait_time: float = 0.0
+
+    def __refill(self, now: float) -> None:
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated_at) * self.rate)
+        self.__updated_at = now
+
+    async def acquire(self) -> float:
+        """
+        Получение одного токена, при необходимости с ожиданием
+
+        :return: время ожидания токена, с
+        """
+        started_at = time.monotonic()
+        self.queue_depth += 1
+        try:
+            async with self.__lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.__paused_until:
+                        await asyncio.sleep(self.__paused_until - now)
+                        continue
+                    self.__refill(now)
+                    if self.__tokens >= 1:
+                        self.__tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self.__tokens) / self.rate)
+        finally:
+            self.queue_depth -= 1
+        wait_time = time.monotonic() - started_at
+        self.acquired_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return wait_time
+
+    def pause(self, delay: float) -> None:
+        """
+        Приостановка выдачи токенов, например по заголовку Retry-After
+
+        :param delay: длительность паузы, с
+        """
+        self.__paused_until = max(self.__paused_until, time.monotonic() + delay)
+        self.__tokens = 0
+
+    @property
+    def metrics(self) -> dict[str, float]:
+        """
+        Метрики ограничителя: глубина очереди и время ожидания
+
+        :return: словарь метрик
+        """
+        return {
+            'queue_depth': self.queue_depth,
+            'acquired_count': self.acquired_count,
+            'total_wait_time': self.total_wait_time,
+            'mean_wait_time': self.total_wait_time / self.acquired_count if self.acquired_count else 0.0,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Ограничитель частоты запросов, общий для нескольких процессов бота.
+
+    Токены резервируются в общем хранилище, поэтому при шардировании все процессы вместе
+    укладываются в ограничение Notion, а пауза по Retry-After действует во всех процессах
+    """
+
+    def __init__(self, backend: 'CoordinationBackend', key: str, rate: float, capacity: int) -> None:
+        """
+        :param backend: общее хранилище
+        :param key: ключ ограничителя в хранилище
+        :param rate: скорость пополнения, токенов в секунду
+        :param capacity: максимальное количество токенов (размер всплеска)
+        """
+        super().__init__(rate=rate, capacity=capacity)
+        self.backend = backend
+        self.key = key
+        self.__paused_until: float | None = None
+
+    async def acquire(self) -> float:
+        started_at = time.monotonic()
+        self.queue_depth += 1
+        try:
+            if self.__paused_until is not None:
+                paused_until, self.__paused_until = self.__paused_until, None
+                await self.backend.pause(self.key, paused_until)
+            delay: float = await self.backend.reserve_token(self.key, self.rate, self.capacity)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self.queue_depth -= 1
+        wait_time = time.monotonic() - started_at
+        self.acquired_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return wait_time
+
+    def pause(self, delay: float) -> None:
+        # pause синхронный, поэтому пауза передается в хранилище при следующем запросе токена
+        self.__paused_until = max(self.__paused_until or 0.0, time.time() + delay)
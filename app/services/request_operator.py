@@ -1,33 +1,219 @@
+import asyncio
+import logging
+import random
 import aiohttp
 import json
+import time
+from typing import TypeVar
+from urllib.parse import urlsplit
+from pydantic import BaseModel
+
+from common import http_client_settings, HttpClientSettings, rate_limit_settings, RateLimitSettings
+from services.metrics import metrics_registry, notion_request_duration, endpoint_label, tracer
+from services.coordination import CoordinationBackend
+from services.rate_limiter import SharedTokenBucket, TokenBucket
+
+
+RETRYABLE_STATUSES = frozenset({500, 502, 503, 504})
+
+ModelT = TypeVar('ModelT', bound=BaseModel)
 
 
 def get_request_operator():
     return RequestOperator()
 
 
+class NotionRequestError(Exception):
+    """
+    Ошибка запроса к Notion API
+    """
+
+    def __init__(self, method: str, status: int, reason: str | None = None) -> None:
+        super().__init__(f'Error {method} request, status = {status}, {reason}')
+        self.method = method
+        self.status = status
+        self.reason = reason
+
+
 class RequestOperator:
+    """
+    Класс для выполнения HTTP запросов к Notion API через одну долгоживущую сессию с пулом соединений.
+    Все запросы проходят через общий ограничитель частоты, ответы 429 и временные ошибки повторяются
+    """
 
-    @staticmethod
-    async def get_request_response_data(url: str, headers: dict, data: dict | None = None) -> dict:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url=url,
-                                   data=data,
-                                   headers=headers) as resp:
-                if resp.status == 200:
-                    resp_body: dict = await resp.json()
-                    return resp_body
-                else:
-                    raise Exception(f'Error GET request, status = {resp.status}')
+    def __init__(self,
+                 settings: HttpClientSettings | None = None,
+                 rate_limit: RateLimitSettings | None = None,
+                 gauges: bool = True,
+                 backend: CoordinationBackend | None = None,
+                 rate_limit_key: str = 'notion') -> None:
+        """
+        :param settings: настройки пула соединений и таймаутов
+        :param rate_limit: настройки ограничения частоты запросов
+        :param gauges: регистрировать показатель очереди ограничителя, у операторов пользователей не регистрируется,
+            чтобы не подменять показатель общего оператора
+        :param backend: общее хранилище, через которое ограничение частоты делится между процессами бота
+        :param rate_limit_key: ключ ограничителя в общем хранилище
+        """
+        self.__settings = settings if settings else http_client_settings
+        self.__rate_limit = rate_limit if rate_limit else rate_limit_settings
+        self.__session: aiohttp.ClientSession | None = None
+        self.__session_lock = asyncio.Lock()
+        if backend is not None:
+            self.rate_limiter: TokenBucket = SharedTokenBucket(backend, key=f'rate_limit:{rate_limit_key}',
+                                                               rate=self.__rate_limit.requests_per_second,
+                                                               capacity=self.__rate_limit.burst)
+        else:
+            self.rate_limiter = TokenBucket(rate=self.__rate_limit.requests_per_second,
+                                            capacity=self.__rate_limit.burst)
+        self.retries_count: int = 0
+        self.__rate_limit_wait = metrics_registry.histogram('notion_rate_limit_wait_seconds',
+                                                            'Time a Notion request waits for a rate limit token')
+        if gauges:
+            metrics_registry.gauge('notion_rate_limit_queue_depth', 'Notion requests waiting for a rate limit token',
+                                   lambda: self.rate_limiter.queue_depth)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Получение общей сессии, при первом обращении сессия создается
+
+        :return: сессия aiohttp с ограниченным пулом соединений и кэшем DNS
+        """
+        if self.__session is None or self.__session.closed:
+            async with self.__session_lock:
+                if self.__session is None or self.__session.closed:
+                    connector = aiohttp.TCPConnector(limit=self.__settings.connections_limit,
+                                                     limit_per_host=self.__settings.connections_limit_per_host,
+                                                     ttl_dns_cache=self.__settings.dns_cache_ttl,
+                                                     keepalive_timeout=self.__settings.keepalive_timeout)
+                    timeout = aiohttp.ClientTimeout(total=self.__settings.total_timeout,
+                                                    connect=self.__settings.connect_timeout,
+                                                    sock_read=self.__settings.read_timeout)
+                    self.__session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.__session
+
+    async def close(self) -> None:
+        """
+        Закрытие общей сессии и всех соединений пула
+        """
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
+    @property
+    def metrics(self) -> dict[str, float]:
+        """
+        Метрики планировщика запросов: глубина очереди, время ожидания и количество повторов
+
+        :return: словарь метрик
+        """
+        return self.rate_limiter.metrics | {'retries_count': self.retries_count}
+
+    def __backoff(self, attempt: int) -> float:
+        # экспоненциальная задержка с полным джиттером
+        return random.uniform(0, min(self.__rate_limit.backoff_max, self.__rate_limit.backoff_base * 2 ** attempt))
 
     @staticmethod
-    async def post_request_response_data(url: str, headers: dict, data: dict | None = None) -> dict:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url=url,
-                                    data=json.dumps(data),
-                                    headers=headers) as resp:
-                if resp.status == 200:
-                    resp_body: dict = await resp.json()
-                    return resp_body
+    def __parse_retry_after(value: str | None) -> float | None:
+        try:
+            return max(float(value), 0.0) if value is not None else None
+        except ValueError:
+            return None
+
+    async def __request(self, method: str, url: str, headers: dict, data, idempotent: bool) -> bytes:
+        """
+        Выполнение запроса с ограничением частоты и повторами
+
+        :param method: HTTP метод
+        :param url: адрес запроса
+        :param headers: заголовки запроса
+        :param data: тело запроса
+        :param idempotent: можно ли повторять запрос при временных ошибках
+
+        :return: тело ответа в необработанном виде
+        """
+        endpoint = endpoint_label(urlsplit(url).path)
+        with tracer.start_as_current_span(f'notion {method} {endpoint}') as span:
+            span.set_attribute('http.method', method)
+            span.set_attribute('http.url', url)
+            return await self.__request_with_retries(method, url, endpoint, headers, data, idempotent)
+
+    async def __request_with_retries(self, method: str, url: str, endpoint: str, headers: dict, data,
+                                     idempotent: bool) -> bytes:
+        session = await self.get_session()
+        attempt = 0
+        while True:
+            self.__rate_limit_wait.observe(await self.rate_limiter.acquire())
+            started_at = time.perf_counter()
+            status: str = 'error'
+            try:
+                async with session.request(method=method, url=url, data=data, headers=headers) as resp:
+                    status = str(resp.status)
+                    if resp.status == 200:
+                        return await resp.read()
+                    retry_after = self.__parse_retry_after(resp.headers.get('Retry-After'))
+                    error = NotionRequestError(method, resp.status, resp.reason)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                if not idempotent or attempt >= self.__rate_limit.max_retries:
+                    raise
+                retry_after, error = None, exc
+            finally:
+                notion_request_duration.observe(time.perf_counter() - started_at,
+                                                method=method, endpoint=endpoint, status=status)
+
+            if attempt >= self.__rate_limit.max_retries:
+                raise error
+            if isinstance(error, NotionRequestError):
+                if error.status == 429:
+                    # запрос отклонен до обработки, повторять безопасно даже для неидемпотентных запросов
+                    delay = retry_after if retry_after is not None else self.__backoff(attempt)
+                    # ожидание перед повтором выполняет ограничитель: пауза задерживает и повтор,
+                    # и остальные запросы, поэтому отдельно не ждем
+                    self.rate_limiter.pause(delay)
+                elif error.status in RETRYABLE_STATUSES and idempotent:
+                    delay = self.__backoff(attempt)
                 else:
-                    raise Exception(f'Error POST request, status = {resp.status}, {resp.reason}')
+                    raise error
+            else:
+                delay = self.__backoff(attempt)
+
+            attempt += 1
+            self.retries_count += 1
+            logging.warning(f'Retry {method} {url} in {delay:.2f} s (attempt {attempt}): {error}')
+            if not (isinstance(error, NotionRequestError) and error.status == 429):
+                await asyncio.sleep(delay)
+
+    async def get_request_response_data(self, url: str, headers: dict, data: dict | None = None) -> dict:
+        return json.loads(await self.__request('GET', url=url, headers=headers, data=data, idempotent=True))
+
+    async def post_request_response_data(self, url: str, headers: dict, data: dict | None = None,
+                                         idempotent: bool = False) -> dict:
+        return json.loads(await self.__request('POST', url=url, headers=headers, data=json.dumps(data),
+                                               idempotent=idempotent))
+
+    async def get_request_response_model(self, url: str, headers: dict, model: type[ModelT]) -> ModelT:
+        """
+        GET запрос с валидацией ответа напрямую из JSON в pydantic модель
+
+        :param url: адрес запроса
+        :param headers: заголовки запроса
+        :param model: pydantic модель ответа
+        :return: модель ответа
+        """
+        return model.model_validate_json(await self.__request('GET', url=url, headers=headers, data=None,
+                                                              idempotent=True))
+
+    async def post_request_response_model(self, url: str, headers: dict, model: type[ModelT],
+                                          data: dict | None = None, idempotent: bool = False) -> ModelT:
+        """
+        POST запрос с валидацией ответа напрямую из JSON в pydantic модель
+
+        :param url: адрес запроса
+        :param headers: заголовки запроса
+        :param model: pydantic модель ответа
+        :param data: тело запроса
+        :param idempotent: можно ли повторять запрос при временных ошибках
+        :return: модель ответа
+        """
+        return model.model_validate_json(await self.__request('POST', url=url, headers=headers,
+                                                              data=json.dumps(data), idempotent=idempotent))
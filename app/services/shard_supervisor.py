@@ -0,0 +1,391 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from queue import Empty, Full
+from typing import Callable
+
+from dependency_injector import providers
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+
+from common import (BotSettings, coordination_settings, metrics_settings, ocr_settings, shard_settings,
+                    ShardSettings, write_queue_settings)
+from services.container import ApplicationContainer, close_services
+from services.coordination import create_backend
+from services.image_operator import ImageOperator
+from services.metrics import metrics_registry, MetricsServer
+from services.page_write_queue import PageWriteQueue
+from services.webhook_server import WebhookServer
+
+
+# общее хранилище по умолчанию, если процессов несколько, а адрес в настройках не задан
+DEFAULT_BACKEND_URL = 'sqlite:///coordination.sqlite3'
+
+# сколько обновлений процесс забирает из очереди за одно обращение из потока
+WORKER_BATCH_SIZE = 64
+
+
+def update_chat_id(raw: dict) -> int:
+    """
+    Чат обновления Telegram, по которому обновление закрепляется за процессом
+
+    :param raw: обновление в исходном виде
+    :return: id чата, id пользователя для обновлений без чата или update_id
+    """
+    for key, value in raw.items():
+        if not isinstance(value, dict):
+            continue
+        if isinstance(value.get('chat'), dict):
+            return value['chat']['id']
+        # callback query: чат сообщения с кнопкой, иначе пользователь, нажавший кнопку
+        message = value.get('message')
+        if isinstance(message, dict) and isinstance(message.get('chat'), dict):
+            return message['chat']['id']
+        if isinstance(value.get('from'), dict):
+            return value['from']['id']
+    return raw.get('update_id', 0)
+
+
+def journal_path(path: str, index: int, workers: int) -> str:
+    """
+    Каталог журнала очереди записей процесса
+
+    :param path: каталог журнала из настроек
+    :param index: номер процесса
+    :param workers: количество процессов
+    :return: каталог журнала, при одном процессе - каталог из настроек
+    """
+    return path if workers == 1 else os.path.join(path, f'shard-{index}')
+
+
+def rebalance_journals(path: str, workers: int) -> int:
+    """
+    Перенос неотправленных записей журнала после смены количества процессов: записи из каталогов
+    процессов, которых больше нет, переходят к существующим, при одном процессе - в каталог из настроек
+
+    :param path: каталог журнала из настроек
+    :param workers: количество процессов
+    :return: количество перенесенных записей
+    """
+    root = Path(path)
+    if not root.is_dir():
+        return 0
+    moved = 0
+    sources: list[tuple[Path, int]] = [(root, 0)]
+    for shard in root.glob('shard-*'):
+        index = shard.name.removeprefix('shard-')
+        if shard.is_dir() and index.isdigit():
+            sources.append((shard, int(index)))
+    for source, index in sources:
+        target = Path(journal_path(path, index % workers, workers))
+        if source == target:
+            continue
+        target.mkdir(parents=True, exist_ok=True)
+        # имена записей уникальны и упорядочены по времени создания, поэтому порядок отправки сохраняется
+        for entry in source.glob('*.json'):
+            entry.replace(target / entry.name)
+            moved += 1
+    if moved:
+        logging.info(f'Moved {moved} queued pages between journals of {workers} workers')
+    return moved
+
+
+async def _process_update(telegram_bot, raw: dict, processed, index: int, semaphore: asyncio.Semaphore) -> None:
+    try:
+        await telegram_bot.bot.process_new_updates([Update.de_json(raw)])
+    except Exception as exc:
+        logging.exception(f'Error processing update {raw.get("update_id")}: {exc!r}')
+    finally:
+        processed[index] += 1
+        semaphore.release()
+
+
+def _get_batch(queue: multiprocessing.Queue) -> list:
+    # первое обновление ожидается с таймаутом, чтобы процесс заметил завершение родителя,
+    # остальные забираются без ожидания
+    batch: list = [queue.get(timeout=1.0)]
+    while batch[-1] is not None and len(batch) < WORKER_BATCH_SIZE:
+        try:
+            batch.append(queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
+
+async def _serve_worker(index: int,
+                        workers: int,
+                        token: str,
+                        backend_url: str | None,
+                        queue: multiprocessing.Queue,
+                        processed,
+                        ready: multiprocessing.Queue,
+                        settings: ShardSettings) -> None:
+    container = ApplicationContainer()
+    container.coordination_backend.override(providers.Singleton(create_backend, backend_url))
+    ocr_workers: int = settings.ocr_workers if settings.ocr_workers else max(1, (os.cpu_count() or 1) // workers)
+    container.image_operator.override(providers.Singleton(
+        ImageOperator, settings=ocr_settings.model_copy(update={'workers': ocr_workers})))
+    container.page_write_queue.override(providers.Singleton(
+        PageWriteQueue,
+        request_operator=container.request_operator,
+        settings=write_queue_settings.model_copy(update={'path': journal_path(write_queue_settings.path,
+                                                                              index, workers)}),
+        tenants=container.tenant_registry,
+        mirror=container.notion_mirror))
+    telegram_bot = container.telegram_bot(token=token)
+    # метрики обработки собираются в процессе-обработчике, у каждого процесса свой порт после порта
+    # процесса приема обновлений
+    metrics_server = MetricsServer(settings=metrics_settings.model_copy(
+        update={'port': metrics_settings.port + 1 + index}))
+    try:
+        await metrics_server.start()
+        # зеркало Notion синхронизирует один процесс, остальные читают ту же базу
+        await telegram_bot.start(sync_mirror=index == 0)
+        ready.put(index)
+
+        semaphore = asyncio.Semaphore(settings.concurrency)
+        tasks: set[asyncio.Task] = set()
+        parent: BaseProcess | None = multiprocessing.parent_process()
+        stopping = False
+        while not stopping:
+            try:
+                batch: list = await asyncio.to_thread(_get_batch, queue)
+            except Empty:
+                if parent is not None and not parent.is_alive():
+                    logging.error(f'Shard worker {index}: supervisor exited, stopping')
+                    break
+                continue
+            for raw in batch:
+                if raw is None:
+                    stopping = True
+                    break
+                # задачи запускаются в порядке очереди и занимают место в очереди чата до первого ожидания,
+                # поэтому порядок обновлений каждого чата сохраняется
+                await semaphore.acquire()
+                task = asyncio.create_task(_process_update(telegram_bot, raw, processed, index, semaphore))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # уже собранные альбомы обрабатываются, принятые записи отправляются в Notion в пределах drain_timeout,
+        # неотправленные остаются в журнале
+        await telegram_bot.close()
+        try:
+            await asyncio.wait_for(container.page_write_queue().join(), timeout=settings.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'Shard worker {index}: {container.page_write_queue().pending} pages left in journal')
+    finally:
+        await close_services(container, telegram_bot)
+        await telegram_bot.bot.close_session()
+        await metrics_server.stop()
+
+
+def _run_worker(index: int,
+                workers: int,
+                token: str,
+                backend_url: str | None,
+                queue: multiprocessing.Queue,
+                processed,
+                ready: multiprocessing.Queue,
+                settings: ShardSettings,
+                worker_init: Callable | None,
+                worker_init_args: tuple) -> None:
+    # остановкой процессов управляет родитель: Ctrl+C и SIGTERM от systemd приходят всей группе процессов,
+    # и без этого процессы завершились бы, не дообработав очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if worker_init is not None:
+        worker_init(*worker_init_args)
+    asyncio.run(_serve_worker(index, workers, token, backend_url, queue, processed, ready, settings))
+
+
+class ShardSupervisor:
+    """
+    Прием обновлений Telegram в одном процессе и обработка в нескольких процессах-обработчиках.
+
+    Обновление закрепляется за процессом по id чата, поэтому обновления одного чата обрабатываются
+    одним процессом по порядку, а распознавание скриншотов разных чатов занимает все ядра.
+    Ограничение частоты запросов к Notion и кэш распознавания общие для процессов через общее хранилище.
+    При остановке прием прекращается, процессы дообрабатывают свои очереди и завершаются
+    """
+
+    def __init__(self,
+                 token: str,
+                 settings: ShardSettings | None = None,
+                 worker_init: Callable | None = None,
+                 worker_init_args: tuple = ()) -> None:
+        """
+        :param token: токен бота
+        :param settings: настройки процессов-обработчиков
+        :param worker_init: функция, вызываемая в каждом процессе перед созданием сервисов, должна импортироваться
+            по имени модуля, так как процессы запускаются через spawn
+        :param worker_init_args: аргументы worker_init
+        """
+        self.token = token
+        self.settings = settings if settings else shard_settings
+        self.workers: int = self.settings.workers
+        self.backend_url: str | None = coordination_settings.backend
+        if self.workers > 1:
+            if self.backend_url == 'memory://':
+                raise ValueError('memory:// coordination backend cannot be shared between worker processes')
+            self.backend_url = self.backend_url if self.backend_url else DEFAULT_BACKEND_URL
+        self.__worker_init = worker_init
+        self.__worker_init_args = worker_init_args
+        # spawn: процессы не наследуют цикл событий и потоки родителя
+        self.__context = multiprocessing.get_context('spawn')
+        self.__queues: list[multiprocessing.Queue] = []
+        self.__processes: list[BaseProcess] = []
+        self.__processed = self.__context.Array('q', self.workers, lock=False)
+        self.__submitted: int = 0
+        metrics_registry.gauge('shard_pending_updates', 'Updates accepted but not yet processed by workers',
+                               lambda: self.pending)
+
+    @property
+    def processed(self) -> int:
+        return sum(self.__processed)
+
+    @property
+    def pending(self) -> int:
+        return self.__submitted - self.processed
+
+    async def start(self) -> None:
+        """
+        Запуск процессов-обработчиков и ожидание их готовности
+
+        :raises RuntimeError: если процессы не запустились за start_timeout
+        """
+        rebalance_journals(write_queue_settings.path, self.workers)
+        ready: multiprocessing.Queue = self.__context.Queue()
+        for index in range(self.workers):
+            queue: multiprocessing.Queue = self.__context.Queue(maxsize=self.settings.queue_size)
+            process = self.__context.Process(
+                target=_run_worker, name=f'shard-worker-{index}', daemon=False,
+                args=(index, self.workers, self.token, self.backend_url, queue, self.__processed, ready,
+                      self.settings, self.__worker_init, self.__worker_init_args))
+            process.start()
+            self.__queues.append(queue)
+            self.__processes.append(process)
+
+        deadline = time.monotonic() + self.settings.start_timeout
+        started: set[int] = set()
+        while len(started) < self.workers:
+            try:
+                started.add(await asyncio.to_thread(ready.get, timeout=1.0))
+            except Empty:
+                self.__check_alive()
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Only {len(started)} of {self.workers} shard workers started')
+        logging.info(f'Started {self.workers} shard workers, coordination backend {self.backend_url}')
+
+    def __check_alive(self) -> None:
+        for process in self.__processes:
+            if not process.is_alive():
+                raise RuntimeError(f'Shard worker {process.name} exited with code {process.exitcode}')
+
+    def __shard(self, raw: dict) -> int:
+        return update_chat_id(raw) % self.workers
+
+    def offer(self, raw: dict) -> bool:
+        """
+        Передача обновления процессу без ожидания
+
+        :param raw: обновление в исходном виде
+        :return: False, если очередь процесса заполнена
+        """
+        try:
+            self.__queues[self.__shard(raw)].put_nowait(raw)
+        except Full:
+            return False
+        self.__submitted += 1
+        return True
+
+    async def submit(self, raw: dict) -> None:
+        """
+        Передача обновления процессу, при заполненной очереди - с ожиданием места
+
+        :param raw: обновление в исходном виде
+
+        :raises RuntimeError: если процесс, за которым закреплен чат, завершился
+        """
+        if self.offer(raw):
+            return
+        index = self.__shard(raw)
+        while True:
+            if not self.__processes[index].is_alive():
+                self.__check_alive()
+            try:
+                await asyncio.to_thread(self.__queues[index].put, raw, timeout=1.0)
+                break
+            except Full:
+                continue
+        self.__submitted += 1
+
+    async def run_polling(self) -> None:
+        """
+        Получение обновлений через getUpdates и передача процессам до отмены задачи
+        """
+        offset: int | None = None
+        try:
+            while True:
+                try:
+                    updates: list[dict] = await asyncio_helper.get_updates(self.token, offset=offset, timeout=20,
+                                                                          request_timeout=30)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    logging.error(f'Cannot get updates: {exc!r}')
+                    await asyncio.sleep(3)
+                    continue
+                for raw in updates:
+                    await self.submit(raw)
+                    offset = raw['update_id'] + 1
+        finally:
+            if offset is not None:
+                # подтверждение переданных обновлений, чтобы после перезапуска они не пришли повторно
+                try:
+                    await asyncio_helper.get_updates(self.token, offset=offset, limit=1, request_timeout=5)
+                except Exception as exc:
+                    logging.warning(f'Cannot confirm updates before {offset}: {exc!r}')
+
+    async def run_webhook(self, settings: BotSettings | None = None) -> None:
+        """
+        Прием обновлений через webhook и передача процессам до отмены задачи
+        """
+        bot = AsyncTeleBot(self.token)
+        try:
+            await WebhookServer(bot=bot, settings=settings, forward=self.offer).run()
+        finally:
+            await bot.close_session()
+
+    async def drain(self) -> None:
+        """
+        Остановка процессов: каждый процесс дообрабатывает свою очередь, отправляет принятые записи в Notion
+        и завершается. Процессы, не успевшие за drain_timeout, завершаются принудительно
+        """
+        for queue, process in zip(self.__queues, self.__processes):
+            if process.is_alive():
+                try:
+                    await asyncio.to_thread(queue.put, None, timeout=self.settings.drain_timeout)
+                except Full:
+                    logging.error(f'Cannot stop {process.name}: queue is full')
+        # очередь обновлений и отправка записей ограничены drain_timeout каждая
+        deadline = time.monotonic() + 2 * self.settings.drain_timeout
+        for process in self.__processes:
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                # SIGTERM процессы игнорируют
+                logging.error(f'{process.name} did not stop in time, killing')
+                process.kill()
+                await asyncio.to_thread(process.join)
+        for queue in self.__queues:
+            queue.close()
+        logging.info(f'Shard workers stopped, {self.processed} of {self.__submitted} updates processed')
+        self.__queues = []
+        self.__processes = []
@@ -1,62 +1,326 @@
+import asyncio
 import logging
-import io
+import aiohttp
 import telebot
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
 from telebot.async_telebot import AsyncTeleBot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, User
-from uuid import UUID
-from PIL import Image
+from telebot.asyncio_helper import ApiException, ApiTelegramException
+from telebot.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, User
+from uuid import UUID, uuid4
 
-from services.database_lister import DatabaseLister
-from services.database_operator import DatabaseWorkoutOperator, DatabaseRunOperator
-from services.image_operator import ImageOperator
+from services.chart_renderer import ChartData, ChartRenderer
+from services.coordination import CoordinationBackend
+from services.database_operator import DatabaseRunOperator, RUN_DATABASE_ID
+from services.file_downloader import FileDownloader, FileTooLargeError
+from services.image_operator import (ImageDecodeError, ImageOperator, ImageTooLargeError, OcrEngineError,
+                                    OcrQueueFullError)
+from services.media_group_collector import MediaGroupCollector
+from services.notion_mirror import NotionMirror
+from services.ocr_cache import OcrResultCache
+from services.page_write_queue import PageWriteQueue
+from services.request_operator import NotionRequestError
+from services.tenants import Tenant, TenantRegistry
+from services.metrics import cache_requests, handler_duration, tracer
+from services.update_dispatcher import UpdateDispatcher, INTERACTIVE_LANE, HEAVY_LANE
+from services.webhook_server import WebhookServer
+from common import bot_settings, BotSettings
+
+
+RUN_REPORT_CAPTION = 'Тренировка. Пробежка'
+
+CONNECT_HINT = 'Подключите свое рабочее пространство Notion: /connect <токен интеграции>'
+
+# графики прогресса по типу тренировки из названия базы данных
+CHART_TYPES_BY_WORKOUT = {'Турник': ('reps',), 'Пробежка': ('distance', 'pace')}
+
+# ошибки распознавания скриншота и ответы пользователю
+RECOGNITION_ERROR_MESSAGES = {
+    FileTooLargeError: 'Файл слишком большой, отправьте скрин меньшего размера',
+    ImageTooLargeError: 'Разрешение скрина слишком большое',
+    ImageDecodeError: 'Файл не является изображением, отправьте скрин в формате png или jpeg',
+    OcrQueueFullError: 'Сейчас распознается много скринов, попробуйте чуть позже',
+    # файл не скачался: ошибка Bot API или соединения, в том числе таймаут скачивания
+    ApiException: 'Не удалось скачать файл из Telegram, отправьте его еще раз',
+    aiohttp.ClientError: 'Не удалось скачать файл из Telegram, отправьте его еще раз',
+    asyncio.TimeoutError: 'Не удалось распознать скрин за отведенное время',
+    OcrEngineError: 'Распознавание скринов временно недоступно, попробуйте позже',
+    BrokenProcessPool: 'Распознавание скрина прервалось, отправьте его еще раз',
+}
+RECOGNITION_ERRORS = tuple(RECOGNITION_ERROR_MESSAGES)
+
+DATABASE_NOT_FOUND_MESSAGE = 'База данных не найдена'
+
+NO_WORKOUTS_MESSAGE = 'В базе данных пока нет тренировок'
+
+INCOMPLETE_REPORT_MESSAGE = 'На скрине не удалось распознать все данные тренировки, тренировка не сохранена'
+
+
+# сервисы пользователей, арендованные текущим обработчиком, возвращаются реестру по его завершении
+_tenant_leases: ContextVar[list[Tenant] | None] = ContextVar('tenant_leases', default=None)
+
+
+def recognition_error_message(error: BaseException) -> str:
+    return next(text for error_type, text in RECOGNITION_ERROR_MESSAGES.items() if isinstance(error, error_type))
 
 
 class TelegramBot:
 
     def __init__(self,
                  token: str,
-                 database_lister: DatabaseLister,
-                 database_workout_operator: DatabaseWorkoutOperator,
-                 database_run_operator: DatabaseRunOperator) -> None:
+                 default_tenant: Tenant,
+                 tenants: TenantRegistry,
+                 chart_renderer: ChartRenderer,
+                 image_operator: ImageOperator,
+                 ocr_cache: OcrResultCache,
+                 notion_mirror: NotionMirror,
+                 page_write_queue: PageWriteQueue,
+                 dispatcher: UpdateDispatcher,
+                 backend: CoordinationBackend | None = None) -> None:
+        """
+        :param backend: общее хранилище, через которое /refresh сбрасывает кэши во всех процессах
+        """
         self.token = token
-        self.database_lister = database_lister
-        self.database_workout_operator = database_workout_operator
-        self.database_run_operator = database_run_operator
+        self.default_tenant = default_tenant
+        self.tenants = tenants
+        self.chart_renderer = chart_renderer
+        self.image_operator = image_operator
+        self.ocr_cache = ocr_cache
+        self.notion_mirror = notion_mirror
+        self.page_write_queue = page_write_queue
+        self.dispatcher = dispatcher
+        self.backend = backend
 
         self.bot = AsyncTeleBot(token=token)
+        self.file_downloader = FileDownloader(bot=self.bot)
+        self.media_groups = MediaGroupCollector(handler=self.__dispatch_media_group)
+        # сериализованные клавиатуры меню: строятся один раз для набора баз данных, а не на каждое сообщение
+        # клавиатуры разных наборов баз данных, в том числе пользователей со своим рабочим пространством,
+        # хранятся не больше keyboards_max_cached, давно не использованные вытесняются
+        self.__keyboards: OrderedDict[tuple, str] = OrderedDict()
+        # последние известные процессу отметки /refresh по рабочим пространствам
+        self.__refreshes: dict[str, bytes | None] = {}
 
         @self.bot.message_handler(commands=['start'])
         async def command_start(message):
             """
             Команда старта
             """
-            await self.__command_start(message)
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__command_start)
+
+        @self.bot.message_handler(commands=['refresh'])
+        async def command_refresh(message):
+            """
+            Команда принудительного обновления данных из Notion
+            """
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__command_refresh)
+
+        @self.bot.message_handler(commands=['stats'])
+        async def command_stats(message):
+            """
+            Команда статистики по всей истории тренировок
+            """
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__command_stats)
+
+        @self.bot.message_handler(commands=['connect'])
+        async def command_connect(message):
+            """
+            Команда подключения рабочего пространства Notion пользователя
+            """
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__command_connect)
+
+        @self.bot.message_handler(commands=['disconnect'])
+        async def command_disconnect(message):
+            """
+            Команда отключения рабочего пространства Notion пользователя
+            """
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__command_disconnect)
 
         @self.bot.message_handler(content_types=['text'])
         async def work_flow(message):
             """
             Рабочий процесс
             """
-            await self.__work_flow(message)
+            await self.__dispatch_message(message, INTERACTIVE_LANE, self.__work_flow)
+
+        @self.bot.callback_query_handler(func=lambda call: call.data == 'workouts')
+        async def get_workout_databases(call):
+            await self.__dispatch_callback(call, self.__get_workout_databases)
 
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('database/')
                                          and call.data.endswith('/operations'))
         async def get_database_operation(call):
-            await self.__get_database_operation(call)
+            await self.__dispatch_callback(call, self.__get_database_operation)
 
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('database/')
                                          and call.data.endswith('/last_result'))
         async def process_database_operation(call):
-            await self.__process_database_operation(call)
+            await self.__dispatch_callback(call, self.__process_database_operation)
 
         @self.bot.callback_query_handler(func=lambda call: call.data.startswith('database/')
                                          and call.data.endswith('/new_result'))
         async def process_database_operation_tmp(call):
-            await self.__process_database_operation_tmp(call)
+            await self.__dispatch_callback(call, self.__process_database_operation_tmp)
+
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('database/')
+                                         and call.data.endswith('/stats'))
+        async def process_database_stats(call):
+            await self.__dispatch_callback(call, self.__process_database_stats)
+
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('database/')
+                                         and call.data.endswith('/chart'))
+        async def process_database_chart(call):
+            await self.__dispatch_callback(call, self.__process_database_chart)
 
         @self.bot.message_handler(content_types=['document'])
         async def process_file(message):
-            await self.__process_file(message)
+            await self.__dispatch_message(message, HEAVY_LANE, self.__process_file)
+
+    async def __observe(self, handler, update):
+        # длительность и трассировка обработчика от начала обработки до ответа
+        name: str = handler.__name__.lstrip('_')
+        leases: list[Tenant] = []
+        token = _tenant_leases.set(leases)
+        try:
+            with tracer.start_as_current_span(f'handler {name}'), handler_duration.time(handler=name):
+                await handler(update)
+        finally:
+            _tenant_leases.reset(token)
+            for tenant in leases:
+                await self.tenants.release(tenant)
+
+    async def __dispatch_message(self, message, lane: str, handler):
+        await self.dispatcher.dispatch(message.chat.id, lane, lambda: self.__observe(handler, message))
+
+    async def __answer_callback(self, call) -> None:
+        try:
+            await self.bot.answer_callback_query(call.id)
+        except ApiTelegramException as exc:
+            logging.warning(f'Cannot answer callback query {call.id}: {exc!r}')
+
+    async def __dispatch_callback(self, call, handler):
+        # ответ сразу убирает индикатор загрузки на кнопке, не дожидаясь обработки. Ответ отправляется
+        # в отдельной задаче: место в очереди чата занимается до первого ожидания, иначе следующее
+        # обновление того же чата может обогнать нажатие кнопки
+        answer = asyncio.create_task(self.__answer_callback(call))
+        try:
+            # повторные нажатия той же кнопки, пока первое еще обрабатывается, отбрасываются
+            await self.dispatcher.dispatch(call.message.chat.id, INTERACTIVE_LANE,
+                                           lambda: self.__observe(handler, call),
+                                           dedup_key=(call.message.chat.id, call.data))
+        finally:
+            await answer
+
+    async def __tenant(self, update) -> Tenant | None:
+        """
+        Сервисы рабочего пространства Notion пользователя, отправившего сообщение или нажавшего кнопку.
+        Если пользователь еще не подключил Notion, ему отправляется подсказка.
+        Сервисы арендуются до завершения обработчика, реестр не закроет их соединения раньше
+
+        :param update: сообщение или callback query
+        :return: сервисы рабочего пространства или None
+        """
+        if not self.tenants.enabled:
+            return self.default_tenant
+        tenant: Tenant | None = await self.tenants.acquire(update.from_user.id)
+        if tenant is None:
+            message = update.message if isinstance(update, CallbackQuery) else update
+            await self.bot.send_message(chat_id=message.chat.id, text=CONNECT_HINT)
+            return None
+        _tenant_leases.get().append(tenant)
+        await self.__check_refresh(update, tenant)
+        return tenant
+
+    def __refresh_key(self, update) -> str:
+        return f'refresh:{update.from_user.id}' if self.tenants.enabled else 'refresh'
+
+    def __invalidate(self, tenant: Tenant) -> None:
+        tenant.database_lister.invalidate_cache()
+        tenant.workout_analytics.invalidate()
+        self.__keyboards.clear()
+
+    async def __check_refresh(self, update, tenant: Tenant) -> None:
+        """
+        Сброс кэшей рабочего пространства, если /refresh выполнен в другом процессе-обработчике:
+        команда публикует в общем хранилище новую отметку, процесс сравнивает ее с последней известной
+
+        :param update: сообщение или callback query
+        :param tenant: сервисы рабочего пространства
+        """
+        if self.backend is None:
+            return
+        key: str = self.__refresh_key(update)
+        stamp: bytes | None = await self.backend.get(key)
+        if key not in self.__refreshes:
+            self.__refreshes[key] = stamp
+        elif self.__refreshes[key] != stamp:
+            self.__refreshes[key] = stamp
+            self.__invalidate(tenant)
+
+    def __tenant_id(self, update) -> int | None:
+        return update.from_user.id if self.tenants.enabled else None
+
+    async def __run_database_id(self, tenant: Tenant, message) -> str | None:
+        """
+        id базы пробежек, в которую сохраняются скриншоты: у пользователя - база с названием RUN_REPORT_CAPTION,
+        иначе база из настроек. Если у пользователя такой базы нет, он получает ответ
+
+        :return: id базы данных или None
+        """
+        if tenant is self.default_tenant:
+            return RUN_DATABASE_ID
+        databases: dict[UUID, str] = await tenant.database_lister.get_workout_databases()
+        database_id: UUID | None = next((key for key, title in databases.items() if title == RUN_REPORT_CAPTION), None)
+        if database_id is None:
+            await self.bot.reply_to(message, f"В Notion нет базы данных '{RUN_REPORT_CAPTION}'")
+            return None
+        return str(database_id)
+
+    def __keyboard(self, key: tuple, buttons) -> str:
+        """
+        Клавиатура из кэша или построенная и сериализованная один раз
+
+        :param key: ключ клавиатуры, включает все данные, от которых зависят кнопки
+        :param buttons: функция, возвращающая кнопки в виде (текст, callback_data)
+        :return: клавиатура в JSON для reply_markup
+        """
+        markup: str | None = self.__keyboards.get(key)
+        cache_requests.inc(cache='keyboards', result='hit' if markup is not None else 'miss')
+        if markup is not None:
+            self.__keyboards.move_to_end(key)
+        else:
+            keyboard_menu = InlineKeyboardMarkup()
+            for text, callback_data in buttons():
+                keyboard_menu.add(InlineKeyboardButton(text=text, callback_data=callback_data))
+            markup = self.__keyboards[key] = keyboard_menu.to_json()
+            while len(self.__keyboards) > bot_settings.keyboards_max_cached:
+                self.__keyboards.popitem(last=False)
+        return markup
+
+    def __databases_keyboard(self, databases: dict[UUID, str], action: str) -> str:
+        return self.__keyboard((action, tuple(databases.items())),
+                               lambda: [(title, f'database/{key}/{action}') for key, title in databases.items()])
+
+    def __operations_keyboard(self, data_type: str, database_id: UUID) -> str:
+        return self.__keyboard(('operations', data_type, database_id), lambda: [
+            ('Показать результат последней тренировки', f'{data_type}/{database_id}/last_result'),
+            ('Загрузить новую тренировку', f'{data_type}/{database_id}/new_result'),
+            ('Статистика', f'{data_type}/{database_id}/stats'),
+            ('График', f'{data_type}/{database_id}/chart'),
+            ('« Назад', 'workouts'),
+        ])
+
+    async def __show_menu(self, call, text: str, markup: str):
+        # переход по меню редактирует сообщение с кнопками вместо отправки нового
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=call.message.chat.id,
+                                             message_id=call.message.message_id, reply_markup=markup)
+        except ApiTelegramException as exc:
+            if 'message is not modified' in exc.description:
+                return
+            logging.warning(f'Cannot edit menu message, sending a new one: {exc!r}')
+            await self.bot.send_message(chat_id=call.message.chat.id, text=text, reply_markup=markup)
 
     async def __command_start(self, message):
         logging.info('Bot starting to work')
@@ -69,101 +333,368 @@ class TelegramBot:
                                          f"Выбери желаемое действие ниже ...",
                                     reply_markup=keyboard)
 
+    async def __command_connect(self, message):
+        if not self.tenants.enabled:
+            await self.bot.send_message(chat_id=message.chat.id,
+                                        text='Бот работает с одним рабочим пространством Notion из настроек')
+            return
+        # сообщение с токеном удаляется из чата сразу, токен хранится только в зашифрованном виде
+        token: str = (message.text or '').partition(' ')[2].strip()
+        try:
+            await self.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+        except ApiTelegramException as exc:
+            logging.warning(f'Cannot delete message with Notion token: {exc!r}')
+        if not token:
+            await self.bot.send_message(chat_id=message.chat.id, text=CONNECT_HINT)
+            return
+        logging.info(f'Bot connecting Notion workspace of user {message.from_user.id}')
+        try:
+            workout_databases: dict[UUID, str] = await self.tenants.connect(message.from_user.id, token)
+        except NotionRequestError as exc:
+            logging.info(f'Notion token of user {message.from_user.id} rejected: {exc}')
+            await self.bot.send_message(chat_id=message.chat.id, text='Notion не принял токен, проверьте его')
+            return
+        except ValueError as exc:
+            logging.error(f'Cannot store Notion token of user {message.from_user.id}: {exc}')
+            await self.bot.send_message(chat_id=message.chat.id,
+                                        text='Подключение рабочих пространств Notion не настроено на сервере')
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logging.warning(f'Cannot connect Notion workspace of user {message.from_user.id}: {exc!r}')
+            await self.bot.send_message(chat_id=message.chat.id, text='Notion недоступен, попробуйте позже')
+            return
+        await self.bot.send_message(chat_id=message.chat.id,
+                                    text=f'Notion подключен, баз данных тренировок: {len(workout_databases)}')
+
+    async def __command_disconnect(self, message):
+        if not self.tenants.enabled:
+            await self.bot.send_message(chat_id=message.chat.id,
+                                        text='Бот работает с одним рабочим пространством Notion из настроек')
+            return
+        await self.tenants.disconnect(message.from_user.id)
+        await self.bot.send_message(chat_id=message.chat.id, text='Notion отключен, токен удален')
+
+    async def __command_refresh(self, message):
+        logging.info('Bot refreshing data from Notion')
+        tenant: Tenant | None = await self.__tenant(message)
+        if tenant is None:
+            return
+        self.__invalidate(tenant)
+        if self.backend is not None:
+            key: str = self.__refresh_key(message)
+            self.__refreshes[key] = uuid4().hex.encode()
+            await self.backend.set(key, self.__refreshes[key])
+        # локальная копия ведется только для рабочего пространства из настроек
+        if self.notion_mirror.enabled and tenant is self.default_tenant:
+            await self.notion_mirror.force_refresh()
+        await self.bot.send_message(chat_id=message.chat.id, text='Данные из Notion обновлены')
+
+    async def __command_stats(self, message):
+        tenant: Tenant | None = await self.__tenant(message)
+        if tenant is None:
+            return
+        logging.info('Bot displaying a list of databases for stats')
+        workout_databases: dict[UUID, str] = await tenant.database_lister.get_workout_databases()
+        await self.bot.send_message(chat_id=message.chat.id,
+                                    text="Выберите тренировку для статистики:",
+                                    reply_markup=self.__databases_keyboard(workout_databases, 'stats'))
+
     async def __work_flow(self, message):
         logging.info(f'Bot processing workflow message "{message.text}"')
         if message.text == "👋 Поздороваться":
             await self.bot.send_message(chat_id=message.chat.id,
                                         text="Привет! Спасибо, что пользуешься мной!)")
         elif message.text == "🦾 Тренировки":
-            workout_databases: dict[UUID, str] = await self.database_lister.get_workout_databases()
-            workout_keyboard_menu = InlineKeyboardMarkup()
-            for key, value in workout_databases.items():
-                workout_keyboard_menu.add(InlineKeyboardButton(text=value,
-                                                               callback_data=f'database/{key}/operations'))
+            tenant: Tenant | None = await self.__tenant(message)
+            if tenant is None:
+                return
+            workout_databases: dict[UUID, str] = await tenant.database_lister.get_workout_databases()
             await self.bot.send_message(chat_id=message.chat.id,
                                         text="Выберите тренировку:",
-                                        reply_markup=workout_keyboard_menu)
+                                        reply_markup=self.__databases_keyboard(workout_databases, 'operations'))
+
+    async def __get_workout_databases(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
+        logging.info('Bot returning to the list of workout databases')
+        workout_databases: dict[UUID, str] = await tenant.database_lister.get_workout_databases()
+        await self.__show_menu(call, "Выберите тренировку:", self.__databases_keyboard(workout_databases, 'operations'))
 
     async def __get_database_operation(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
         params: list[str] = call.data.split('/')
         data_type: str = params[0]
         database_id: UUID = UUID(params[1])
         action: str = params[2]
         logging.info(f'Bot displaying a list of commands for database "{database_id}"')
 
-        databases: dict[UUID, str] = await self.database_lister.get_all_databases()
-        if not databases.get(database_id):
-            # TODO: error
-            print('Error !!!')
+        database_title: str | None = await tenant.database_lister.get_database_title(database_id)
+        if not database_title:
+            await self.bot.send_message(chat_id=call.message.chat.id, text=DATABASE_NOT_FOUND_MESSAGE)
+            return
 
-        workout_keyboard_menu = telebot.types.InlineKeyboardMarkup()
-        workout_keyboard_menu.add(InlineKeyboardButton(text='Показать результат последней тренировки',
-                                                       callback_data=f'{data_type}/{database_id}/last_result'))
-        workout_keyboard_menu.add(InlineKeyboardButton(text='Загрузить новую тренировку',
-                                                       callback_data=f'{data_type}/{database_id}/new_result'))
-        await self.bot.send_message(chat_id=call.message.chat.id,
-                                    text=f"Выберите действие для '{databases.get(database_id)}'",
-                                    reply_markup=workout_keyboard_menu)
+        await self.__show_menu(call, f"Выберите действие для '{database_title}'",
+                               self.__operations_keyboard(data_type, database_id))
 
     async def __process_database_operation(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
         params: list[str] = call.data.split('/')
         data_type: str = params[0]
         database_id: UUID = UUID(params[1])
         action: str = params[2]
 
-        databases: dict[UUID, str] = await self.database_lister.get_all_databases()
-        if not databases.get(database_id):
-            # TODO: error
-            print('Error !!!')
-        database_title: str = databases.get(database_id)
+        database_title: str | None = await tenant.database_lister.get_database_title(database_id)
+        if not database_title:
+            await self.bot.send_message(chat_id=call.message.chat.id, text=DATABASE_NOT_FOUND_MESSAGE)
+            return
 
-        if database_title.split('.')[1].strip() == 'Турник':
+        workout_type: str | None = self.__workout_type(database_title)
+        if workout_type == 'Турник':
             report: dict[str, dict[str, int]] = \
-                await self.database_workout_operator.get_report_last_workout(database_id=database_id)
-            await self.bot.send_message(chat_id=call.message.chat.id,
-                                        text=self.database_workout_operator.convert_report_to_str_mess(report))
-        elif database_title.split('.')[1].strip() == 'Пробежка':
-            report = await self.database_run_operator.get_report_last_workout(database_id=database_id)
-            await self.bot.send_message(chat_id=call.message.chat.id,
-                                        text=self.database_run_operator.convert_report_to_str_mess(report))
+                await tenant.database_workout_operator.get_report_last_workout(database_id=database_id)
+            text: str = tenant.database_workout_operator.convert_report_to_str_mess(report)
+        elif workout_type == 'Пробежка':
+            report = await tenant.database_run_operator.get_report_last_workout(database_id=database_id)
+            text = tenant.database_run_operator.convert_report_to_str_mess(report)
+        else:
+            await self.bot.send_message(chat_id=call.message.chat.id, text='Для этой базы данных отчет недоступен')
+            return
+        await self.bot.send_message(chat_id=call.message.chat.id, text=text if report else NO_WORKOUTS_MESSAGE)
+
+    @staticmethod
+    def __workout_type(database_title: str) -> str | None:
+        # название базы данных тренировок имеет вид "Тренировка. <вид тренировки>"
+        parts: list[str] = database_title.split('.')
+        return parts[1].strip() if len(parts) > 1 else None
+
+    async def __process_database_stats(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
+        database_id: UUID = UUID(call.data.split('/')[1])
+        logging.info(f'Bot displaying stats for database "{database_id}"')
+
+        database_title: str | None = await tenant.database_lister.get_database_title(database_id)
+        if not database_title:
+            await self.bot.send_message(chat_id=call.message.chat.id, text=DATABASE_NOT_FOUND_MESSAGE)
+            return
+
+        workout_type: str | None = self.__workout_type(database_title)
+        if workout_type == 'Турник':
+            text: str = await tenant.workout_analytics.get_workout_stats_message(database_id)
+        elif workout_type == 'Пробежка':
+            text = await tenant.workout_analytics.get_run_stats_message(database_id)
+        else:
+            text = 'Для этой базы данных статистика недоступна'
+        await self.bot.send_message(chat_id=call.message.chat.id, text=text)
+
+    async def __process_database_chart(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
+        database_id: UUID = UUID(call.data.split('/')[1])
+        logging.info(f'Bot sending charts for database "{database_id}"')
+
+        database_title: str | None = await tenant.database_lister.get_database_title(database_id)
+        if not database_title:
+            await self.bot.send_message(chat_id=call.message.chat.id, text=DATABASE_NOT_FOUND_MESSAGE)
+            return
+
+        chart_types: tuple[str, ...] = CHART_TYPES_BY_WORKOUT.get(self.__workout_type(database_title), ())
+        if not chart_types:
+            await self.bot.send_message(chat_id=call.message.chat.id, text='Для этой базы данных графиков нет')
+            return
+        for chart_type in chart_types:
+            chart: ChartData | None = await tenant.workout_analytics.get_chart_data(database_id, chart_type)
+            if chart is None:
+                await self.bot.send_message(chat_id=call.message.chat.id, text=NO_WORKOUTS_MESSAGE)
+                return
+            await self.__send_chart(call.message.chat.id, database_id, chart)
+
+    async def __send_chart(self, chat_id: int, database_id: UUID, chart: ChartData):
+        file_id: str | None = self.chart_renderer.get_file_id(database_id, chart)
+        if file_id is not None:
+            try:
+                await self.bot.send_photo(chat_id=chat_id, photo=file_id, caption=chart.caption)
+                return
+            except ApiTelegramException as exc:
+                logging.warning(f'Cannot resend chart by file_id, rendering again: {exc!r}')
+                self.chart_renderer.forget_file_id(database_id, chart)
+        try:
+            png: bytes = await self.chart_renderer.render(chart)
+        except asyncio.TimeoutError:
+            await self.bot.send_message(chat_id=chat_id, text='Не удалось построить график за отведенное время')
+            return
+        message = await self.bot.send_photo(chat_id=chat_id, photo=png, caption=chart.caption)
+        self.chart_renderer.put_file_id(database_id, chart, message.photo[-1].file_id)
 
     async def __process_database_operation_tmp(self, call):
+        tenant: Tenant | None = await self.__tenant(call)
+        if tenant is None:
+            return
         params: list[str] = call.data.split('/')
         data_type: str = params[0]
         database_id: UUID = UUID(params[1])
         action: str = params[2]
 
-        databases: dict[UUID, str] = await self.database_lister.get_all_databases()
-        if not databases.get(database_id):
-            # TODO: error
-            print('Error !!!')
-        database_title: str = databases.get(database_id)
+        database_title: str | None = await tenant.database_lister.get_database_title(database_id)
+        if not database_title:
+            await self.bot.send_message(chat_id=call.message.chat.id, text=DATABASE_NOT_FOUND_MESSAGE)
+            return
 
         # if database_title.split('.')[1].strip() == 'Турник':
         #     report: dict[str, dict[str, int]] = \
-        #         await self.database_workout_operator.get_report_last_workout(database_id=database_id)
+        #         await tenant.database_workout_operator.get_report_last_workout(database_id=database_id)
         #     await self.bot.send_message(chat_id=call.message.chat.id,
-        #                                 text=self.database_workout_operator.convert_report_to_str_mess(report))
-        if database_title.split('.')[1].strip() == 'Пробежка':
-            print('CHECK !')
-            mesg = await self.bot.send_message(call.message.chat.id, 'Отправте скрин тренировки в сообщении')
-            # report = await self.database_run_operator.get_report_last_workout(database_id=database_id)
+        #                                 text=tenant.database_workout_operator.convert_report_to_str_mess(report))
+        if self.__workout_type(database_title) == 'Пробежка':
+            await self.bot.send_message(call.message.chat.id, 'Отправте скрин тренировки в сообщении')
+            # report = await tenant.database_run_operator.get_report_last_workout(database_id=database_id)
             # await self.bot.send_message(chat_id=call.message.chat.id,
-            #                             text=self.database_run_operator.convert_report_to_str_mess(report))
+            #                             text=tenant.database_run_operator.convert_report_to_str_mess(report))
+
+    async def __recognize_document(self, document) -> dict:
+        """
+        Распознавание скриншота пробежки с использованием кэша результатов
+
+        :param document: документ из сообщения Telegram
+        :return: данные тренировки
+
+        :raises RECOGNITION_ERRORS: если скриншот не удалось скачать или распознать
+        """
+        file_unique_id: str = document.file_unique_id
+        data: dict | None = await self.ocr_cache.get(self.ocr_cache.file_key(file_unique_id))
+        if data is not None:
+            logging.info(f'OCR cache hit for file "{file_unique_id}"')
+            return data
+
+        async with self.file_downloader.download(document.file_id, document.file_size) as downloaded_file:
+            content_key: str = self.ocr_cache.digest_key(downloaded_file.sha256)
+            data = await self.ocr_cache.get(content_key)
+            if data is None and self.image_operator.engine == 'layout':
+                data = await self.image_operator.parse_image_fields(downloaded_file.read())
+            elif data is None:
+                text: str = await self.image_operator.parse_image_bytes(downloaded_file.read())
+                data = self.default_tenant.database_run_operator.convert_image_str_to_data(text)
+            else:
+                logging.info(f'OCR cache hit for content of file "{file_unique_id}"')
+        await self.ocr_cache.put(data, content_key, file_unique_id)
+        return data
+
+    async def __recognize_run_report(self, message) -> dict | None:
+        """
+        Распознавание скриншота пробежки с ответом пользователю, если распознавание не удалось
+
+        :return: данные тренировки или None, если распознавание не удалось
+        """
+        try:
+            return await self.__recognize_document(message.document)
+        except RECOGNITION_ERRORS as exc:
+            logging.info(f'File "{message.document.file_unique_id}" not recognized: {exc!r}')
+            await self.bot.reply_to(message, recognition_error_message(exc))
+            return None
 
     async def __process_file(self, message):
-        if message.caption == 'Тренировка. Пробежка':
-            file_info = await self.bot.get_file(message.document.file_id)
-            downloaded_file = await self.bot.download_file(file_info.file_path)
-            image = Image.open(io.BytesIO(downloaded_file))
-
-            image_operator = ImageOperator()
-            text: str = image_operator.parse_image_to_string(image)
-            data: dict = self.database_run_operator.convert_image_str_to_data(text)
-            print('----------')
-            print(data)
-            print('----------')
-            await self.database_run_operator.send_new_report(data)
+        if message.media_group_id:
+            # альбом обрабатывается целиком, когда придут все его сообщения
+            self.media_groups.add(message)
+            return
+        if message.caption == RUN_REPORT_CAPTION:
+            tenant: Tenant | None = await self.__tenant(message)
+            if tenant is None:
+                return
+            database_id: str | None = await self.__run_database_id(tenant, message)
+            if database_id is None:
+                return
+            data: dict | None = await self.__recognize_run_report(message)
+            if data is None:
+                return
+            logging.debug(f'Recognized run report {data}')
+            try:
+                page: dict = tenant.database_run_operator.build_new_report_page(data, database_id)
+            except (AttributeError, IndexError, KeyError, TypeError, ValueError) as exc:
+                logging.info(f'Incomplete run report {data}: {exc!r}')
+                await self.bot.reply_to(message, INCOMPLETE_REPORT_MESSAGE)
+                return
+            await self.page_write_queue.enqueue(page, self.__tenant_id(message))
+            await self.bot.reply_to(message, 'Тренировка принята и будет сохранена в Notion')
+
+    async def __dispatch_media_group(self, messages: list):
+        await self.dispatcher.dispatch(messages[0].chat.id, HEAVY_LANE,
+                                       lambda: self.__observe(self.__process_media_group, messages))
+
+    async def __process_media_group(self, messages: list):
+        if not any(message.caption == RUN_REPORT_CAPTION for message in messages):
+            return
+        tenant: Tenant | None = await self.__tenant(messages[0])
+        if tenant is None:
+            return
+        database_id: str | None = await self.__run_database_id(tenant, messages[0])
+        if database_id is None:
+            return
+        documents = [message for message in messages if message.document is not None]
+        logging.info(f'Bot processing media group of {len(documents)} documents')
+        # распознавание параллельно, но не больше задач, чем процессов распознавания
+        semaphore = asyncio.Semaphore(self.image_operator.workers)
+
+        async def recognize(document) -> dict | BaseException:
+            async with semaphore:
+                try:
+                    return await self.__recognize_document(document)
+                except RECOGNITION_ERRORS as exc:
+                    logging.info(f'File "{document.file_unique_id}" not recognized: {exc!r}')
+                    return exc
+
+        results: list = await asyncio.gather(*(recognize(message.document) for message in documents))
+        errors: list[BaseException] = [result for result in results if isinstance(result, BaseException)]
+        reports: list[dict] = DatabaseRunOperator.merge_reports(
+            [result for result in results if not isinstance(result, BaseException)])
+
+        pages: list[dict] = []
+        incomplete: int = 0
+        for report in reports:
+            try:
+                pages.append(tenant.database_run_operator.build_new_report_page(report, database_id))
+            except (AttributeError, IndexError, KeyError, TypeError, ValueError) as exc:
+                logging.info(f'Incomplete run report {report}: {exc!r}')
+                incomplete += 1
+        if pages:
+            await self.page_write_queue.enqueue_many(pages, self.__tenant_id(messages[0]))
+
+        lines: list[str] = [f'Скринов: {len(documents)}, распознано: {len(documents) - len(errors)}',
+                            f'Тренировок принято: {len(pages)}, будут сохранены в Notion']
+        if incomplete:
+            lines.append(f'Не хватает данных для тренировок: {incomplete}')
+        for error_message in dict.fromkeys(recognition_error_message(error) for error in errors):
+            lines.append(error_message)
+        await self.bot.reply_to(messages[0], '\n'.join(lines))
+
+    async def start(self, sync_mirror: bool = True):
+        """
+        Запуск фоновых сервисов бота без приема обновлений
+
+        :param sync_mirror: запускать синхронизацию зеркала Notion, при шардировании ее выполняет один процесс
+        """
+        self.image_operator.warm_up()
+        if sync_mirror:
+            self.notion_mirror.start()
+        await self.page_write_queue.start()
 
     async def run(self):
+        await self.start()
         await self.bot.infinity_polling()
+
+    async def run_webhook(self, settings: BotSettings | None = None):
+        await self.start()
+        await WebhookServer(bot=self.bot, settings=settings).run()
+
+    async def close(self):
+        """
+        Обработка уже собранных альбомов перед остановкой
+        """
+        await self.media_groups.close()
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, TYPE_CHECKING
+
+from common import http_client_settings, tenant_settings, TenantSettings
+from services.database_lister import DatabaseLister
+from services.database_operator import DatabaseOperator, DatabaseWorkoutOperator, DatabaseRunOperator
+from services.coordination import CoordinationBackend
+from services.metrics import metrics_registry
+from services.request_operator import RequestOperator
+from services.workout_analytics import WorkoutAnalytics
+
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+    user_id INTEGER PRIMARY KEY,
+    token BLOB NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class TenantStore:
+    """
+    Привязки пользователей Telegram к рабочим пространствам Notion в SQLite.
+
+    Токены интеграций хранятся зашифрованными ключом Fernet из настроек,
+    cryptography загружается при первом обращении к токену, а не при запуске бота
+    """
+
+    def __init__(self, settings: TenantSettings | None = None) -> None:
+        self.settings = settings if settings else tenant_settings
+        self.__fernet: 'Fernet | None' = None
+        self.__connection: sqlite3.Connection | None = None
+        self.__lock = asyncio.Lock()
+
+    def __cipher(self) -> 'Fernet':
+        from cryptography.fernet import Fernet
+
+        if self.__fernet is None:
+            if not self.settings.encryption_key:
+                raise ValueError('TENANTS_ENCRYPTION_KEY is required to store Notion tokens')
+            self.__fernet = Fernet(self.settings.encryption_key)
+        return self.__fernet
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.settings.store_path, check_same_thread=False)
+            self.__connection.executescript(SCHEMA)
+        return self.__connection
+
+    async def __execute(self, func, *args):
+        # sqlite вызывается в отдельном потоке, запросы к соединению выполняются по очереди
+        async with self.__lock:
+            return await asyncio.to_thread(func, self.__connect(), *args)
+
+    @staticmethod
+    def __select(connection: sqlite3.Connection, user_id: int) -> bytes | None:
+        row = connection.execute('SELECT token FROM tenants WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def __upsert(connection: sqlite3.Connection, user_id: int, token: bytes) -> None:
+        with connection:
+            connection.execute('INSERT INTO tenants (user_id, token, updated_at) VALUES (?, ?, ?) '
+                               'ON CONFLICT (user_id) DO UPDATE SET token = excluded.token, '
+                               'updated_at = excluded.updated_at', (user_id, token, time.time()))
+
+    @staticmethod
+    def __delete(connection: sqlite3.Connection, user_id: int) -> None:
+        with connection:
+            connection.execute('DELETE FROM tenants WHERE user_id = ?', (user_id,))
+
+    async def get_token(self, user_id: int) -> str | None:
+        """
+        Получение токена интеграции пользователя
+
+        :param user_id: id пользователя Telegram
+        :return: токен или None, если пользователь не подключил Notion или токен не расшифровывается ключом
+        """
+        from cryptography.fernet import InvalidToken
+
+        encrypted: bytes | None = await self.__execute(self.__select, user_id)
+        if encrypted is None:
+            return None
+        try:
+            return self.__cipher().decrypt(encrypted).decode()
+        except InvalidToken:
+            logging.warning(f'Notion token of user {user_id} cannot be decrypted with the current key')
+            return None
+
+    async def set_token(self, user_id: int, token: str) -> None:
+        await self.__execute(self.__upsert, user_id, self.__cipher().encrypt(token.encode()))
+
+    async def delete(self, user_id: int) -> None:
+        await self.__execute(self.__delete, user_id)
+
+    async def close(self) -> None:
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+
+class Tenant:
+    """
+    Сервисы одного рабочего пространства Notion: свой оператор запросов с отдельными пулом соединений
+    и ограничителем частоты, а также свои кэши списка баз, схем и истории тренировок
+    """
+
+    def __init__(self,
+                 request_operator: RequestOperator,
+                 database_lister: DatabaseLister,
+                 database_workout_operator: DatabaseWorkoutOperator,
+                 database_run_operator: DatabaseRunOperator,
+                 workout_analytics: WorkoutAnalytics,
+                 token: str | None = None) -> None:
+        """
+        :param token: токен интеграции Notion, None - токен из настроек
+        """
+        self.request_operator = request_operator
+        self.database_lister = database_lister
+        self.database_workout_operator = database_workout_operator
+        self.database_run_operator = database_run_operator
+        self.workout_analytics = workout_analytics
+        self.database_operator = DatabaseOperator(request_operator=request_operator, token=token)
+        self.last_used: float = time.monotonic()
+        # обработчики и отправки очереди записи, использующие сервисы прямо сейчас
+        self.leases: int = 0
+        self.retired: bool = False
+
+    @classmethod
+    def create(cls,
+               token: str,
+               settings: TenantSettings | None = None,
+               backend: CoordinationBackend | None = None,
+               user_id: int | None = None) -> 'Tenant':
+        """
+        Создание сервисов рабочего пространства по токену интеграции
+
+        :param token: токен интеграции Notion
+        :param settings: настройки пользователей, ограничивающие пул соединений
+        :param backend: общее хранилище ограничителя частоты при работе в нескольких процессах
+        :param user_id: id пользователя Telegram, ключ ограничителя в общем хранилище
+        :return: сервисы рабочего пространства
+        """
+        settings = settings if settings else tenant_settings
+        request_operator = RequestOperator(
+            settings=http_client_settings.model_copy(update={'connections_limit': settings.connections_limit,
+                                                             'connections_limit_per_host': settings.connections_limit}),
+            gauges=False,
+            backend=backend,
+            rate_limit_key=f'tenant:{user_id}'
+        )
+        database_workout_operator = DatabaseWorkoutOperator(request_operator=request_operator, token=token)
+        database_run_operator = DatabaseRunOperator(request_operator=request_operator, token=token)
+        return cls(
+            request_operator=request_operator,
+            database_lister=DatabaseLister(request_operator=request_operator, token=token),
+            database_workout_operator=database_workout_operator,
+            database_run_operator=database_run_operator,
+            workout_analytics=WorkoutAnalytics(database_workout_operator=database_workout_operator,
+                                               database_run_operator=database_run_operator),
+            token=token
+        )
+
+    async def close(self) -> None:
+        await self.request_operator.close()
+
+    async def retire(self) -> None:
+        """
+        Закрытие сервисов, вытесненных из реестра: если ими еще пользуются, соединения закрываются
+        после завершения последнего обращения
+        """
+        self.retired = True
+        if not self.leases:
+            await self.close()
+
+
+class TenantRegistry:
+    """
+    Рабочие пространства Notion пользователей бота.
+
+    Сервисы пользователя создаются при первом обращении и хранятся, пока пользователь активен:
+    не дольше idle_ttl с последнего обращения и не больше max_active пространств одновременно,
+    при превышении закрываются давно не использовавшиеся. Закрытие освобождает соединения и кэши,
+    при следующем обращении сервисы создаются заново по токену из хранилища.
+
+    Сервисы выдаются в аренду (acquire/release или lease): вытесненные сервисы закрываются,
+    только когда их больше не использует ни один обработчик или отправка очереди записи
+    """
+
+    def __init__(self,
+                 store: TenantStore,
+                 settings: TenantSettings | None = None,
+                 backend: CoordinationBackend | None = None) -> None:
+        self.settings = settings if settings else tenant_settings
+        self.store = store
+        self.backend = backend
+        self.__tenants: OrderedDict[int, Tenant] = OrderedDict()
+        # блокировка загрузки сервисов пользователя существует, пока ее ждет хотя бы один обработчик,
+        # иначе словарь рос бы с каждым написавшим боту пользователем
+        self.__locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        self.evicted_count: int = 0
+        metrics_registry.gauge('tenants_active', 'Notion workspaces with open services', lambda: len(self.__tenants))
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.enabled
+
+    @property
+    def active(self) -> int:
+        return len(self.__tenants)
+
+    async def __evict(self) -> None:
+        now = time.monotonic()
+        evicted: list[Tenant] = []
+        while self.__tenants:
+            user_id, tenant = next(iter(self.__tenants.items()))
+            if len(self.__tenants) <= self.settings.max_active and now - tenant.last_used < self.settings.idle_ttl:
+                break
+            del self.__tenants[user_id]
+            evicted.append(tenant)
+        if evicted:
+            self.evicted_count += len(evicted)
+            logging.info(f'Closed services of {len(evicted)} idle Notion workspaces')
+            await asyncio.gather(*(tenant.retire() for tenant in evicted))
+
+    def __remember(self, user_id: int, tenant: Tenant) -> None:
+        self.__tenants[user_id] = tenant
+        self.__tenants.move_to_end(user_id)
+
+    async def acquire(self, user_id: int) -> Tenant | None:
+        """
+        Получение сервисов рабочего пространства пользователя в аренду,
+        после использования сервисы возвращаются вызовом release
+
+        :param user_id: id пользователя Telegram
+        :return: сервисы или None, если пользователь не подключил Notion
+        """
+        tenant: Tenant | None = self.__tenants.get(user_id)
+        if tenant is None:
+            lock: asyncio.Lock = self.__locks.setdefault(user_id, asyncio.Lock())
+            async with lock:
+                tenant = self.__tenants.get(user_id)
+                if tenant is None:
+                    token: str | None = await self.store.get_token(user_id)
+                    if token is None:
+                        return None
+                    tenant = Tenant.create(token, self.settings, self.backend, user_id)
+                    self.__remember(user_id, tenant)
+        # аренда берется до вытеснения: иначе сервисы могли бы закрыться, еще не начав работу
+        tenant.leases += 1
+        tenant.last_used = time.monotonic()
+        self.__tenants.move_to_end(user_id)
+        await self.__evict()
+        return tenant
+
+    @staticmethod
+    async def release(tenant: Tenant) -> None:
+        tenant.leases -= 1
+        if tenant.retired and not tenant.leases:
+            await tenant.close()
+
+    @asynccontextmanager
+    async def lease(self, user_id: int) -> AsyncIterator[Tenant | None]:
+        """
+        Сервисы рабочего пространства пользователя на время блока with
+
+        :param user_id: id пользователя Telegram
+        :return: сервисы или None, если пользователь не подключил Notion
+        """
+        tenant: Tenant | None = await self.acquire(user_id)
+        try:
+            yield tenant
+        finally:
+            if tenant is not None:
+                await self.release(tenant)
+
+    async def connect(self, user_id: int, token: str) -> dict:
+        """
+        Привязка рабочего пространства к пользователю: токен проверяется запросом списка баз данных
+        и сохраняется зашифрованным
+
+        :param user_id: id пользователя Telegram
+        :param token: токен интеграции Notion
+        :return: базы данных тренировок рабочего пространства
+
+        :raises NotionRequestError: если Notion не принял токен
+        :raises ValueError: если не задан ключ шифрования токенов
+        """
+        tenant = Tenant.create(token, self.settings, self.backend, user_id)
+        try:
+            databases = await tenant.database_lister.get_workout_databases()
+            await self.store.set_token(user_id, token)
+        except Exception:
+            await tenant.close()
+            raise
+        previous: Tenant | None = self.__tenants.pop(user_id, None)
+        if previous is not None:
+            await previous.retire()
+        self.__remember(user_id, tenant)
+        await self.__evict()
+        return databases
+
+    async def disconnect(self, user_id: int) -> None:
+        await self.store.delete(user_id)
+        tenant: Tenant | None = self.__tenants.pop(user_id, None)
+        if tenant is not None:
+            await tenant.retire()
+
+    async def close(self) -> None:
+        tenants, self.__tenants = list(self.__tenants.values()), OrderedDict()
+        await asyncio.gather(*(tenant.close() for tenant in tenants))
+        await self.store.close()
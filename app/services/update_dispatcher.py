@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+from common import dispatcher_settings, DispatcherSettings
+from services.metrics import dispatch_queue_delay
+
+
+INTERACTIVE_LANE = 'interactive'
+HEAVY_LANE = 'heavy'
+
+
+class LaneMetrics:
+    """
+    Метрики очереди обработки обновлений одной полосы
+    """
+
+    def __init__(self) -> None:
+        self.dispatched: int = 0
+        self.deduplicated: int = 0
+        self.waiting: int = 0
+        self.total_queue_delay: float = 0.0
+        self.max_queue_delay: float = 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            'dispatched': self.dispatched,
+            'deduplicated': self.deduplicated,
+            'waiting': self.waiting,
+            'mean_queue_delay': self.total_queue_delay / self.dispatched if self.dispatched else 0.0,
+            'max_queue_delay': self.max_queue_delay,
+        }
+
+
+class UpdateDispatcher:
+    """
+    Диспетчер обработки обновлений Telegram.
+
+    Обновления одного чата в одной полосе обрабатываются строго по очереди, повторные одинаковые
+    нажатия кнопок, пока первое еще обрабатывается, отбрасываются. Тяжелые задачи (распознавание скриншотов)
+    идут в отдельную полосу со своим ограничением, чтобы не занимать места быстрых ответов
+    """
+
+    def __init__(self, settings: DispatcherSettings | None = None) -> None:
+        self.settings = settings if settings else dispatcher_settings
+        self.__lanes: dict[str, asyncio.Semaphore] = {
+            INTERACTIVE_LANE: asyncio.Semaphore(self.settings.interactive_concurrency),
+            HEAVY_LANE: asyncio.Semaphore(self.settings.heavy_concurrency),
+        }
+        self.__chat_locks: dict[tuple[int, str], asyncio.Lock] = {}
+        self.__chat_waiters: dict[tuple[int, str], int] = {}
+        self.__in_flight: set[Hashable] = set()
+        self.metrics: dict[str, LaneMetrics] = {lane: LaneMetrics() for lane in self.__lanes}
+
+    async def dispatch(self,
+                       chat_id: int,
+                       lane: str,
+                       handler: Callable[[], Awaitable],
+                       dedup_key: Hashable | None = None) -> None:
+        """
+        Обработка обновления с учетом очереди чата и ограничений полосы
+
+        :param chat_id: id чата
+        :param lane: полоса обработки (INTERACTIVE_LANE или HEAVY_LANE)
+        :param handler: корутина-фабрика обработчика
+        :param dedup_key: ключ для отбрасывания повторов, пока обработка с тем же ключом не завершена
+        """
+        metrics: LaneMetrics = self.metrics[lane]
+        if dedup_key is not None:
+            if dedup_key in self.__in_flight:
+                metrics.deduplicated += 1
+                logging.info(f'Duplicate update "{dedup_key}" skipped')
+                return
+            self.__in_flight.add(dedup_key)
+
+        chat_key = (chat_id, lane)
+        lock = self.__chat_locks.setdefault(chat_key, asyncio.Lock())
+        self.__chat_waiters[chat_key] = self.__chat_waiters.get(chat_key, 0) + 1
+        enqueued_at = time.monotonic()
+        waiting = True
+        metrics.waiting += 1
+        try:
+            async with lock:
+                async with self.__lanes[lane]:
+                    metrics.waiting -= 1
+                    waiting = False
+                    queue_delay = time.monotonic() - enqueued_at
+                    metrics.dispatched += 1
+                    metrics.total_queue_delay += queue_delay
+                    metrics.max_queue_delay = max(metrics.max_queue_delay, queue_delay)
+                    dispatch_queue_delay.observe(queue_delay, lane=lane)
+                    await handler()
+        finally:
+            if waiting:
+                metrics.waiting -= 1
+            self.__chat_waiters[chat_key] -= 1
+            if not self.__chat_waiters[chat_key]:
+                del self.__chat_waiters[chat_key]
+                del self.__chat_locks[chat_key]
+            if dedup_key is not None:
+                self.__in_flight.discard(dedup_key)
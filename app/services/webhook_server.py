@@ -0,0 +1,143 @@
+import asyncio
+import hmac
+import logging
+from typing import Callable
+
+from aiohttp import web
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Update
+
+from common import bot_settings, BotSettings
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Сервер для приема обновлений Telegram через webhook.
+
+    Обновление подтверждается Telegram сразу после постановки в очередь,
+    обработку выполняет ограниченное число рабочих задач.
+    При заданном forward обновления не обрабатываются, а передаются дальше, например процессам-обработчикам
+    """
+
+    def __init__(self,
+                 bot: AsyncTeleBot,
+                 settings: BotSettings | None = None,
+                 forward: Callable[[dict], bool] | None = None) -> None:
+        """
+        :param bot: бот, обрабатывающий обновления, в режиме forward только регистрирует webhook
+        :param settings: настройки webhook
+        :param forward: передача обновления в исходном виде, False - обновление не принято
+        """
+        self.bot = bot
+        self.forward = forward
+        self.settings = settings if settings else bot_settings
+        self.queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=self.settings.webhook_queue_size)
+        self.__workers: list[asyncio.Task] = []
+        self.__runner: web.AppRunner | None = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.settings.webhook_path, self.__handle_update)
+        return app
+
+    def __authorized(self, request: web.Request) -> bool:
+        if not self.settings.webhook_secret_token:
+            return True
+        # сравнение за постоянное время, чтобы секрет нельзя было подобрать по времени ответа
+        return hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, '').encode(),
+                                   self.settings.webhook_secret_token.encode())
+
+    @staticmethod
+    async def __read_update(request: web.Request) -> dict | None:
+        """
+        Чтение обновления из тела запроса
+
+        :param request: запрос Telegram
+        :return: обновление в исходном виде или None, если тело не является JSON объектом обновления
+        """
+        try:
+            raw = await request.json()
+        except ValueError:
+            return None
+        if not isinstance(raw, dict) or not isinstance(raw.get('update_id'), int):
+            return None
+        return raw
+
+    async def __handle_update(self, request: web.Request) -> web.Response:
+        if not self.__authorized(request):
+            return web.Response(status=403)
+        raw: dict | None = await self.__read_update(request)
+        if raw is None:
+            return web.Response(status=400)
+        if self.forward is not None:
+            return self.__forward_update(raw)
+        try:
+            update: Update = Update.de_json(raw)
+        except (ValueError, TypeError, KeyError, AttributeError) as exc:
+            logging.warning(f'Malformed update {raw["update_id"]} rejected: {exc!r}')
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку обновления позже
+            logging.warning(f'Webhook queue is full, update {update.update_id} rejected')
+            return web.Response(status=503)
+        return web.Response()
+
+    def __forward_update(self, raw: dict) -> web.Response:
+        if not self.forward(raw):
+            logging.warning(f'Update {raw["update_id"]} rejected, worker queue is full')
+            return web.Response(status=503)
+        return web.Response()
+
+    async def __worker(self) -> None:
+        while True:
+            update: Update = await self.queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as exc:
+                logging.exception(f'Error processing update {update.update_id}: {exc!r}')
+            finally:
+                self.queue.task_done()
+
+    async def start(self) -> None:
+        """
+        Запуск рабочих задач и http сервера
+        """
+        if self.forward is None:
+            self.__workers = [asyncio.create_task(self.__worker()) for _ in range(self.settings.webhook_workers)]
+        self.__runner = web.AppRunner(self.make_app())
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.settings.webhook_host, self.settings.webhook_port)
+        await site.start()
+        logging.info(f'Webhook server listening on '
+                     f'{self.settings.webhook_host}:{self.settings.webhook_port}{self.settings.webhook_path}')
+
+    async def stop(self) -> None:
+        """
+        Остановка http сервера, обработка уже принятых обновлений и остановка рабочих задач
+        """
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+        await self.queue.join()
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+
+    async def run(self) -> None:
+        """
+        Регистрация webhook в Telegram и работа сервера до отмены задачи
+        """
+        if self.settings.webhook_url:
+            await self.bot.set_webhook(url=self.settings.webhook_url + self.settings.webhook_path,
+                                       secret_token=self.settings.webhook_secret_token)
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING
+from uuid import UUID
+
+from common import cache_settings, CacheSettings
+from services.chart_renderer import ChartData
+from services.database_operator import DatabaseWorkoutOperator, DatabaseRunOperator, WorkoutReportOperator
+
+if TYPE_CHECKING:
+    from services.workout_stats import WorkoutHistory
+
+
+class CachedHistory:
+    """
+    История базы данных вместе с состоянием синхронизации
+    """
+
+    def __init__(self, history: 'WorkoutHistory', synced_until: str | None, synced_at: float) -> None:
+        self.history = history
+        self.synced_until = synced_until
+        self.synced_at = synced_at
+
+
+class WorkoutAnalytics:
+    """
+    Статистика тренировок по всей истории базы данных.
+
+    История загружается постранично один раз и хранится в колоночном виде (numpy), затем
+    дополняется только записями, измененными после прошлой синхронизации, не чаще раза в stats_ttl.
+    numpy загружается при первом запросе статистики, а не при запуске бота
+    """
+
+    def __init__(self,
+                 database_workout_operator: DatabaseWorkoutOperator,
+                 database_run_operator: DatabaseRunOperator,
+                 settings: CacheSettings | None = None) -> None:
+        self.database_workout_operator = database_workout_operator
+        self.database_run_operator = database_run_operator
+        self.settings = settings if settings else cache_settings
+        self.__histories: dict[UUID, CachedHistory] = {}
+        self.__locks: dict[UUID, asyncio.Lock] = {}
+
+    def invalidate(self, database_id: UUID | None = None) -> None:
+        """
+        Сброс истории, следующий запрос загрузит ее полностью
+
+        :param database_id: id базы данных, None - все базы
+        """
+        if database_id is None:
+            self.__histories.clear()
+        else:
+            self.__histories.pop(database_id, None)
+
+    async def get_history(self, database_id: UUID, operator: WorkoutReportOperator) -> 'WorkoutHistory':
+        """
+        Получение истории базы данных с инкрементальным обновлением
+
+        :param database_id: id базы данных
+        :param operator: оператор базы данных, определяющий показатели записей
+        :return: история тренировок
+        """
+        from services.workout_stats import WorkoutHistory
+
+        async with self.__locks.setdefault(database_id, asyncio.Lock()):
+            cached: CachedHistory | None = self.__histories.get(database_id)
+            if cached is not None and time.monotonic() - cached.synced_at < self.settings.stats_ttl:
+                return cached.history
+            records, newest = await operator.get_records_edited_since(
+                database_id, cached.synced_until if cached is not None else None)
+            update = WorkoutHistory.from_rows([
+                (record.get('id'), (record.get('properties', {}).get('Дата', {}).get('date') or {}).get('start'),
+                 operator.history_row(record.get('properties', {})))
+                for record in records
+            ])
+            history = cached.history.merge(update) if cached is not None else update
+            self.__histories[database_id] = CachedHistory(
+                history, newest or (cached.synced_until if cached is not None else None), time.monotonic())
+            logging.info(f'Stats history of database with id {database_id} updated with {len(records)} records')
+            return history
+
+    async def get_workout_stats_message(self, database_id: UUID) -> str:
+        """
+        Статистика тренировок на турнике: повторения по неделям и месяцам, рекорды и среднее за 5 тренировок
+
+        :param database_id: id базы данных
+        :return: сообщение для Telegram
+        """
+        history, plan = await asyncio.gather(
+            self.get_history(database_id, self.database_workout_operator),
+            self.database_workout_operator.get_report_plan(database_id)
+        )
+        if not len(history):
+            return 'В базе данных пока нет тренировок'
+        lines: list[str] = [f'Тренировок: {len(history)}']
+        for header, _ in plan.exercises:
+            exercise: str = header.split('.')[0]
+            lines.append('')
+            lines.append(header)
+            lines.extend(self.__period_lines(history, exercise, 'week', 'повт.'))
+            lines.extend(self.__period_lines(history, exercise, 'month', 'повт.'))
+            record = history.record(exercise)
+            if record is not None:
+                lines.append(f'Рекорд: {record[0]:.0f} повт. ({record[1]})')
+            rolling = history.rolling_mean(exercise, 5)
+            if len(rolling):
+                lines.append(f'Среднее за 5 тренировок: {rolling[-1]:.1f} повт.')
+        return '\n'.join(lines)
+
+    async def get_run_stats_message(self, database_id: UUID) -> str:
+        """
+        Статистика пробежек: дистанция по неделям и месяцам, рекорды и средний темп за 5 пробежек
+
+        :param database_id: id базы данных
+        :return: сообщение для Telegram
+        """
+        history = await self.get_history(database_id, self.database_run_operator)
+        if not len(history):
+            return 'В базе данных пока нет тренировок'
+        lines: list[str] = [f'Пробежек: {len(history)}, всего {history.total("distance"):.1f} км']
+        lines.extend(self.__period_lines(history, 'distance', 'week', 'км'))
+        lines.extend(self.__period_lines(history, 'distance', 'month', 'км'))
+        for name, title, highest, unit in (('distance', 'Самая длинная', True, 'км'),
+                                           ('pace', 'Лучший темп', False, 'мин/км'),
+                                           ('heart_rate', 'Самый низкий средний пульс', False, 'уд/мин')):
+            record = history.record(name, highest=highest)
+            if record is not None:
+                lines.append(f'{title}: {self.__format_value(name, record[0])} {unit} ({record[1]})')
+        rolling = history.rolling_mean('pace', 5)
+        if len(rolling):
+            lines.append(f'Средний темп за 5 пробежек: {self.__format_value("pace", rolling[-1])} мин/км')
+        return '\n'.join(lines)
+
+    async def get_chart_data(self, database_id: UUID, chart_type: str) -> ChartData | None:
+        """
+        Данные графика прогресса: повторения по упражнениям (reps), дистанция (distance) или темп (pace)
+        пробежек со скользящим средним за 5 пробежек
+
+        :param database_id: id базы данных
+        :param chart_type: тип графика из CHART_TYPES
+        :return: данные графика или None, если в базе нет тренировок
+        """
+        import numpy as np
+
+        if chart_type == 'reps':
+            history, plan = await asyncio.gather(
+                self.get_history(database_id, self.database_workout_operator),
+                self.database_workout_operator.get_report_plan(database_id)
+            )
+            exercises: list[str] = [header.split('.')[0] for header, _ in plan.exercises]
+            series = {f'#{exercise}': history.column(exercise) for exercise in exercises}
+            caption = 'Повторения по тренировкам:\n' + '\n'.join(header for header, _ in plan.exercises)
+            unit = 'reps'
+        else:
+            history = await self.get_history(database_id, self.database_run_operator)
+            values = history.column(chart_type)
+            # скользящее среднее относится к тренировкам, где показатель есть, начиная с 5-й
+            trend = np.full(len(history), np.nan)
+            present = np.flatnonzero(~np.isnan(values))
+            rolling = history.rolling_mean(chart_type, 5)
+            trend[present[len(present) - len(rolling):]] = rolling
+            series = {chart_type: values, 'avg 5': trend}
+            caption = 'Дистанция пробежек, км' if chart_type == 'distance' else 'Темп пробежек, мин/км'
+            unit = 'km' if chart_type == 'distance' else 'min/km'
+        cached: CachedHistory | None = self.__histories.get(database_id)
+        if not series or cached is None or cached.synced_until is None \
+                or all(np.isnan(values).all() for values in series.values()):
+            return None
+        return ChartData(
+            chart_type=chart_type,
+            version=cached.synced_until,
+            caption=caption,
+            days=history.dates.astype(np.int64).tolist(),
+            series={name: values.tolist() for name, values in series.items()},
+            unit=unit
+        )
+
+    @staticmethod
+    def __format_value(name: str, value: float) -> str:
+        if name == 'pace':
+            minutes, seconds = divmod(round(value * 60), 60)
+            return f'{minutes}:{seconds:02d}'
+        return f'{value:.1f}' if name == 'distance' else f'{value:.0f}'
+
+    @staticmethod
+    def __period_lines(history: 'WorkoutHistory', name: str, period: str, unit: str, last: int = 3) -> list[str]:
+        starts, totals, counts = history.aggregate(name, period)
+        title = 'По неделям' if period == 'week' else 'По месяцам'
+        items = [f'{str(start) if period == "week" else str(start)[:7]}: {total:.1f} {unit} ({count})'
+                 for start, total, count in zip(starts[-last:], totals[-last:], counts[-last:])]
+        return [f'{title}: ' + ', '.join(items)] if items else []
@@ -0,0 +1,136 @@
+import datetime
+
+import numpy as np
+
+
+PERIODS = {'week': 'W', 'month': 'M'}
+
+
+class WorkoutHistory:
+    """
+    История тренировок одной базы данных в колоночном виде.
+
+    Даты хранятся в массиве datetime64[D], каждый показатель - в отдельном массиве float64,
+    отсутствующие значения - NaN. Записи упорядочены по дате
+    """
+
+    def __init__(self, ids: np.ndarray, dates: np.ndarray, columns: dict[str, np.ndarray]) -> None:
+        """
+        :param ids: id записей
+        :param dates: даты записей
+        :param columns: показатели по названию, массивы той же длины, что и dates
+        """
+        order = np.argsort(dates, kind='stable')
+        self.ids = ids[order]
+        self.dates = dates[order]
+        self.columns = {name: values[order] for name, values in columns.items()}
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple[str, str | None, dict[str, float]]]) -> 'WorkoutHistory':
+        """
+        Построение истории из записей, записи без даты пропускаются
+
+        :param rows: записи в виде (id, дата в ISO формате, показатели)
+        :return: история
+        """
+        rows = [row for row in rows if row[1]]
+        names: list[str] = sorted({name for _, _, values in rows for name in values})
+        return cls(
+            ids=np.array([row[0] for row in rows], dtype=object),
+            dates=np.array([row[1][:10] for row in rows], dtype='datetime64[D]'),
+            columns={name: np.array([values.get(name, np.nan) for _, _, values in rows], dtype=np.float64)
+                     for name in names}
+        )
+
+    def merge(self, other: 'WorkoutHistory') -> 'WorkoutHistory':
+        """
+        Добавление новых и измененных записей, записи с теми же id заменяются записями из other
+
+        :param other: новые записи
+        :return: объединенная история
+        """
+        keep = ~np.isin(self.ids, other.ids)
+        names = sorted(set(self.columns) | set(other.columns))
+        return WorkoutHistory(
+            ids=np.concatenate([self.ids[keep], other.ids]),
+            dates=np.concatenate([self.dates[keep], other.dates]),
+            columns={name: np.concatenate([self.column(name)[keep], other.column(name)]) for name in names}
+        )
+
+    def column(self, name: str) -> np.ndarray:
+        values = self.columns.get(name)
+        return values if values is not None else np.full(len(self), np.nan)
+
+    def total(self, name: str) -> float:
+        return float(np.nansum(self.column(name)))
+
+    def period_starts(self, period: str) -> np.ndarray:
+        """
+        Начало периода для каждой записи: понедельник недели или первое число месяца
+
+        :param period: 'week' или 'month'
+        :return: массив datetime64[D]
+        """
+        if PERIODS[period] == 'M':
+            return self.dates.astype('datetime64[M]').astype('datetime64[D]')
+        # 1970-01-01 - четверг, поэтому день недели с понедельника равен (days + 3) % 7
+        days = self.dates.astype(np.int64)
+        return self.dates - ((days + 3) % 7).astype('timedelta64[D]')
+
+    def aggregate(self, name: str, period: str, how: str = 'sum') -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Агрегирование показателя по неделям или месяцам
+
+        :param name: показатель
+        :param period: 'week' или 'month'
+        :param how: 'sum', 'mean' или 'max'
+        :return: начала периодов, значения и количество записей с показателем за период
+        """
+        values = self.column(name)
+        present = ~np.isnan(values)
+        starts, inverse = np.unique(self.period_starts(period)[present], return_inverse=True)
+        values = values[present]
+        counts = np.bincount(inverse, minlength=len(starts))
+        match how:
+            case 'sum':
+                result = np.bincount(inverse, weights=values, minlength=len(starts))
+            case 'mean':
+                result = np.bincount(inverse, weights=values, minlength=len(starts)) / np.maximum(counts, 1)
+            case 'max':
+                result = np.full(len(starts), -np.inf)
+                np.maximum.at(result, inverse, values)
+            case _:
+                raise ValueError(f'Unknown aggregation "{how}"')
+        return starts, result, counts
+
+    def record(self, name: str, highest: bool = True) -> tuple[float, datetime.date] | None:
+        """
+        Личный рекорд по показателю
+
+        :param name: показатель
+        :param highest: рекорд - наибольшее значение, иначе наименьшее (например, темп)
+        :return: значение и дата рекорда или None, если значений нет
+        """
+        values = self.column(name)
+        if np.isnan(values).all():
+            return None
+        index = int(np.nanargmax(values) if highest else np.nanargmin(values))
+        return float(values[index]), self.dates[index].item()
+
+    def rolling_mean(self, name: str, window: int) -> np.ndarray:
+        """
+        Скользящее среднее показателя по последним window тренировкам, где он есть
+
+        :param name: показатель
+        :param window: размер окна
+        :return: средние для каждой тренировки начиная с window-й
+        """
+        values = self.column(name)
+        values = values[~np.isnan(values)]
+        if len(values) < window:
+            return np.array([], dtype=np.float64)
+        cumsum = np.cumsum(np.insert(values, 0, 0.0))
+        return (cumsum[window:] - cumsum[:-window]) / window